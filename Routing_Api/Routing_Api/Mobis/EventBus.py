@@ -220,14 +220,56 @@ class Consumer():
 
     
     def _callback(self, ch, method, properties, body):
-        """ Invokes the callback function for the routing key from the message. """
+        """
+        Invokes the callback function for the routing key from the message. Messages are acknowledged before the callback
+        is invoked, unless the callback acknowledges them itself (`defers_ack`, see `rabbit_callback`).
+        """
 
         LOGGER.info(f"Incoming message with body {body}")
         if method.routing_key not in self.callbacks:
             LOGGER.warning(f"{method.routing_key} not registered!")
         try:
-            self.channel.basic_ack(delivery_tag=method.delivery_tag)
-            self.callbacks[method.routing_key](ch, method, properties, body)
+            callback = self.callbacks[method.routing_key]
+            if getattr(callback, 'defers_ack', False):
+                callback(ch, method, properties, body, ack=Acknowledgement(self.connection, ch, method.delivery_tag, method.redelivered))
+            else:
+                self.channel.basic_ack(delivery_tag=method.delivery_tag)
+                callback(ch, method, properties, body)
         except Exception as err:
             LOGGER.error('%s, key: %s', err, method.routing_key, extra={'body': body}, exc_info=True)
+
+
+class Acknowledgement():
+    """
+    Acknowledges one message of the consumer once it is called, from any thread. If the connection of the consumer has been
+    closed in between, the message is redelivered by RabbitMQ (`redelivered` is set then).
+    Without connection (callback invoked directly, not by the consumer) there is nothing to acknowledge.
+    """
+    def __init__(self, connection=None, channel=None, delivery_tag=None, redelivered=False):
+        self._connection = connection
+        self._channel = channel
+        self._delivery_tag = delivery_tag
+        self.redelivered = bool(redelivered)
+        # created by the consumer thread within the callback
+        self._thread = threading.get_ident()
+        self._lock = threading.Lock()
+        self._done = False
+
+    def __call__(self):
+        with self._lock:
+            if self._done or self._connection is None:
+                return
+            self._done = True
+        try:
+            if threading.get_ident() == self._thread:
+                self._ack()
+            else:
+                # the blocking connection is not thread safe, the ack is executed by the consumer thread
+                self._connection.add_callback_threadsafe(self._ack)
+        except Exception as err:
+            LOGGER.warning(f'message {self._delivery_tag} not acknowledged, it will be redelivered: {err}')
+
+    def _ack(self):
+        if self._channel.is_open:
+            self._channel.basic_ack(delivery_tag=self._delivery_tag)
             
@@ -17,7 +17,9 @@
 """
 import json
 import os
+import threading
 import time
+from collections import OrderedDict
 from datetime import datetime, timezone, timedelta
 from functools import wraps
 from typing import List
@@ -26,12 +28,14 @@ from dateutil.parser import parse
 from dateutil.relativedelta import relativedelta
 from dateutil.tz import tzutc
 from django.core.exceptions import ObjectDoesNotExist
-from django.db import transaction, close_old_connections
+from django.db import transaction, close_old_connections, connection
 
 import Routing_Api.mockups.RoadClosures
 from Routing_Api.Mobis.RequestManagerConfig import RequestManagerConfig
-from Routing_Api.Mobis.models import Route
+from Routing_Api.Mobis.models import Route, MapNodeCache, FleetState
+from Routing_Api.Mobis.EventBus import Acknowledgement
 from routing.OSRM_directions import OSRM
+from routing.timing import timer
 from routing.errors import DuplicatedOrder, CommunityConflict, SameStop, NoStop, NoBuses, NoBusesDueToBlocker, \
     BusesTooSmall, \
     InvalidTime, InvalidTime2, MalformedMessage
@@ -45,7 +49,7 @@ LOGGER = logging.getLogger('Mobis.services')
 UTC = tzutc()
 
 
-def rabbit_callback(fields):
+def rabbit_callback(fields, defer_ack=False):
     """
     Decorator function for the callback methods.
     Takes another function as an argument and returns a new function that "wraps" the original function.
@@ -53,6 +57,8 @@ def rabbit_callback(fields):
 
     Args:
         fields (list): A list of required fields to check in the message.
+        defer_ack (bool): The function acknowledges the message itself by calling its `ack` argument (see EventBus.Acknowledgement),
+            messages that raise an error are acknowledged by the wrapper.
 
     Returns:
         function: A decorator function that wraps the original function.
@@ -60,7 +66,7 @@ def rabbit_callback(fields):
 
     def message_decorator(fun):
         @wraps(fun)
-        def wrapper(self, ch=None, method=None, properties=None, body=None):
+        def wrapper(self, ch=None, method=None, properties=None, body=None, ack=None):
             try:
                 del ch
                 del method
@@ -74,12 +80,17 @@ def rabbit_callback(fields):
                         raise ValueError("Invalid input for OrderStartedCallback input parameters:" + str(message))
 
                 close_old_connections()
+                if defer_ack:
+                    return fun(self, message, ack=ack if ack is not None else Acknowledgement())
                 return fun(self, message)
             
             except Exception as e:
                 LOGGER.error(f'Error in rabbit_callback wrapper method: {e}')
+                if ack is not None:
+                    ack()
                 raise e
             
+        wrapper.defers_ack = defer_ack
         return wrapper
 
     return message_decorator
@@ -221,6 +232,19 @@ class RequestManager:
         self.Config = RequestManagerConfig()
         self.RoadClosures = RoadClosures
 
+        # rounded coordinates -> nearest map node, lazily loaded from db (OSRM only)
+        self._nearest_node_cache = None
+
+        # results of is_bookable for repeated identical requests: key -> (time, fleet state version, result, rejected message)
+        self._route_check_cache = OrderedDict()
+        self._route_check_cache_lock = threading.Lock()
+
+        # OrderStarted messages (message, ack) collected for a joint booking (see order_batch), batches are booked one after another
+        self._order_batch = []
+        self._order_batch_lock = threading.Lock()
+        self._order_batch_booking_lock = threading.Lock()
+        self._order_batch_timer = None
+
         # do not use same look_around for promises and availabilities, otherwise for long routes we we might not get solutions
         self.Routes._look_around = self.Config.timeOffset_LookAroundHoursPromises
         self.Busses._look_around = self.Config.timeOffset_LookAroundHoursBusAvailabilites
@@ -251,7 +275,33 @@ class RequestManager:
                 latitude=lat,
                 longitude=lon)
         else:
-            return OSRM(self.OSRM_url).nearest_osmid(lat, lon)
+            key = self.nearest_node_key(lat, lon)
+            cache = self.nearest_node_cache()
+
+            if key in cache:
+                return cache[key]
+
+            mapId = str(OSRM(self.OSRM_url).nearest_osmid(lat, lon))
+            cache[key] = mapId
+            MapNodeCache.objects.update_or_create(key=key, defaults={'mapId': mapId})
+            return mapId
+
+    def nearest_node_key(self, lat, lon):
+        digits = self.Config.osrm_NearestNodeCacheDigits
+        return f'{round(float(lat), digits):.{digits}f},{round(float(lon), digits):.{digits}f}'
+
+    def nearest_node_cache(self):
+        """ Cache of nearest map nodes, warmed with the cached db entries and the mapIds of known stations. """
+        if self._nearest_node_cache is None:
+            cache = {}
+            for station in self.Stations._station.objects.exclude(mapId=None).only('latitude', 'longitude', 'mapId'):
+                cache[self.nearest_node_key(station.latitude, station.longitude)] = station.mapId
+            for entry in MapNodeCache.objects.all():
+                cache[entry.key] = entry.mapId
+            LOGGER.info(f'nearest node cache warmed with {len(cache)} locations')
+            self._nearest_node_cache = cache
+
+        return self._nearest_node_cache
 
     # ------------------- Callback functions to act on messages received from Directus -------------------
     # The specified fields by the rabbit_callback tag are expected to be present in the message payload
@@ -268,6 +318,7 @@ class RequestManager:
                 self.Orders.route_rejected(order_id=orderID, reason=f"The bus for which this route was planned (order id = {orderID}) got deleted from BusDeletedIntegrationCallback.")
             route.delete()
         self.Busses._busses.objects.filter(uid=message.Id).delete()
+        FleetState.bump(message.CommunityId)
 
     @rabbit_callback(fields=['Id', 'CommunityId', 'Name'])
     def BusUpdatedIntegrationCallback(self, message):
@@ -299,6 +350,8 @@ class RequestManager:
         if self.Routes._routes.objects.filter(bus=bus).count() == 0:
             self.Busses._busses.objects.filter(uid=message.Id).delete()
 
+        FleetState.bump(message.CommunityId)
+
     @rabbit_callback(fields=['Id', 'CommunityId', 'Name', 'Latitude', 'Longitude'])
     def StopAddedIntegrationCallback(self, message):
         """ Updates the stations table in the database by adding the new station. """
@@ -316,6 +369,7 @@ class RequestManager:
             latitude=message.Latitude,
             longitude=message.Longitude,
             mapId=mapId)
+        FleetState.bump(message.CommunityId)
 
     @rabbit_callback(fields=['Id', 'CommunityId', 'Name', 'Latitude', 'Longitude'])
     def StopUpdatedIntegrationCallback(self, message):
@@ -347,11 +401,11 @@ class RequestManager:
             if mapId != station.mapId:
                 # TODO eventuell muss man hier genauer spezifizieren, bei anderer MapID muss sich das noch nicht zwingend geaendert haben, oder?...(OSRM, andere Karte...),
                 # in den meisten Faellen duerfte das Kriterium aber passen
-                # die Stelle mit mapId muss evtl umgestellt werden auf node.equalsStation(station) ??
 
-                # reject and delete orders which have the old map node as a hopOn or a hopOff and then delete this node
-                nodes = self.Routes._nodes.objects.prefetch_related('route', 'hopOns', 'hopOffs') \
-                    .filter(mapId=station.mapId, route__community=message.CommunityId).distinct()
+                # reject and delete orders which have the old station node as a hopOn or a hopOff and then delete this node
+                nodes = self.Routes._nodes.objects.select_related('route').prefetch_related('hopOns', 'hopOffs') \
+                    .filter(self.Routes.at_station(station), route__community=message.CommunityId)
+                routes_changed = {}
                 for node in nodes:
                     if node.route.status == Route.BOOKED or node.route.status == Route.DRAFT:  # DO NOT CHANGE FINISHED ROUTES!
                         for order in node.hopOns.all() | node.hopOffs.all():
@@ -359,7 +413,10 @@ class RequestManager:
                             self.Orders.route_rejected(order_id=order.uid, reason=f"Start or destination of order (id = {order.uid}) has changed! Old stop: {station.name} ({station.latitude}, {station.longitude}), New stop: {message.Name} ({message.Latitude}, {message.Longitude})", seats=order.load, seats_wheelchair=order.loadWheelchair)
                             
                             order.delete()
+                        routes_changed[node.route_id] = node.route
                         node.delete()
+                for route in routes_changed.values():
+                    route.update_loads()
 
         except ObjectDoesNotExist as err:
             LOGGER.error(f'StopUpdatedCore: station to update not found: {err}')
@@ -375,6 +432,7 @@ class RequestManager:
             latitude=message.Latitude,
             longitude=message.Longitude,
             mapId=mapId)
+        FleetState.bump(message.CommunityId)
 
         return rejectedOrders
 
@@ -388,17 +446,22 @@ class RequestManager:
             station = self.Stations.get_by_id(station_id=message.Id)
 
             # reject and delete orders which have the deleted node as a hopOn or a hopOff and then delete this node
-            nodes = self.Routes._nodes.objects.prefetch_related('route', 'hopOns', 'hopOffs') \
-                .filter(route__community=station.community).distinct()
+            nodes = self.Routes._nodes.objects.select_related('route').prefetch_related('hopOns', 'hopOffs') \
+                .filter(self.Routes.at_station(station), route__community=station.community)
+            routes_changed = {}
             for node in nodes:
-                if node.equalsStation(station):
-                    for order in node.hopOns.all() | node.hopOffs.all():                        
-                        self.Orders.route_rejected(order_id=order.uid, reason=f"Start or destination of order (id = {order.uid}) has been deleted! Deleted stop: {station.name} ({station.latitude}, {station.longitude})", seats=order.load, seats_wheelchair=order.loadWheelchair)
-                        
-                        order.delete()
-                    node.delete()
+                for order in node.hopOns.all() | node.hopOffs.all():                        
+                    self.Orders.route_rejected(order_id=order.uid, reason=f"Start or destination of order (id = {order.uid}) has been deleted! Deleted stop: {station.name} ({station.latitude}, {station.longitude})", seats=order.load, seats_wheelchair=order.loadWheelchair)
+                    
+                    order.delete()
+                if node.route is not None:
+                    routes_changed[node.route_id] = node.route
+                node.delete()
+            for route in routes_changed.values():
+                route.update_loads()
 
             station.delete()
+            FleetState.bump(station.community)
 
         except ObjectDoesNotExist as err:
             LOGGER.error(f'ObjectDoesNotExist Exception in StopDeletedIntegrationCallback: {err}')
@@ -439,16 +502,52 @@ class RequestManager:
             LOGGER.error(f'Exception in OrderCancelledCallback: {err}')
             pass
 
-    @rabbit_callback(fields=['Id', 'StartLatitude', 'StartLongitude', 'EndLatitude', 'EndLongitude', 'IsDeparture', 'Time', 'Seats','SeatsWheelchair'])
-    # if any part of this method fails, the entire database transaction will be rolled back
-    @transaction.atomic
-    def OrderStartedCallback(self, message):
-        """ Called when a new order is received from RabbitMQ. Creates a new order in the system with the requested parameters. """
+    @rabbit_callback(fields=['Id', 'StartLatitude', 'StartLongitude', 'EndLatitude', 'EndLongitude', 'IsDeparture', 'Time', 'Seats','SeatsWheelchair'], defer_ack=True)
+    def OrderStartedCallback(self, message, ack):
+        """
+        Called when a new order is received from RabbitMQ. Creates a new order in the system with the requested parameters.
+        The message is acknowledged before it is processed, batched messages are acknowledged once their batch is booked
+        (they are redelivered if the process stops before).
+        """
         LOGGER.info(f'OrderStartedCallback {message.Id}')
         
         if (not self.validate_locations(message)):
             raise ValueError('Location-Coordinates are not valid')
-                
+
+        if ack.redelivered:
+            # a redelivered message is processed once more at most (no endless redelivery of a message that stops the process),
+            # its order may have been booked before the process stopped
+            ack()
+            if self.order_confirm_booked(message.Id):
+                return
+            self.order_started(message)
+        elif self.Config.orderBatch_WindowSeconds > 0:
+            self.order_batch_add(message, ack)
+        else:
+            ack()
+            self.order_started(message)
+
+    def order_confirm_booked(self, order_id) -> bool:
+        """ Sends the confirmation of an order again if it is booked already, returns False if it is not booked. """
+        route = self.order2route(order_id)
+        if route is None:
+            return False
+
+        LOGGER.warning(f'order {order_id} of redelivered message is booked already, confirmation is sent again')
+        order_entry = self.Routes._orders.objects.get(uid=order_id)
+        hopOn = order_entry.hopOnNode
+        hopOff = order_entry.hopOffNode
+        self.Orders.route_confirmed(order_id=order_id,
+                                    route_id=route.id,
+                                    start_time_min=hopOn.tMin,
+                                    start_time_max=hopOn.tMax,
+                                    stop_time_min=hopOff.tMin,
+                                    stop_time_max=hopOff.tMax,
+                                    bus_id=route.busId)
+        return True
+
+    def order_message_windows(self, message):
+        """ Start and stop location and the requested time windows of an OrderStarted message. """
         startLocation = message.StartLatitude, message.StartLongitude
         stopLocation = message.EndLatitude, message.EndLongitude
 
@@ -466,6 +565,14 @@ class RequestManager:
             startWindow = None
             stopWindow = (time - relativedelta(minutes=10), time)
 
+        return startLocation, stopLocation, startWindow, stopWindow
+
+    # if any part of this method fails, the entire database transaction will be rolled back
+    @transaction.atomic
+    def order_started(self, message):
+        """ Books the order of an OrderStarted message, the order is rejected if it cannot be booked. """
+        startLocation, stopLocation, startWindow, stopWindow = self.order_message_windows(message)
+
         # due to decorator transaction.atomic, the exceptions below will rollback the transaction
         errorCaught = False
         errorMess = ''
@@ -528,7 +635,211 @@ class RequestManager:
         if errorCaught:
             self.Orders.route_rejected(order_id=message.Id, reason=errorMess, start=startNameInfo, destination=stopNameInfo, bookingTime=message.Time, seats=message.Seats, seats_wheelchair=message.SeatsWheelchair)
 
-    
+    def order_batch_add(self, message, ack):
+        """ Collects an OrderStarted message, the batch is booked after the batch window or as soon as it is full, the message is acknowledged then. """
+        with self._order_batch_lock:
+            self._order_batch.append((message, ack))
+            batch_full = len(self._order_batch) >= self.Config.orderBatch_MaxOrders
+            if not batch_full and self._order_batch_timer is None:
+                self._order_batch_timer = threading.Timer(self.Config.orderBatch_WindowSeconds, self.order_batch_flush)
+                self._order_batch_timer.daemon = True
+                self._order_batch_timer.start()
+
+        if batch_full:
+            self.order_batch_flush()
+
+    def order_batch_flush(self):
+        """ Books the collected OrderStarted messages, batches are booked one after another. """
+        with self._order_batch_lock:
+            entries = self._order_batch
+            self._order_batch = []
+            if self._order_batch_timer is not None:
+                self._order_batch_timer.cancel()
+                self._order_batch_timer = None
+
+        if not entries:
+            return
+
+        with self._order_batch_booking_lock:
+            close_old_connections()
+            try:
+                self.order_batch([message for (message, _) in entries])
+            finally:
+                # the timer thread does not reuse its database connection
+                connection.close()
+                # messages are acknowledged after they are booked or rejected, an unacknowledged batch is redelivered
+                for (_, ack) in entries:
+                    ack()
+
+    def order_batch(self, messages):
+        """
+        Books a batch of OrderStarted messages. The orders of one community are inserted together by one solve and
+        committed in one transaction. Orders that cannot be grouped and all orders of a group without joint solution
+        are booked one by one, i.e. they are confirmed or rejected exactly as without batching.
+        """
+        LOGGER.info(f'order_batch with {len(messages)} orders')
+        groups = OrderedDict() # community -> [(message, start, stop, start window, stop window)]
+        singles = []
+
+        for message in messages:
+            try:
+                startLocation, stopLocation, startWindow, stopWindow = self.order_message_windows(message)
+                start, stop, community = self.new_request_eval_start_stop(startLocation, stopLocation)
+            except Exception as err:
+                LOGGER.debug(f'order {message.Id} is booked on its own: {err}')
+                singles.append(message)
+                continue
+            groups.setdefault(community, []).append((message, start, stop, startWindow, stopWindow))
+
+        for community, entries in groups.items():
+            if len(entries) > 1 and self.order_batch_commit(community, entries):
+                continue
+            singles.extend(entry[0] for entry in entries)
+
+        for message in sorted(singles, key=messages.index):
+            try:
+                self.order_started(message)
+            except Exception as err:
+                LOGGER.error(f'Order {message.Id} could not be processed: {err}')
+
+    def order_batch_commit(self, community, entries) -> bool:
+        """ Books all orders of one community with one solve and one transaction, returns False if they have no joint solution. """
+        confirmations = []
+        try:
+            with transaction.atomic():
+                with timer.phase('solver'):
+                    routes = self.new_request_batch(community, entries)
+                if not routes:
+                    LOGGER.info(f'no joint solution for {len(entries)} orders in community {community}')
+                    return False
+
+                for (message, _, _, _, _) in entries:
+                    self.Routes.commit_order(order_id=message.Id, load=message.Seats, loadWheelchair=message.SeatsWheelchair, group_id=None)
+                with timer.phase('commit'):
+                    if not self.Routes.commit(routes, self.Orders):
+                        raise OrderNotCommittedToRoutes('Solution for orders found but cannot be committed properly into bus routes (forbidden changes of started routes)')
+
+                for (message, _, _, _, _) in entries:
+                    order_entry = self.Routes._orders.objects.get(uid=message.Id)
+                    route = self.Routes.contains_order(message.Id)
+                    hopOn = order_entry.hopOnNode
+                    hopOff = order_entry.hopOffNode
+                    confirmations.append({'order_id': message.Id, 'route_id': route.id,
+                                          'start_time_min': hopOn.tMin, 'start_time_max': hopOn.tMax,
+                                          'stop_time_min': hopOff.tMin, 'stop_time_max': hopOff.tMax,
+                                          'bus_id': route.busId})
+                FleetState.bump(community)
+        except Exception as err:
+            LOGGER.warning(f'{len(entries)} orders in community {community} not booked together, booking one by one: {err}')
+            return False
+
+        # Send messages to Directus after the transaction is committed
+        for confirmation in confirmations:
+            self.Orders.route_confirmed(**confirmation)
+        LOGGER.info(f'{len(entries)} orders booked together in community {community}')
+        return True
+
+    def new_request_batch(self, community, entries):
+        """
+        Solves the orders of one community together (see order_batch), returns the new routes or None if there is no
+        solution for all of them. Only the original time windows are considered and busses must be available for all
+        orders by the same working times, otherwise the orders are left to the single booking.
+        """
+        from routing.routingClasses import Moby
+
+        for (message, _, _, _, _) in entries:
+            if self.order2route(message.Id) is not None:
+                return None
+
+        def reference_time(startWindow, stopWindow):
+            return startWindow[0] if startWindow else stopWindow[1]
+
+        times = [reference_time(startWindow, stopWindow) for (_, _, _, startWindow, stopWindow) in entries]
+
+        allowOrdersInStartedRoutes = False
+        timeMaxForRoutesInOperation = datetime.now(UTC) + timedelta(days=1000*365) # almost infinity
+        if self.Config.timeOffset_MinMinutesToOrderFromNowIntoStartedRoutes > -1:
+            allowOrdersInStartedRoutes = True
+            timeMaxForRoutesInOperation = datetime.now(UTC) + timedelta(minutes=self.Config.timeOffset_MinMinutesToOrderFromNowIntoStartedRoutes)
+
+        with timer.phase('busses'):
+            (busses_for_times, _, busses_have_routes_in_operation) = self.Busses.get_available_buses(
+                community=community, start_times=times, allowOrdersInStartedRoutes=allowOrdersInStartedRoutes, timeMaxForRoutesInOperation=timeMaxForRoutesInOperation)
+
+        # one problem needs one set of vehicles, i.e. the same working times for all orders
+        def vehicle_key(bus):
+            return (bus.id, bus.work_time)
+        common_keys = set.intersection(*[set(vehicle_key(bus) for bus in busses) for busses in busses_for_times])
+        busses = [bus for bus in busses_for_times[0] if vehicle_key(bus) in common_keys]
+        if len(busses) == 0:
+            return None
+
+        requests = []
+        for (message, start, stop, startWindow, stopWindow) in entries:
+            # invalid times are rejected by the single booking
+            self.new_request_eval_time_windows(startWindow, stopWindow, RequestManagerConfig.ALTERNATIVE_SEARCH_NONE, routes_in_operation=busses_have_routes_in_operation)
+            request = Moby(start=Station(node_id=start.mapId, longitude=start.longitude, latitude=start.latitude),
+                           stop=Station(node_id=stop.mapId, longitude=stop.longitude, latitude=stop.latitude),
+                           start_window=startWindow, stop_window=stopWindow, load=MobyLoad(message.Seats, message.SeatsWheelchair))
+            request.order_id = message.Id
+            requests.append(request)
+
+        bus_ids = [bus.id for bus in busses]
+        vehicle_types = [bus.vehicleType for bus in busses]
+
+        # promises around all orders
+        promises = {}
+        with timer.phase('promises'):
+            fleet_version = FleetState.current(community)
+            for time_order in sorted(set(times)):
+                promises.update(self.Routes.get_promises(bus_ids=bus_ids, start_time=time_order, stop_time=None, community=community, fleet_version=fleet_version))
+
+        mandatory_stations = self.Stations.get_mandatory_stations(community=community, before=None, after=None)
+
+        # the earliest order is the time reference of the problem
+        requests.sort(key=lambda request: reference_time(request.start_window, request.stop_window))
+        t_ref, _, promises, mandatory_stations, busses, t_now_normalized = self.normalize_dates(
+            requests[0], promises, mandatory_stations, busses)
+        for request in requests[1:]:
+            self.normalize_dates(request, {}, [], [], t_ref)
+
+        t_min_start_time_for_orders = t_now_normalized
+        if busses_have_routes_in_operation:
+            t_min_start_time_for_orders += self.Config.timeOffset_MinMinutesToOrderFromNowIntoStartedRoutes
+        else:
+            t_min_start_time_for_orders += self.Config.timeOffset_MinMinutesToOrderFromNow
+
+        with timer.phase('closures'):
+            self.RoadClosures.initRoadClosures(community, min(times) - timedelta(minutes=10), max(times) + timedelta(minutes=10))
+            closuresListLatLon = self.RoadClosures.getRoadClosuresList(bus_ids, vehicle_types)
+
+        graph = None
+        graph_source = None
+        if self.OSRM_activated:
+            # the fallback graph is left to the single booking
+            if OSRM.circuit_breaker.is_open:
+                return None
+            if len(closuresListLatLon) > 0:
+                LOGGER.error("Road closures not implemented for OSRM!")
+        elif self.Solver.remote:
+            graph_source = (community, closuresListLatLon)
+        elif self.Maps != None:
+            with timer.phase('graph'):
+                graph_tmp = self.Maps.get_graph(community)
+                if len(closuresListLatLon):
+                    add_detours_from_gps(graph_tmp, closuresListLatLon, [])
+                graph = multi2single(graph_tmp)
+
+        optionsDict = {'slack': 30, 'slack_steps': 3,
+                       'time_offset_factor': self.Config.timeOffset_FactorForDrivingTimes,
+                       'time_service_per_wheelchair': self.Config.timeService_per_wheelchair}
+        optionsDict['build_paths'] = True
+        optionsDict['graph_source'] = graph_source
+
+        raw_solution = self.Solver.solve(graph, self.OSRM_url, requests, promises, mandatory_stations, busses, t_min_start_time_for_orders, optionsDict, {})
+        solution = self.new_request_solution(raw_solution, True, t_ref, busses, community)
+        return solution['routes']
+
     def commit_new_order(self, newRoutes, new_order_id, new_load, new_loadWheelchair, new_group_id) -> bool:
         """
         Commit a new order by updating routes and orders.
@@ -544,7 +855,8 @@ class RequestManager:
         """
         try:            
             self.Routes.commit_order(order_id=new_order_id, load=new_load, loadWheelchair=new_loadWheelchair, group_id=new_group_id)
-            result = self.Routes.commit(newRoutes, self.Orders)
+            with timer.phase('commit'):
+                result = self.Routes.commit(newRoutes, self.Orders)
 
             return result        
         except Exception as e:
@@ -578,6 +890,7 @@ class RequestManager:
             
             order_entry = self.Routes._orders.objects.get(uid=order_id)
             route = self.Routes.contains_order(order_id)
+            FleetState.bump(route.community)
             hopOn = order_entry.hopOnNode
             hopOff = order_entry.hopOffNode
 
@@ -599,6 +912,7 @@ class RequestManager:
             solution['restrictions'] = start_station, stop_station, start_window, stop_window, load, loadWheelchair
             # assign an order to a route
             self.Routes.hop_on(solution['routes'], solution['restrictions'], order_id, self.Orders)
+            FleetState.bump(start_station.community)
             return order_id
 
         raise SolutionFormattingError('unexpected solution case: solution type is neither "new" nor "free"')
@@ -613,9 +927,8 @@ class RequestManager:
         LOGGER.debug(f'cancel_order {order_id}')
 
         try:
-            order = self.Routes._orders.objects.get(uid=order_id)
-            hopOnNode = order.hopOnNode
-            hopOffNode = order.hopOffNode
+            order = self.Routes._orders.objects.select_related('hopOnNode__route').get(uid=order_id)
+            community = order.hopOnNode.route.community if order.hopOnNode is not None else None
         except self.Routes._orders.DoesNotExist:
             LOGGER.error(f'Order with ID {order_id} does not exist.')
             return
@@ -624,21 +937,14 @@ class RequestManager:
             return
 
         try:
-            self.Routes.remove_order(order_id)
+            # empty nodes are removed before the loads and the start time of the route are updated
+            with transaction.atomic():
+                self.Routes.remove_order(order_id, delete_empty_nodes=True)
+                FleetState.bump(community)
         except Exception as e:
             LOGGER.error(f'Error removing order with ID {order_id}: {e}')
             return
 
-        LOGGER.debug(f'remove hopOn or hopOff nodes that are empty after order delete:')
-        try:
-            for node in self.Routes._nodes.objects.all():
-                if not node.has_order:
-                    if node.id == hopOnNode.id or node.id == hopOffNode.id:
-                        LOGGER.debug(f'delete empty node {node.id}')
-                        node.delete()
-        except Exception as e:
-            LOGGER.error(f'Error processing nodes after order deletion: {e}')
-
     def is_bookable(self, start_location, stop_location, start_window, stop_window, load=1, loadWheelchair=0,
                     group_id=None, alternatives_mode=RequestManagerConfig.ALTERNATIVE_SEARCH_NONE, bookingTime=None):
         """Return result, code and message for a given request."""
@@ -659,6 +965,20 @@ class RequestManager:
         rejectedEvent = False
         rejectedMessage = ''
 
+        # repeated identical requests are answered from cache as long as the fleet state of the community is unchanged
+        community = starts[0].community if starts != None and len(starts) > 0 else None
+        fleet_version = None
+        if self.Config.routeCheck_CacheSeconds > 0 and community is not None:
+            fleet_version = FleetState.current(community)
+            cache_key = self.route_check_key(start_location, stop_location, start_window, stop_window, load, loadWheelchair, group_id, alternatives_mode)
+            cached = self.route_check_cached(cache_key, fleet_version)
+            if cached is not None:
+                result, rejectedMessage = cached
+                LOGGER.debug(f'is_bookable: result from cache')
+                if rejectedMessage is not None:
+                    self.Orders.route_rejected(order_id=-1, reason=rejectedMessage, start=startNameInfo, destination=stopNameInfo, bookingTime=bookingTime, seats=load, seats_wheelchair=loadWheelchair)
+                return result
+
         try:
             # empty request can be cancelled
             if load <=0 and loadWheelchair <=0:
@@ -763,11 +1083,45 @@ class RequestManager:
             rejectedMessage = msg
             rejectedEvent = True
             result = (False, self.INTERNAL_EXCEPTION, err.message, times_found, time_slot_min_max)
+
+        if fleet_version is not None and result[1] != self.INTERNAL_EXCEPTION:
+            self.route_check_store(cache_key, fleet_version, result, rejectedMessage if rejectedEvent else None)
             
         if rejectedEvent:
             self.Orders.route_rejected(order_id=-1, reason=rejectedMessage, start=startNameInfo, destination=stopNameInfo, bookingTime=bookingTime, seats=load, seats_wheelchair=loadWheelchair)                
         return result
         
+    def route_check_key(self, start_location, stop_location, start_window, stop_window, load, loadWheelchair, group_id, alternatives_mode):
+        """ Signature of a route check: stops (rounded coordinates), time windows by the minute, loads, group and alternatives mode. """
+        def by_minute(window):
+            return None if window is None else tuple(t.replace(second=0, microsecond=0) for t in window)
+
+        return (self.nearest_node_key(*start_location), self.nearest_node_key(*stop_location),
+                by_minute(start_window), by_minute(stop_window), load, loadWheelchair, group_id, alternatives_mode)
+
+    def route_check_cached(self, key, fleet_version):
+        """ Result and rejected message of an identical route check, None if unknown, expired or the fleet state has changed. """
+        with self._route_check_cache_lock:
+            entry = self._route_check_cache.get(key)
+            if entry is None:
+                return None
+
+            time_cached, version_cached, result, rejectedMessage = entry
+            if version_cached != fleet_version or time.time() - time_cached > self.Config.routeCheck_CacheSeconds:
+                del self._route_check_cache[key]
+                return None
+
+            self._route_check_cache.move_to_end(key)
+            return result, rejectedMessage
+
+    def route_check_store(self, key, fleet_version, result, rejectedMessage):
+        """ Stores the result of a route check, the least recently used entries are removed if the cache is full. """
+        with self._route_check_cache_lock:
+            self._route_check_cache[key] = (time.time(), fleet_version, result, rejectedMessage)
+            self._route_check_cache.move_to_end(key)
+            while len(self._route_check_cache) > self.Config.routeCheck_CacheMaxEntries:
+                self._route_check_cache.popitem(last=False)
+
     def order2route(self, order_id):
         """ Return the `Route` object that contains the order with the matching `order_id`. """
         route = self.Routes.contains_order(order_id)
@@ -924,8 +1278,23 @@ class RequestManager:
                     load: MobyLoad = MobyLoad(1, 0), group_id=None, order_id=None,
                     alternatives_mode=RequestManagerConfig.ALTERNATIVE_SEARCH_NONE, build_paths=True):
         """ Try to generate a solution for a given request and return a descriptive dictionary if there is one, or None. """
+        # all OSRM calls of this request share one latency budget, slow OSRM must not block the request
+        latency_budget = self.Config.osrm_LatencyBudgetSeconds if self.OSRM_activated else None
+
+        # durations of the phases are logged per request and aggregated in histograms (see metrics)
+        with timer.request() as timings:
+            try:
+                with timer.phase('new_request'), OSRM.latency_budget(latency_budget):
+                    return self._new_request(start_location, stop_location, start_window_orig, stop_window_orig,
+                                             load=load, group_id=group_id, order_id=order_id,
+                                             alternatives_mode=alternatives_mode, build_paths=build_paths)
+            finally:
+                if timings:
+                    LOGGER.info(f'new_request timings [ms]: {timer.format(timings)}', extra={'timings': dict(timings)})
+
+    def _new_request(self, start_location, stop_location, start_window_orig, stop_window_orig,
+                     load: MobyLoad, group_id, order_id, alternatives_mode, build_paths):
         LOGGER.debug(f'new_request with order_id {order_id}, start_window_orig{start_window_orig}, stop_window_orig{stop_window_orig}')
-        timeStarted = time.time()
 
         result: List = []
         time_slot_complete = []
@@ -960,7 +1329,8 @@ class RequestManager:
         #     raise err       
 
         # eval bus stops and community from coords
-        start, stop, community = self.new_request_eval_start_stop(start_location, stop_location)
+        with timer.phase('stations'):
+            start, stop, community = self.new_request_eval_start_stop(start_location, stop_location)
         station_start = Station(node_id=start.mapId, longitude=start.longitude, latitude=start.latitude)
         station_stop = Station(node_id=stop.mapId, longitude=stop.longitude, latitude=stop.latitude)
 
@@ -973,6 +1343,9 @@ class RequestManager:
         if not stop.mapId:
             raise NoStop(message=f"No bus stop was found for the given destination {stop.name} location (lat: {stop_location[0]}, long: {stop_location[1]})!")       
      
+        # promises of all time windows are read from the in-memory index of this fleet state version
+        fleet_version = FleetState.current(community)
+
         # eval all available busses for all requested times at once - performance!
         start_times  = []
         stop_times = []
@@ -993,8 +1366,9 @@ class RequestManager:
             allowOrdersInStartedRoutes = True
             timeMaxForRoutesInOperation = datetime.now(UTC) + timedelta(minutes=self.Config.timeOffset_MinMinutesToOrderFromNowIntoStartedRoutes)
                                                                     
-        (busses_for_times, time_in_blocker, busses_have_routes_in_operation) = self.Busses.get_available_buses(
-            community=community, start_times=start_times, stop_times=stop_times, allowOrdersInStartedRoutes=allowOrdersInStartedRoutes, timeMaxForRoutesInOperation=timeMaxForRoutesInOperation)
+        with timer.phase('busses'):
+            (busses_for_times, time_in_blocker, busses_have_routes_in_operation) = self.Busses.get_available_buses(
+                community=community, start_times=start_times, stop_times=stop_times, allowOrdersInStartedRoutes=allowOrdersInStartedRoutes, timeMaxForRoutesInOperation=timeMaxForRoutesInOperation)
         LOGGER.debug(f'available busses calculated {busses_for_times}')
 
         # update time windows if busses have already routes in operation
@@ -1032,16 +1406,26 @@ class RequestManager:
         break_if_first_window_works = True
 
         graph = None
+        graph_fallback = None
+        graph_source = None
+        fallback_graph_source = None
 
         # once calculated times should be reused within iteration - performance!
         apriori_times_matrix = {}
 
+        # alternative windows are independent of each other, their solves may run in parallel at the solver service after the loop
+        parallel_alternatives = alternatives_mode != RequestManagerConfig.ALTERNATIVE_SEARCH_NONE \
+            and self.Solver.remote and len(busses_for_times) > 2
+        jobs_deferred = []
+        alternatives_feasible = 0
+
         # find solution for each time window
         # we assume that the original windows are the first in the list
         for windowIndex in range(len(busses_for_times)):
-            # timeElapsed = time.time()-timeStarted
-            # print('time elapsed')
-            # print(timeElapsed)
+            # early exit if enough alternatives are found
+            if self.Config.alternatives_MaxFeasible is not None and alternatives_feasible >= self.Config.alternatives_MaxFeasible:
+                LOGGER.debug(f'{alternatives_feasible} alternatives found, remaining windows are skipped')
+                break
 
             start_window_current = None
             stop_window_current = None
@@ -1085,6 +1469,8 @@ class RequestManager:
 
                 if windowIndex == 0:
                     original_time_found = True
+                else:
+                    alternatives_feasible += 1
 
                 if windowIndex == 0 and break_if_first_window_works:
                     return result, time_slot_complete, original_time_found
@@ -1138,9 +1524,10 @@ class RequestManager:
                         continue
 
                 # promises are already existing orders within a specified time slot around the current order
-                promises = self.Routes.get_promises(
-                    bus_ids=bus_ids, start_time=start_window_current[0] if start_window_current else None,
-                    stop_time=stop_window_current[1] if stop_window_current else None)
+                with timer.phase('promises'):
+                    promises = self.Routes.get_promises(
+                        bus_ids=bus_ids, start_time=start_window_current[0] if start_window_current else None,
+                        stop_time=stop_window_current[1] if stop_window_current else None, community=community, fleet_version=fleet_version)
                 LOGGER.debug(f'promises={promises}')
                 
                 t_ref, request, promises, mandatory_stations, busses, t_now_normalized = self.normalize_dates(
@@ -1157,40 +1544,59 @@ class RequestManager:
                 # generate graph including road closures do this only once due to performance!
 
                 # road closures
-                if windowIndex == 0:
-                    self.RoadClosures.initRoadClosures(
-                        community, time_slot_complete[0], time_slot_complete[1])
+                with timer.phase('closures'):
+                    if windowIndex == 0:
+                        self.RoadClosures.initRoadClosures(
+                            community, time_slot_complete[0], time_slot_complete[1])
 
-                # graph
-                closuresListLatLon = self.RoadClosures.getRoadClosuresList(
-                    bus_ids, vehicle_types)
+                    closuresListLatLon = self.RoadClosures.getRoadClosuresList(
+                        bus_ids, vehicle_types)
                 LOGGER.debug(f'closuresListLatLon={closuresListLatLon}')
 
-                if self.OSRM_activated == False and graph is None:
+                # graph, the solver service builds it in its workers
+                if self.OSRM_activated == False and self.Solver.remote:
+                    graph_source = (community, closuresListLatLon)
+
+                elif self.OSRM_activated == False and graph is None:
                     LOGGER.debug(f'self.OSRM_activated == False and graph is None')
                     if self.Maps != None:
                         LOGGER.debug(f'community={community}')
                                                 
-                        graph_tmp = self.Maps.get_graph(community) # sometimes SIGSEGV with ERROR 139
-                        LOGGER.debug(f'graph_tmp is loaded')
+                        with timer.phase('graph'):
+                            graph_tmp = self.Maps.get_graph(community) # sometimes SIGSEGV with ERROR 139
+                            LOGGER.debug(f'graph_tmp is loaded')
                         
-                        if len(closuresListLatLon):
-                            # attach road closures to graph
-                            # print("attach detours to graph")
-                            # print(closuresListLatLon)
-                            LOGGER.debug(f'len(closuresListLatLon)>0')
-                            add_detours_from_gps(graph_tmp, closuresListLatLon, [])
-
-                        graph = multi2single(graph_tmp)
-                        LOGGER.debug(f'graph = multi2single(graph_tmp)')
-
-                elif self.OSRM_activated and len(closuresListLatLon) > 0:
-                    LOGGER.error("Road closures not implemented for OSRM!")
+                            if len(closuresListLatLon):
+                                # attach road closures to graph
+                                # print("attach detours to graph")
+                                # print(closuresListLatLon)
+                                LOGGER.debug(f'len(closuresListLatLon)>0')
+                                add_detours_from_gps(graph_tmp, closuresListLatLon, [])
+
+                            graph = multi2single(graph_tmp)
+                            LOGGER.debug(f'graph = multi2single(graph_tmp)')
+
+                elif self.OSRM_activated:
+                    if len(closuresListLatLon) > 0:
+                        LOGGER.error("Road closures not implemented for OSRM!")
+
+                    # OSRM does not respond properly, use map of community for time matrix if maps are loaded
+                    if graph_fallback is None and self.Maps != None and OSRM.circuit_breaker.is_open \
+                            and str(community) in self.Maps.graph.keys():
+                        LOGGER.warning(f'OSRM circuit breaker is open, using graph of community {community} as fallback')
+                        if self.Solver.remote:
+                            fallback_graph_source = (community, [])
+                        else:
+                            graph_fallback = multi2single(self.Maps.get_graph(community))
 
                 optionsDict = {'slack': 30, 'slack_steps': 3,
                                'time_offset_factor': self.Config.timeOffset_FactorForDrivingTimes,
                                'time_service_per_wheelchair': self.Config.timeService_per_wheelchair}
                 optionsDict['build_paths'] = build_paths
+                optionsDict['fallback_graph'] = graph_fallback
+                optionsDict['prune_promises'] = self.Config.promises_Pruning
+                optionsDict['graph_source'] = graph_source
+                optionsDict['fallback_graph_source'] = fallback_graph_source
                 
                 # reduce slack iteration for performance reasons if alternative time windows are under consideration
                 if windowIndex > 0 and alternatives_mode != RequestManagerConfig.ALTERNATIVE_SEARCH_NONE:
@@ -1198,41 +1604,19 @@ class RequestManager:
                     optionsDict['slack'] = 20
                     optionsDict['slack_steps'] = 2
 
-                # timeElapsed = time.time()-timeStarted
-                # print('time elapsed before solver')
-                # print(timeElapsed)
+                solve_args = (self.OSRM_url, request, promises, mandatory_stations, busses, t_min_start_time_for_orders, optionsDict)
+
+                if windowIndex > 0 and parallel_alternatives:
+                    LOGGER.debug(f'solve of window {windowIndex} deferred to solver service')
+                    jobs_deferred.append((len(result), solve_args, t_ref, busses, reason, start_window_current, stop_window_current))
+                    result.append(None) # placeholder, results are merged in window order
+                    continue
+
                 LOGGER.debug(f'Running Solver.solve(..)')
-                raw_solution = self.Solver.solve(graph, self.OSRM_url, request, promises, mandatory_stations, busses, t_min_start_time_for_orders, optionsDict, apriori_times_matrix)
-                # timeElapsed = time.time()-timeStarted
-                # print('time elapsed after solver')
-                # print(timeElapsed)
-
-                solution = {'type': 'new', 'routes': []}
-
-                if raw_solution is not None:
-                    LOGGER.debug(f'raw_solution is not None')
-
-                    if build_paths:
-                        LOGGER.debug(f'denormalize_dates')
-
-                        denormed_solution = self.denormalize_dates(
-                            t_ref, raw_solution)
-                        LOGGER.debug(f'denormed_solution')
-                        for bus_idx, route in denormed_solution.items():
-                            if len(route) <= 2:
-                                continue
-                            trip: Trip = Trip(
-                                busses[bus_idx].id, route[1:-1], promised=False, community=community)
-
-                            if len(trip.nodes) >= 2:
-                                solution['routes'].append(trip)
-                                LOGGER.debug(f'solution[routes].append(trip)')
-                            else:
-                                LOGGER.warning(f'Trip has not enough nodes! Ignored in routes.')
-                                
-                    else:
-                        LOGGER.debug(f'solution[routes].append(True)')
-                        solution['routes'].append(True)
+                with timer.phase('solver'):
+                    raw_solution = self.Solver.solve(graph, *solve_args, apriori_times_matrix)
+
+                solution = self.new_request_solution(raw_solution, build_paths, t_ref, busses, community)
 
                 if solution['routes']:
                     LOGGER.debug(f'if solution[routes]')
@@ -1241,6 +1625,8 @@ class RequestManager:
                     if windowIndex == 0:
                         LOGGER.debug(f'windowIndex == 0')
                         original_time_found = True
+                    else:
+                        alternatives_feasible += 1
 
                     if windowIndex == 0 and break_if_first_window_works:
                         LOGGER.debug(f'windowIndex == 0 and break_if_first_window_works')
@@ -1248,9 +1634,72 @@ class RequestManager:
                 else:
                     LOGGER.debug(f'result.append((None, reason, start_window_current, stop_window_current))')
                     result.append((None, reason, start_window_current, stop_window_current))
+
+        if jobs_deferred:
+            with timer.phase('solver_pool'):
+                self.new_request_solve_parallel(jobs_deferred, result, build_paths, community, alternatives_feasible)
+
         LOGGER.debug(f'return new_request resutls')
         return result, time_slot_complete, original_time_found
 
+    def new_request_solution(self, raw_solution, build_paths, t_ref, busses, community):
+        """ Convert the raw solver solution of one time window into trips. """
+        from routing.routingClasses import Trip
+
+        solution = {'type': 'new', 'routes': []}
+
+        if raw_solution is not None:
+            LOGGER.debug(f'raw_solution is not None')
+
+            if build_paths:
+                LOGGER.debug(f'denormalize_dates')
+
+                denormed_solution = self.denormalize_dates(
+                    t_ref, raw_solution)
+                LOGGER.debug(f'denormed_solution')
+                for bus_idx, route in denormed_solution.items():
+                    if len(route) <= 2:
+                        continue
+                    trip: Trip = Trip(
+                        busses[bus_idx].id, route[1:-1], promised=False, community=community)
+
+                    if len(trip.nodes) >= 2:
+                        solution['routes'].append(trip)
+                        LOGGER.debug(f'solution[routes].append(trip)')
+                    else:
+                        LOGGER.warning(f'Trip has not enough nodes! Ignored in routes.')
+                        
+            else:
+                LOGGER.debug(f'solution[routes].append(True)')
+                solution['routes'].append(True)
+
+        return solution
+
+    def new_request_solve_parallel(self, jobs, result, build_paths, community, alternatives_feasible):
+        """ Solve the deferred alternative windows at the solver service and fill their placeholders in result (window order). """
+        max_feasible = self.Config.alternatives_MaxFeasible
+
+        # all windows are queued at once, the workers of the solver service solve them in parallel
+        futures = [self.Solver.submit_remote(*solve_args) for (_, solve_args, _, _, _, _, _) in jobs]
+
+        for (position, solve_args, t_ref, busses, reason, start_window_current, stop_window_current), future in zip(jobs, futures):
+            # early exit: windows after the first feasible ones are not needed
+            if max_feasible is not None and alternatives_feasible >= max_feasible:
+                future.cancel()
+                continue
+
+            raw_solution = self.Solver.result(future)
+            solution = self.new_request_solution(raw_solution, build_paths, t_ref, busses, community)
+
+            if solution['routes']:
+                alternatives_feasible += 1
+                result[position] = (solution, reason, start_window_current, stop_window_current)
+            else:
+                result[position] = (None, reason, start_window_current, stop_window_current)
+
+        # skipped windows are not part of the result
+        result[:] = [entry for entry in result if entry is not None]
+
     @staticmethod
     def normalize_dates(request, promises, mandatory_stations, busses, t_ref=None):
         """ Transform datetime objects into int64 values for IP-solver. """
@@ -1304,6 +1753,8 @@ class RequestManager:
             normed_promises[order_id]['stop_lat_lon'] = old_promise['stop_lat_lon']
             normed_promises[order_id]['load'] = old_promise['load']
             normed_promises[order_id]['loadWheelchair'] = old_promise['loadWheelchair']
+            normed_promises[order_id]['bus_uid'] = old_promise.get('bus_uid')
+            normed_promises[order_id]['route_id'] = old_promise.get('route_id')
         # TODO:mandatory stations
 
         # min time for orders accepted        
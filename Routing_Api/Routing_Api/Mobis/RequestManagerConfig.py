@@ -35,3 +35,17 @@ class RequestManagerConfig:
         self.timeOffset_LookAroundHoursBusAvailabilites = 10 # do not use same look_around for promises und availabilities, otherwise for long routes we we might not get solutions
 
         self.timeService_per_wheelchair = 3
+
+        self.routeCheck_CacheSeconds = 30 # results of identical route checks are reused within this time if the fleet state of the community is unchanged
+        self.routeCheck_CacheMaxEntries = 1000
+
+        self.promises_Pruning = True # remove promises (complete routes) from the problem that cannot interact with the request
+
+        self.osrm_LatencyBudgetSeconds = (float)(settings.ROUTING_OSRM_LATENCY_BUDGET_SECONDS) # max. time of all OSRM calls within one request
+        self.osrm_NearestNodeCacheDigits = 5 # coordinates are rounded to ~1m for the nearest node cache
+
+        self.solver_Workers = (int)(settings.ROUTING_SOLVER_WORKERS) # processes of the solver service (alternative time windows are solved there in parallel), 0: solve within the request thread
+        self.solver_TimeoutSeconds = (float)(settings.ROUTING_SOLVER_TIMEOUT_SECONDS) # max. time of one job of the solver service (queue, graph, time matrix and search), the request window has no solution otherwise; not applied if solver_Workers is 0
+        self.orderBatch_WindowSeconds = (float)(settings.ROUTING_ORDER_BATCH_SECONDS) # OrderStarted messages are collected for a joint solve per community, 0: each order is booked on its own
+        self.orderBatch_MaxOrders = 10 # a batch is booked immediately if it reaches this size
+        self.alternatives_MaxFeasible = None # stop alternatives search after this number of feasible alternatives (in window order), None: all windows
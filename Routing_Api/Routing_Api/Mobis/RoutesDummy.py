@@ -15,41 +15,63 @@
  
  SPDX-License-Identifier: Apache-2.0
 """
+import threading
+from functools import partial
 from typing import List
 from dateutil.relativedelta import relativedelta
+from routing.polyline import SEPARATOR, encode_polyline
+from routing.promises import PromiseIndex
 from routing.routingClasses import MobyLoad
 import logging
 from dateutil.tz import tzutc
 from datetime import datetime
+from django.db import connections, transaction
+from django.db.models import Max, Min, Q
 
 UTC = tzutc()
 
 LOGGER = logging.getLogger('Mobis.services')
 
 class RoutesDummy():
-    def __init__(self, Route, Node, Order, *args, **kwargs):
+    def __init__(self, Route, Node, Order, Station=None, FleetState=None, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self._routes = Route
         self._nodes = Node
         self._orders = Order
+        self._stations = Station
+        self._fleet_state = FleetState
         self._look_around = kwargs.get('look_around', 1)
+        self._promise_index = {} # community -> PromiseIndex
+        self._promise_index_lock = threading.Lock()
+        self._promises_pending = threading.local() # routes changed by the transaction of the thread, see promises_changed
     def get_free_routes(self, community, start_location, stop_location, start_window, stop_window, load: MobyLoad):
+        """ Routes of the community in operation that pass start and then stop location within the window and have capacity left for the load. """
         routes = []
-        for route in self._routes.objects.prefetch_related('nodes').all():
-            first_node = route.nodes.first()
-            last_node = route.nodes.last()
-            nodes = route.nodes.prefetch_related('hopOns', 'hopOffs').all()
-            if not first_node:
-                continue
-            if start_window is not None and start_window[1] < first_node.tMin:
-                continue
-            if stop_window is not None and stop_window[0] > last_node.tMax:
-                continue
+        if start_window is None and stop_window is None:
+            return routes
+
+        candidates = self._routes.objects.filter(community=community, status__in=[self._routes.BOOKED, self._routes.FROZEN, self._routes.STARTED])\
+            .annotate(time_first=Min('nodes__tMin'), time_last=Max('nodes__tMax'))
+        if start_window is not None:
+            candidates = candidates.filter(time_first__lte=start_window[1])
+        if stop_window is not None:
+            candidates = candidates.filter(time_last__gte=stop_window[0])
+
+        # the route needs a node at the location of the window that matches the window and a node at the other location
+        if start_window:
+            window_location, window, other_location = start_location, start_window, stop_location
+        else:
+            window_location, window, other_location = stop_location, stop_window, start_location
+        candidates = candidates.filter(id__in=self._nodes.objects.filter(self.at_station(window_location), tMin__lte=window[1], tMax__gte=window[0]).values('route_id'))
+        candidates = candidates.filter(id__in=self._nodes.objects.filter(self.at_station(other_location)).values('route_id'))
+
+        for route in candidates.select_related('bus').prefetch_related('nodes'):
+            nodes = list(route.nodes.all())
 
             if start_window:
-                start_node, stop_node = self.find_node_pair(route.nodes.all(), start_location, stop_location, start_window)
-            elif stop_window:
-                stop_node, start_node = self.find_node_pair(reversed(route.nodes.all()), stop_location, start_location, stop_window)
+                start_node, stop_node = self.find_node_pair(nodes, start_location, stop_location, start_window)
+            else:
+                stop_node, start_node = self.find_node_pair(reversed(nodes), stop_location, start_location, stop_window)
             if (start_node is not None) and (stop_node is not None):
                 i=0
                 start_idx = stop_idx = None
@@ -85,11 +107,15 @@ class RoutesDummy():
 
         isCommittable = True # isCommittable defines wether the new orders in solution are committable, i.e. the order is designated to the correct route and changes in the route are acceptable for driver
 
+        # all affected orders with their nodes and routes at once, the order objects are updated and saved in bulk
+        orders_all = self.orders_by_uid(set().union(*[route.clients for route in solution]))
+        plan = []
+
         for route in solution:
             # get all order_ids that are included in this route
             orders = route.clients
             # remember their previous assignment, because we'll change that attribute
-            old_routes = {order_id: self.contains_order(order_id) for order_id in orders}
+            old_routes = {order_id: self.order_route(orders_all[order_id]) if order_id in orders_all else None for order_id in orders}
 
             # check if route is committable and how orders will be moved within routes
             dictStatusValsNotBooked: dict = {}
@@ -100,11 +126,6 @@ class RoutesDummy():
                 if old_routes[order_id] is not None:
                     routeTmp = old_routes[order_id]
 
-                    # print("old route: " + str(routeTmp))
-                    # print("old route id: " + str(routeTmp.id))
-                    # print("old route status: " + str(routeTmp.status))
-                    # print("old route bus id: " + str(routeTmp.bus.uid))
-
                     if routeTmp.status != self._routes.BOOKED:
                         dictStatusValsNotBooked.setdefault(routeTmp.status, set()).update({routeTmp.id})
                     dictRouteIdBusId[routeTmp.id] = routeTmp.bus.uid
@@ -132,48 +153,56 @@ class RoutesDummy():
                     # another route status than started or frozen 
                     # currently not implemented , because we don't know how to handle this case in practise, wait for driver experience
                     isCommittable = False     
-            
-            # print("isCommittable: " + str(isCommittable))
-            # print(str(dictStatusValsNotBooked))
-            # print("commit - route: " + str(route))                   
-
-            if isCommittable == True:
-                # subtract order from old assignment
-                for order_id in orders:
-                    # but only if there actually is one
-                    # and if the route is not the remaining route
-                    if old_routes[order_id] is not None and (old_routes[order_id].id != routeInOperationRouteId):    
-                        self.remove_from_route(old_routes[order_id].id, order_id, True)
-
-                # create and save routes that actually serve someone, but only if there is not a remainung route
-                # a new one can only be of status BOOKED, a remaing should conserve its status
-
-                finalRouteId = -1
-
-                if len(orders) > 0:                    
-                    db_entry = self.create_or_update_route(bus_id=route.bus_id, status_default=self._routes.BOOKED, nodes=route.nodes, route_id=routeInOperationRouteId)
-                                        
-                    # if routeInOperationRouteId >0:
-                    #     print("commit - routeInOperationRouteId: " + str(routeInOperationRouteId))                        
-                    #     print("commit - routeRemaining.nodes: " + str(db_entry.nodes))
-                    #     print("commit - route.nodes: " + str(route.nodes))    
-
-                    finalRouteId = db_entry.id                    
-
-                # communicate new assignments with our event bus
-                for order_id in orders:
-                    if old_routes[order_id] is not None and old_routes[order_id].id != finalRouteId:
-                        order = self._orders.objects.get(uid=order_id)
-                        hopOn = order.hopOnNode
-                        hopOff = order.hopOffNode
-                        Orders.route_changed(order_id=order_id, new_route_id=finalRouteId, old_route_id=old_routes[order_id].id,
-                            start_time_min=hopOn.tMin, start_time_max=hopOn.tMax, stop_time_min=hopOff.tMin, stop_time_max=hopOff.tMax, bus_id = route.bus_id)
-                
-                # driver needs information if started route was changed, only once per route to minimize number of pushes
-                if routeInOperationRouteId > 0:
-                    Orders.current_route_changed_driver_warning(routeInOperationRouteId, route.bus_id)
-            else:
+
+            if isCommittable == False:
+                # nothing is written if any route cannot be committed
                 return False
+
+            plan.append((route, old_routes, routeInOperationRouteId))
+
+        events = []
+        routes_left = {}
+
+        for route, old_routes, routeInOperationRouteId in plan:
+            orders = route.clients
+
+            # orders leave their old assignment (if there is one and it is not the remaining route), their nodes are replaced below
+            for order_id in orders:
+                if old_routes[order_id] is not None and (old_routes[order_id].id != routeInOperationRouteId):
+                    routes_left[old_routes[order_id].id] = old_routes[order_id]
+
+            # create and save routes that actually serve someone, but only if there is not a remainung route
+            # a new one can only be of status BOOKED, a remaing should conserve its status
+
+            finalRouteId = -1
+
+            if len(orders) > 0:                    
+                db_entry = self.create_or_update_route(bus_id=route.bus_id, status_default=self._routes.BOOKED, nodes=route.nodes, route_id=routeInOperationRouteId, orders=orders_all)
+                finalRouteId = db_entry.id                    
+                self.promises_changed(db_entry.community, [db_entry.id])
+
+            # new assignments are communicated with our event bus after all changes are written
+            for order_id in orders:
+                if old_routes[order_id] is not None and old_routes[order_id].id != finalRouteId:
+                    hopOn = orders_all[order_id].hopOnNode
+                    hopOff = orders_all[order_id].hopOffNode
+                    events.append(partial(Orders.route_changed, order_id=order_id, new_route_id=finalRouteId, old_route_id=old_routes[order_id].id,
+                        start_time_min=hopOn.tMin, start_time_max=hopOn.tMax, stop_time_min=hopOff.tMin, stop_time_max=hopOff.tMax, bus_id = route.bus_id))
+
+            # driver needs information if started route was changed, only once per route to minimize number of pushes
+            if routeInOperationRouteId > 0:
+                events.append(partial(Orders.current_route_changed_driver_warning, routeInOperationRouteId, route.bus_id))
+
+        # routes that have no orders left are removed (as in remove_from_route)
+        for route_left in routes_left.values():
+            self.promises_changed(route_left.community, [route_left.id])
+            if not route_left.blocking and not self._orders.objects.filter(Q(hopOnNode__route_id=route_left.id) | Q(hopOffNode__route_id=route_left.id)).exists():
+                route_left.delete()
+            else:
+                route_left.update_loads()
+
+        for event in events:
+            event()
                     
         return isCommittable
 
@@ -207,6 +236,8 @@ class RoutesDummy():
                 node.save()
         if (len(route.clients()) == 0) and deleteRouteIfEmpty==True and not route.blocking:
             route.delete()
+        else:
+            route.update_loads()
 
     def hop_on(self, solution, restrictions, order_id, Orders) -> bool:
         """
@@ -270,6 +301,8 @@ class RoutesDummy():
 
             start_node.save()
             stop_node.save()
+            route.update_loads()
+            self.promises_changed(route.community, [route.id])
 
             orderAdded = True
 
@@ -292,6 +325,11 @@ class RoutesDummy():
 
         return orderAdded
 
+    @staticmethod
+    def at_station(station) -> Q:
+        """ Node filter that corresponds to Node.equalsStation, stop nodes are linked to their station. """
+        return Q(station_id=station.id)
+
     @staticmethod
     def find_node_pair(nodes, loc1, loc2, twin):
         """
@@ -315,8 +353,9 @@ class RoutesDummy():
                 break
         return node1, node2
 
-    def get_promises(self, bus_ids, start_time, stop_time):
-        """ Returns all active promises (i.e., already existing orders) within the given time frame and bus list """
+    def get_promises(self, bus_ids, start_time, stop_time, community=None, fleet_version=None):
+        """ Returns all active promises (i.e., already existing orders) within the given time frame and bus list,
+        answered from the in-memory index of the community if its fleet state version is given """
 
         from collections import defaultdict
 
@@ -326,6 +365,10 @@ class RoutesDummy():
         shift_start = time - relativedelta(hours=self._look_around)
         shift_end = time + relativedelta(hours=self._look_around)
 
+        if community is not None and fleet_version is not None:
+            index = self.promise_index(community, fleet_version)
+            return index.query(bus_ids, shift_start, shift_end, datetime.now(UTC))
+
         orders = self._orders.objects.prefetch_related('hopOnNode', 'hopOnNode__route', 'hopOnNode__route__bus', 'hopOffNode', 'hopOffNode__route').filter(
             hopOnNode__route__status__in=[self._routes.BOOKED, self._routes.FROZEN, self._routes.STARTED])
         orders = orders.filter(hopOnNode__route__bus__uid__in=bus_ids)
@@ -359,6 +402,7 @@ class RoutesDummy():
                 promises[order.uid]['loadWheelchair'] = order.loadWheelchair
                 promises[order.uid]['route_status'] = order.hopOnNode.route.status
                 promises[order.uid]['bus_uid'] = order.hopOnNode.route.bus.uid
+                promises[order.uid]['route_id'] = order.hopOnNode.route_id
                 # print (f"Promise start: {promises[order.uid]['start']}")
                 # print (f"Promise stop: {promises[order.uid]['stop']}")
                 # print (f"Promise route status: {promises[order.uid]['route_status']}")
@@ -366,47 +410,195 @@ class RoutesDummy():
 
         return promises
 
-    def create_or_update_route(self, bus_id, status_default, nodes, route_id = -1):
-        """ Create a 'proper' route object from a list of nodes """
+    def promise_orders(self, community):
+        """ Orders of the active promises of the community """
+        return self._orders.objects.select_related('hopOnNode__route__bus', 'hopOffNode').filter(
+            hopOnNode__route__community=community,
+            hopOnNode__route__status__in=[self._routes.BOOKED, self._routes.FROZEN, self._routes.STARTED])
+
+    def promise_index(self, community, fleet_version) -> PromiseIndex:
+        """
+        Index of the active promises of the community, rebuilt from the database if it is older than the fleet state version.
+        Changes of this process are applied to the index (see promises_changed), i.e. it is rebuilt after changes of other processes only.
+        """
+        index = self._promise_index.get(community)
+        if index is not None and index.version >= fleet_version:
+            return index
+
+        with self._promise_index_lock:
+            index = self._promise_index.get(community)
+            if index is None or index.version < fleet_version:
+                # the version is read before the orders, i.e. the index contains at least the changes up to it
+                version = self._fleet_state.current(community) if self._fleet_state is not None else fleet_version
+                index = PromiseIndex(max(version, fleet_version), self.promise_orders(community))
+                self._promise_index[community] = index
+                LOGGER.debug(f'promise index of community {community} rebuilt for fleet state version {index.version}')
+        return index
+
+    def promises_changed(self, community, route_ids):
+        """ The transaction of this thread changes the promises of the routes, they are updated in the promise index once it is committed """
+        if community is None:
+            return
+        if self._fleet_state is None or not transaction.get_connection().in_atomic_block:
+            self.forget_promises(community)
+            return
+        pending = getattr(self._promises_pending, 'routes', None)
+        if pending is None:
+            pending = self._promises_pending.routes = {}
+        pending.setdefault(community, set()).update(route_ids)
+        transaction.on_commit(partial(self.refresh_promises, community))
+
+    def refresh_promises(self, community):
+        """
+        Applies the committed changes of routes to the promise index (see promises_changed) and advances its version.
+        The transaction has increased the fleet state version by one, if it has increased by more, another process has changed
+        the community as well and the index is rebuilt with the next request.
+        """
+        route_ids = getattr(self._promises_pending, 'routes', {}).pop(community, None)
+        if not route_ids:
+            return
+
+        with self._promise_index_lock:
+            index = self._promise_index.get(community)
+            if index is None:
+                return
+            version = self._fleet_state.current(community)
+            if version != index.version + 1:
+                LOGGER.debug(f'promise index of community {community} at version {index.version} dropped, fleet state version is {version}')
+                self._promise_index.pop(community, None)
+                return
+            index.update_routes(route_ids, self.promise_orders(community).filter(hopOnNode__route_id__in=route_ids))
+            index.version = version
+
+    def forget_promises(self, community):
+        """ Drops the promise index of the community, it is rebuilt with the next request """
+        with self._promise_index_lock:
+            self._promise_index.pop(community, None)
+
+    def create_or_update_route(self, bus_id, status_default, nodes, route_id = -1, orders = None):
+        """ Create a 'proper' route object from a list of nodes, orders (uid -> Order) may be prefetched by the caller and are updated """
+
+        # only stops are saved as nodes, the paths in between are saved as geometry of the route
+        stations_by_map_id, stations_by_lat_lon = self.station_lookup()
+        def is_stop(n):
+            return bool(n.hop_on or n.hop_off) or n.map_id in stations_by_map_id
 
         if route_id < 0:
             route = self._routes.create_route_with_busId(busId=bus_id, status=status_default)
-            route.save()
         else:
             route = self._routes.objects.filter(pk=route_id).first()
+        route.geometry = self.route_geometry(nodes, is_stop)
+        route.save()
 
+        if orders is None:
+            orders = {}
+        order_ids = set(n.hop_on for n in nodes if n.hop_on) | set(n.hop_off for n in nodes if n.hop_off)
+        orders.update(self.orders_by_uid(order_ids - orders.keys()))
+        for order_id in order_ids - orders.keys():
+            orders[order_id], created = self._orders.objects.get_or_create(uid=order_id)
+
+        nodes_new = []
         for n in nodes:
+            if not is_stop(n):
+                continue
             addHopOn = True
             addHopOff = True
 
             if route_id > 0 and n.hop_on:
-                order = self._orders.objects.filter(uid=n.hop_on).first() 
-                if order is not None and order.hopOnNode is not None and order.hopOnNode.route.id == route_id:
+                order = orders[n.hop_on]
+                if order.hopOnNode is not None and order.hopOnNode.route_id == route_id:
                     # the order is already part of the route, skip the node
-                    #print("node skipped in create_or_update_route:" + str(n))
                     addHopOn = False
             
             if route_id > 0 and n.hop_off:
-                order = self._orders.objects.filter(uid=n.hop_off).first() 
-                if order is not None and order.hopOffNode is not None and order.hopOffNode.route.id == route_id:
+                order = orders[n.hop_off]
+                if order.hopOffNode is not None and order.hopOffNode.route_id == route_id:
                     # the order is already part of the route, skip the node
-                    #print("node skipped in create_or_update_route:" + str(n))
                     addHopOff = False
 
             if addHopOn or addHopOff:
+                # a node at the coordinates of a station belongs to it, otherwise to the station at its map node
+                station_id = stations_by_lat_lon.get(self.lat_lon_key(n.lat, n.lon), stations_by_map_id.get(n.map_id))
                 node = self._nodes(mapId=n.map_id,tMin=n.time_min,tMax=n.time_max,
-                                route=route, latitude=n.lat, longitude=n.lon)
-                node.save()
-                if n.hop_on and addHopOn:
-                    hop_on, created = self._orders.objects.get_or_create(uid=n.hop_on)
-                    hop_on.hopOnNode = node
-                    hop_on.save()
-                if n.hop_off and addHopOff:
-                    hop_off, created = self._orders.objects.get_or_create(uid=n.hop_off)
-                    hop_off.hopOffNode = node
-                    hop_off.save()
+                                route=route, latitude=n.lat, longitude=n.lon, station_id=station_id)
+                nodes_new.append((node, n, addHopOn, addHopOff))
+
+        self.save_nodes([node for (node, _, _, _) in nodes_new])
+
+        orders_changed = {}
+        for node, n, addHopOn, addHopOff in nodes_new:
+            if n.hop_on and addHopOn:
+                orders[n.hop_on].hopOnNode = node
+                orders_changed[n.hop_on] = orders[n.hop_on]
+            if n.hop_off and addHopOff:
+                orders[n.hop_off].hopOffNode = node
+                orders_changed[n.hop_off] = orders[n.hop_off]
+
+        if orders_changed:
+            self._orders.objects.bulk_update(list(orders_changed.values()), ['hopOnNode', 'hopOffNode'])
+        route.update_loads()
 
         return route
+
+    def save_nodes(self, nodes):
+        """ Inserts the nodes with one query if the database returns the primary keys of bulk inserts, one by one otherwise. """
+        if connections[self._nodes.objects.db].features.can_return_rows_from_bulk_insert:
+            self._nodes.objects.bulk_create(nodes)
+        else:
+            for node in nodes:
+                node.save()
+
+    def orders_by_uid(self, order_ids) -> dict:
+        """ Orders with their hop on/off nodes and routes, fetched with one query. """
+        if not order_ids:
+            return {}
+        orders = self._orders.objects.select_related('hopOnNode__route__bus', 'hopOffNode__route__bus').filter(uid__in=order_ids)
+        return {order.uid: order for order in orders}
+
+    def station_lookup(self):
+        """
+        Station ids by map id and by coordinates (see lat_lon_key) to link stop nodes to their station.
+        Nodes at stations are kept since orders may hop on later (see get_free_routes).
+        """
+        stations_by_map_id, stations_by_lat_lon = {}, {}
+        if self._stations is None:
+            return stations_by_map_id, stations_by_lat_lon
+        for station_id, mapId, latitude, longitude in self._stations.objects.order_by('uid').values_list('id', 'mapId', 'latitude', 'longitude'):
+            if mapId is not None:
+                stations_by_map_id.setdefault(mapId, station_id)
+            stations_by_lat_lon.setdefault(self.lat_lon_key(latitude, longitude), station_id)
+        return stations_by_map_id, stations_by_lat_lon
+
+    @staticmethod
+    def lat_lon_key(latitude, longitude):
+        """ Coordinates rounded to the precision of Node.equalsStation """
+        if latitude is None or longitude is None:
+            return None
+        return (round(latitude, 6), round(longitude, 6))
+
+    @staticmethod
+    def route_geometry(nodes, is_stop) -> str:
+        """
+        Encodes the paths between consecutive stops: one polyline of (map id, tMin, tMax-tMin) per leg (times in seconds),
+        legs are joined by the separator. A leg with map ids that are no integers is left empty.
+        """
+        legs = []
+        leg = None
+        for n in nodes:
+            if is_stop(n):
+                if leg is not None:
+                    legs.append(leg)
+                leg = []
+            elif leg is not None:
+                leg.append(n)
+
+        encoded = []
+        for leg in legs:
+            try:
+                encoded.append(encode_polyline((int(n.map_id), int(n.time_min.timestamp()), int((n.time_max-n.time_min).total_seconds())) for n in leg))
+            except (TypeError, ValueError):
+                encoded.append('')
+        return SEPARATOR.join(encoded)
     
     def contains_order(self, order_id):
         """
@@ -415,9 +607,15 @@ class RoutesDummy():
         If the nodes are not part of the same route, it raises an exception. If no order is found, it returns `None`.
         """
 
-        order = self._orders.objects.filter(uid=order_id).first()
+        order = self._orders.objects.select_related('hopOnNode__route__bus', 'hopOffNode__route__bus').filter(uid=order_id).first()
         if order is None:
             return None
+        return self.order_route(order)
+
+    @staticmethod
+    def order_route(order):
+        """ Route of an order (see contains_order). """
+        order_id = order.uid
         route1 = None
         route2 = None
 
@@ -435,27 +633,26 @@ class RoutesDummy():
         else:
             return route1
 
-    def remove_order(self, order_id):
-        order = self._orders.objects.get(uid=order_id)
+    def remove_order(self, order_id, delete_empty_nodes=False):
+        """ Deletes the order, optionally with its hop on/off nodes that are empty then, and updates the loads and start times of its routes """
+        order = self._orders.objects.select_related('hopOnNode__route', 'hopOffNode__route').get(uid=order_id)
+        node_ids = [node.id for node in (order.hopOnNode, order.hopOffNode) if node is not None]
+        routes = {node.route_id: node.route for node in (order.hopOnNode, order.hopOffNode) if node is not None and node.route is not None}
         order.delete()
+        if delete_empty_nodes:
+            # only the two nodes of the order are checked, the existence of other orders is looked up by the indexed foreign keys
+            empty_node_ids = list(self._nodes.objects.filter(id__in=node_ids, hopOns__isnull=True, hopOffs__isnull=True).values_list('id', flat=True))
+            for node_id in empty_node_ids:
+                LOGGER.debug(f'delete empty node {node_id}')
+            self._nodes.objects.filter(id__in=empty_node_ids).delete()
+        for route in routes.values():
+            route.update_loads()
+            self.promises_changed(route.community, [route.id])
 
     @staticmethod
     def node_loads(nodes)-> List[MobyLoad]:
-        from django.db.models import Sum
-        loads: List[MobyLoad] = []
-
-        load = 0
-        loadWheelchair = 0
-
-        for node in nodes:
-            if node.hopOns.count() > 0:
-                load += node.hopOns.aggregate(Sum('load'))['load__sum']
-                loadWheelchair += node.hopOns.aggregate(Sum('loadWheelchair'))['loadWheelchair__sum']
-            if node.hopOffs.count() > 0:
-                load -= node.hopOffs.aggregate(Sum('load'))['load__sum']
-                loadWheelchair -= node.hopOffs.aggregate(Sum('loadWheelchair'))['loadWheelchair__sum']
-            loads.append(MobyLoad(load,loadWheelchair))
-        return loads
+        # cumulative loads are materialized in the nodes, see Route.update_loads
+        return [node.loadAll for node in nodes]
 
     @classmethod
     def free_capacities_sufficient_for_load(cls, bus, nodes, loadAdded:MobyLoad, startIndex, stopIndex) -> bool:
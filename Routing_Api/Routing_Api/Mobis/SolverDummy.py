@@ -15,29 +15,169 @@
  
  SPDX-License-Identifier: Apache-2.0
 """
+import logging
+import multiprocessing
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, Future, TimeoutError
+from concurrent.futures.process import BrokenProcessPool
+
+from routing.OSRM_directions import OSRM
 from routing.routingClasses import MobyLoad, Station
-from routing.rutils import moby2order
+from routing.timing import timer
+from routing.rutils import moby2order, add_detours_from_gps, multi2single
+
+LOGGER = logging.getLogger('Mobis.services')
+
+# data of a solver service worker, the maps are inherited by fork (not pickled per job)
+_worker_data = {}
+
+# graphs (with road closures) built by a solver service worker, the newest ones are kept
+SERVICE_GRAPHS_MAX = 4
+
+# the client waits this long beyond the time budget of a job for its solution
+RESULT_GRACE_SECONDS = 2
+
+def _init_service_worker(maps):
+    _worker_data['maps'] = maps
+    _worker_data['graphs'] = OrderedDict()
+
+def _service_graph(graph_source):
+    """ Graph of the community with road closures and its time matrix cache, built once per worker. """
+    community, closuresListLatLon = graph_source
+    key = (str(community), repr(closuresListLatLon))
+    graphs = _worker_data['graphs']
+
+    if key not in graphs:
+        graph_tmp = _worker_data['maps'].get_graph(community)
+        if len(closuresListLatLon):
+            add_detours_from_gps(graph_tmp, closuresListLatLon, [])
+        graphs[key] = (multi2single(graph_tmp), {})
+        while len(graphs) > SERVICE_GRAPHS_MAX:
+            graphs.popitem(last=False)
+
+    graphs.move_to_end(key)
+    return graphs[key]
+
+def _solve_in_service(OSRM_url:str, request, promises, mandatory_stations, busses, t_min_start_time_for_orders, options):
+    """ Solves a job of the solver service, returns the solution, the outcomes of the OSRM calls and the phase durations
+    (reported to the OSRM circuit breaker and the timer of the client process, see SolverDummy.result). """
+    with timer.request() as timings, OSRM.circuit_breaker.recording(options.get('osrm_breaker_state')) as osrm_events, \
+            OSRM.latency_budget(options.get('osrm_budget_seconds')):
+        graph, apriori_times_matrix = None, {}
+        if options.get('graph_source') is not None:
+            graph, apriori_times_matrix = _service_graph(options['graph_source'])
+        if options.get('fallback_graph_source') is not None:
+            options['fallback_graph'] = _service_graph(options['fallback_graph_source'])[0]
+        # the time in the queue and for the graph counts as well, the client does not wait for the solution anymore
+        if options.get('deadline') is not None and time.time() >= options['deadline']:
+            LOGGER.warning('solver service job expired before it was solved')
+            solution = None
+        else:
+            solution = solve_problem(graph, OSRM_url, request, promises, mandatory_stations, busses, t_min_start_time_for_orders, options, apriori_times_matrix)
+    return solution, osrm_events, dict(timings)
+
+def solve_problem(graph, OSRM_url:str, request, promises, mandatory_stations, busses, t_min_start_time_for_orders, options, apriori_times_matrix):
+    """ Solve one routing problem in the calling process, request may be a list of requests that are inserted together. """
+    from routing.routing import new_routing, new_routing_batch, Moby
+    promise_mobies: dict[int, Moby] = {}
+    for order_id, promise in promises.items():  
+        start_location, start_window = promise['start']
+        start_lat, start_lon = promise['start_lat_lon']
+        stop_location, stop_window = promise['stop']
+        stop_lat, stop_lon = promise['stop_lat_lon']
+        load = MobyLoad(promise['load'], promise['loadWheelchair'])
+        station_start = Station(node_id=start_location, latitude=start_lat, longitude=start_lon)
+        station_stop = Station(node_id=stop_location, latitude=stop_lat, longitude=stop_lon)
+        promise_mobies[order_id] = Moby(station_start, station_stop, start_window, stop_window, load)
+        promise_mobies[order_id].order_id = order_id
+        promise_mobies[order_id].bus_id = promise.get('bus_uid') # committed route is used as initial solution
+        promise_mobies[order_id].route_id = promise.get('route_id') # promises are removed per route if they cannot interact with the request
+
+    if isinstance(request, list):
+        solution = new_routing_batch(graph, OSRM_url, request, promise_mobies, mandatory_stations, busses, t_min_start_time_for_orders, options, apriori_times_matrix)
+    else:
+        solution = new_routing(graph, OSRM_url, request, promise_mobies, mandatory_stations, busses, t_min_start_time_for_orders, options, apriori_times_matrix)
+    if solution is None:
+        return None
+    routing = solution[1]
+    return moby2order(routing)
 
 
 class SolverDummy():
+    def __init__(self, workers:int=0, timeout_seconds:float=None, maps=None):
+        """ workers > 0: problems are solved by a pool of solver processes (solver service) that lives as long as the solver,
+        the graphs are built by the workers from the maps, thus only the problem itself is serialized per job.
+        timeout_seconds > 0: time budget of a job of the solver service from its submission, the worker gives the job up
+        (no solution) once it is used up. Problems solved within the request thread have no time limit. """
+        self.workers = workers
+        self.timeout_seconds = timeout_seconds
+        self.maps = maps
+        self._service: ProcessPoolExecutor = None
+
+    @property
+    def remote(self) -> bool:
+        return self.workers > 0
+
+    def service(self) -> ProcessPoolExecutor:
+        """ The pool of solver processes, started with the first job. The workers are forked to inherit the maps without
+        pickling them. A fork copies only the forking thread, thus jobs must not rely on state of other threads (locks held by
+        the consumer thread or gevent hub of the API process): the workers solve with the routing package only and do not
+        use the database or the event bus. """
+        if self._service is None:
+            self._service = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context('fork'),
+                                                initializer=_init_service_worker, initargs=(self.maps,))
+            LOGGER.info(f'solver service started with {self.workers} workers')
+        return self._service
+
+    def restart_service(self, service: ProcessPoolExecutor):
+        """ Replaces a broken pool (a worker has died), its remaining processes are stopped. """
+        if service is None or self._service is not service:
+            return
+        self._service = None
+        service.shutdown(wait=False, cancel_futures=True)
+
     def solve(self, graph, OSRM_url:str, request, promises, mandatory_stations, busses, t_min_start_time_for_orders, options, apriori_times_matrix):
+        if self.remote:
+            return self.result(self.submit_remote(OSRM_url, request, promises, mandatory_stations, busses, t_min_start_time_for_orders, options))
+        return solve_problem(graph, OSRM_url, request, promises, mandatory_stations, busses, t_min_start_time_for_orders, options, apriori_times_matrix)
 
-        from routing.routing import new_routing, Moby
-        promise_mobies: dict[int, Moby] = {}
-        for order_id, promise in promises.items():  
-            start_location, start_window = promise['start']
-            start_lat, start_lon = promise['start_lat_lon']
-            stop_location, stop_window = promise['stop']
-            stop_lat, stop_lon = promise['stop_lat_lon']
-            load = MobyLoad(promise['load'], promise['loadWheelchair'])
-            station_start = Station(node_id=start_location, latitude=start_lat, longitude=start_lon)
-            station_stop = Station(node_id=stop_location, latitude=stop_lat, longitude=stop_lon)
-            promise_mobies[order_id] = Moby(station_start, station_stop, start_window, stop_window, load)
-            promise_mobies[order_id].order_id = order_id
+    def submit_remote(self, OSRM_url:str, request, promises, mandatory_stations, busses, t_min_start_time_for_orders, options) -> Future:
+        """ Queue a problem at the solver service, the graph is given by options['graph_source'] = (community, road closures). """
+        if self.timeout_seconds:
+            options = dict(options, deadline=time.time() + self.timeout_seconds, time_limit_seconds=self.timeout_seconds)
+        # the OSRM calls of the job share the latency budget of the request and follow the circuit breaker of this process
+        options = dict(options, osrm_budget_seconds=OSRM.budget_remaining(), osrm_breaker_state=OSRM.circuit_breaker.state)
+        service = self.service()
+        try:
+            future = service.submit(_solve_in_service, OSRM_url, request, promises, mandatory_stations, busses, t_min_start_time_for_orders, options)
+        except RuntimeError as err:
+            # a crashed worker breaks the pool (BrokenProcessPool is a RuntimeError), it is restarted
+            LOGGER.error(f'solver service not available, restarting it: {err}')
+            self.restart_service(service)
+            service = self.service()
+            future = service.submit(_solve_in_service, OSRM_url, request, promises, mandatory_stations, busses, t_min_start_time_for_orders, options)
+        # the pool of the job is restarted if its worker dies, see result
+        future.solver_service = service
+        return future
 
-        solution = new_routing(graph, OSRM_url, request, promise_mobies, mandatory_stations, busses, t_min_start_time_for_orders, options, apriori_times_matrix)
-        if solution is None:
+    def result(self, future: Future):
+        """ Solution of a queued problem, None (no solution) if the solver does not finish in time. """
+        # the worker stops at the deadline of the job, the grace period covers the transfer of the solution
+        timeout = self.timeout_seconds + RESULT_GRACE_SECONDS if self.timeout_seconds else None
+        try:
+            solution, osrm_events, timings = future.result(timeout=timeout)
+        except TimeoutError:
+            future.cancel()
+            LOGGER.warning(f'solver did not finish within {self.timeout_seconds} seconds, no solution')
             return None
-        routing = solution[1]
-        return moby2order(routing)
-    
+        except BrokenProcessPool as err:
+            # the worker of the job died (e.g. crash within the solver), the pool is restarted with the next job
+            LOGGER.error(f'solver service worker died, no solution: {err}')
+            self.restart_service(getattr(future, 'solver_service', None))
+            return None
+
+        OSRM.circuit_breaker.replay(osrm_events)
+        for phase, duration_ms in timings.items():
+            timer.record(phase, duration_ms)
+        return solution
@@ -34,13 +34,15 @@ from routing.errors import DuplicatedOrder
 from Routing_Api.mockups.db_busses import Busses
 from Routing_Api.mockups.RoadClosures import RoadClosures
 from routing.maps import Maps
+from routing.OSRM_directions import OSRM
+from routing.timing import timer
 from Routing_Api.mockups.stations import WebStations as Stations
 from Routing_Api.Mobis.OrdersMQ import OrdersMQ as Orders
 from Routing_Api.Mobis.RequestManager import RequestManager
 from Routing_Api.Mobis.RoutesDummy import RoutesDummy as Routes
 from Routing_Api.Mobis.SolverDummy import SolverDummy as Solver
 
-from Routing_Api.Mobis.models import Bus, Node, Order, Route, Station
+from Routing_Api.Mobis.models import Bus, FleetState, Node, Order, Route, Station
 from Routing_Api.Mobis.serializers import NodeSerializer, RouteSerializer
 from Routing_Api.Mobis.signals import RabbitMqListener as Listener
 from Routing_Api.Mobis.signals import RabbitMqSender as Publisher
@@ -71,6 +73,11 @@ if os.environ.get('IS_CELERY_APP', 'no') != "yes":
         OSRM_activated = True
         LOGGER.info(f'OSRM_ACTIVATED, osrmUrl={osrmUrl}')
         print('OSRM_ACTIVATED')
+
+        # optional: maps are used as fallback if OSRM does not respond
+        if os.environ.get('OSRM_FALLBACK_MAPS', 'no') == 'yes' and os.path.isdir('../maps'):
+            maps = Maps(data_dir='../maps')
+            LOGGER.info(f'maps loaded as OSRM fallback, maps={maps}')
     else:
         # load maps from files
         if os.path.isdir('../maps'):
@@ -82,18 +89,23 @@ if os.environ.get('IS_CELERY_APP', 'no') != "yes":
             LOGGER.info(f'could not locate a data directory with map data')       
             raise FileNotFoundError('could not locate a data directory with map data')
     
+    solverConfig = RequestManagerConfig()
     Requests = RequestManager(
-        Routes=Routes(Route=Route, Node=Node, Order=Order),
+        Routes=Routes(Route=Route, Node=Node, Order=Order, Station=Station, FleetState=FleetState),
         Busses=Busses(busUrl=API_URI+'/items/bus',busAvailUrl=API_URI+'/customendpoints/operatingtime', BusDb=Bus, RouteDb=Route),
         Stations=Stations(stopUrl=API_URI+'/customendpoints/stops', StationDb=Station),
         Maps=maps,
         OSRM_activated = OSRM_activated,
         OSRM_url = OSRM_url,
-        Solver=Solver(),
+        Solver=Solver(workers=solverConfig.solver_Workers, timeout_seconds=solverConfig.solver_TimeoutSeconds, maps=maps),
         Orders=Orders(MessageBus=Publisher(), Listener=Listener()), RoadClosures=RoadClosures(API_URI))
 
 def GetRequestManager()->RequestManager:
     return Requests
+
+def Metrics():
+    """ Runtime metrics of the routing service. """
+    return {'osrm': OSRM.circuit_breaker.metrics(), 'timings': timer.metrics()}
     
 def RouteCheck(startLocation, stopLocation, time, isDeparture, seatNumber=1, wheelchairNumber=0, routeId=None, alternatives_mode: str=None):
     """ Check, but don't book, a potential route request and return its possibility. """
@@ -196,6 +208,7 @@ def RouteStarted(routeId):
     
     route.start()
     route.save()
+    FleetState.bump(route.community)
     Requests.Orders.route_started(route_id=routeId)
 
     return Response(data={'message': f'route {routeId} has been started'}, status=202)
@@ -208,6 +221,7 @@ def RouteFinished(routeId):
     
     route.finish()
     route.save()
+    FleetState.bump(route.community)
     Requests.Orders.route_finished(route_id=routeId)
 
     return Response(data={'message': f'route {routeId} has been finished'}, status=202)
@@ -0,0 +1,71 @@
+"""
+ Copyright  2025 IAV GmbH Ingenieurgesellschaft Auto und Verkehr, All Rights Reserved.
+ 
+ Licensed under the Apache License, Version 2.0 (the "License");
+ you may not use this file except in compliance with the License.
+ You may obtain a copy of the License at
+ 
+ http://www.apache.org/licenses/LICENSE-2.0
+ 
+ Unless required by applicable law or agreed to in writing, software
+ distributed under the License is distributed on an "AS IS" BASIS,
+ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ See the License for the specific language governing permissions and
+ limitations under the License.
+ 
+ SPDX-License-Identifier: Apache-2.0
+"""
+# Generated by Django 4.2.10 on 2026-10-19 15:10
+
+from collections import defaultdict
+
+from django.db import migrations, models
+
+
+def compute_node_loads(apps, schema_editor):
+    """ Cumulative loads of the existing nodes, see Route.update_loads. """
+    Node = apps.get_model('Mobis', 'Node')
+    Order = apps.get_model('Mobis', 'Order')
+
+    changes = defaultdict(lambda: [0, 0])
+    for hopOnNode_id, hopOffNode_id, load, loadWheelchair in Order.objects.values_list('hopOnNode_id', 'hopOffNode_id', 'load', 'loadWheelchair'):
+        if hopOnNode_id is not None:
+            changes[hopOnNode_id][0] += load
+            changes[hopOnNode_id][1] += loadWheelchair
+        if hopOffNode_id is not None:
+            changes[hopOffNode_id][0] -= load
+            changes[hopOffNode_id][1] -= loadWheelchair
+
+    route_loads = {}
+    nodes = []
+    for node in Node.objects.order_by('route_id', 'tMin'):
+        loadSeats, loadWheelchairs = route_loads.get(node.route_id, (0, 0))
+        loadSeats += changes[node.id][0]
+        loadWheelchairs += changes[node.id][1]
+        route_loads[node.route_id] = (loadSeats, loadWheelchairs)
+        node.loadSeats = loadSeats
+        node.loadWheelchairs = loadWheelchairs
+        nodes.append(node)
+
+    Node.objects.bulk_update(nodes, ['loadSeats', 'loadWheelchairs'], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('Mobis', '0018_route_node_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='node',
+            name='loadSeats',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='node',
+            name='loadWheelchairs',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.RunPython(compute_node_loads, migrations.RunPython.noop),
+    ]
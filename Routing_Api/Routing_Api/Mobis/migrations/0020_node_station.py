@@ -0,0 +1,71 @@
+"""
+ Copyright  2025 IAV GmbH Ingenieurgesellschaft Auto und Verkehr, All Rights Reserved.
+ 
+ Licensed under the Apache License, Version 2.0 (the "License");
+ you may not use this file except in compliance with the License.
+ You may obtain a copy of the License at
+ 
+ http://www.apache.org/licenses/LICENSE-2.0
+ 
+ Unless required by applicable law or agreed to in writing, software
+ distributed under the License is distributed on an "AS IS" BASIS,
+ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ See the License for the specific language governing permissions and
+ limitations under the License.
+ 
+ SPDX-License-Identifier: Apache-2.0
+"""
+# Generated by Django 4.2.10 on 2026-10-19 16:20
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+def lat_lon_key(latitude, longitude):
+    if latitude is None or longitude is None:
+        return None
+    return (round(latitude, 6), round(longitude, 6))
+
+
+def link_node_stations(apps, schema_editor):
+    """ Station of the existing nodes, see RoutesDummy.create_or_update_route. """
+    Node = apps.get_model('Mobis', 'Node')
+    Station = apps.get_model('Mobis', 'Station')
+
+    stations_by_map_id, stations_by_lat_lon = {}, {}
+    for station_id, mapId, latitude, longitude in Station.objects.order_by('uid').values_list('id', 'mapId', 'latitude', 'longitude'):
+        if mapId is not None:
+            stations_by_map_id.setdefault(mapId, station_id)
+        stations_by_lat_lon.setdefault(lat_lon_key(latitude, longitude), station_id)
+
+    nodes = []
+    for node in Node.objects.only('id', 'mapId', 'latitude', 'longitude'):
+        node.station_id = stations_by_lat_lon.get(lat_lon_key(node.latitude, node.longitude), stations_by_map_id.get(node.mapId))
+        if node.station_id is not None:
+            nodes.append(node)
+
+    Node.objects.bulk_update(nodes, ['station'], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('Mobis', '0019_node_loads'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='node',
+            name='station',
+            field=models.ForeignKey(default=None, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='nodes', to='Mobis.station'),
+        ),
+        migrations.RemoveIndex(
+            model_name='node',
+            name='node_mapid_idx',
+        ),
+        migrations.RemoveIndex(
+            model_name='node',
+            name='node_lat_lon_idx',
+        ),
+        migrations.RunPython(link_node_stations, migrations.RunPython.noop),
+    ]
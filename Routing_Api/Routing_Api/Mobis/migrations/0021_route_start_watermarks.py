@@ -0,0 +1,72 @@
+"""
+ Copyright  2025 IAV GmbH Ingenieurgesellschaft Auto und Verkehr, All Rights Reserved.
+ 
+ Licensed under the Apache License, Version 2.0 (the "License");
+ you may not use this file except in compliance with the License.
+ You may obtain a copy of the License at
+ 
+ http://www.apache.org/licenses/LICENSE-2.0
+ 
+ Unless required by applicable law or agreed to in writing, software
+ distributed under the License is distributed on an "AS IS" BASIS,
+ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ See the License for the specific language governing permissions and
+ limitations under the License.
+ 
+ SPDX-License-Identifier: Apache-2.0
+"""
+# Generated by Django 4.2.10 on 2026-10-19 17:05
+
+import django.utils.timezone
+from django.db import migrations, models
+from django.db.models import Min
+
+
+def compute_route_start_times(apps, schema_editor):
+    """ Time of the first node of the existing routes, see Route.update_loads. """
+    Route = apps.get_model('Mobis', 'Route')
+
+    routes = []
+    for route in Route.objects.annotate(time_first=Min('nodes__tMin')).exclude(time_first=None):
+        route.timeStart = route.time_first
+        routes.append(route)
+
+    Route.objects.bulk_update(routes, ['timeStart'], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('Mobis', '0020_node_station'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='route',
+            name='timeStart',
+            field=models.DateTimeField(default=None, null=True),
+        ),
+        migrations.AddField(
+            model_name='route',
+            name='modified',
+            field=models.DateTimeField(auto_now=True, default=django.utils.timezone.now),
+            preserve_default=False,
+        ),
+        migrations.AddIndex(
+            model_name='route',
+            index=models.Index(fields=['status', 'timeStart'], name='route_status_start_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='route',
+            index=models.Index(fields=['modified'], name='route_modified_idx'),
+        ),
+        migrations.CreateModel(
+            name='TaskWatermark',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=64, unique=True)),
+                ('time', models.DateTimeField()),
+            ],
+        ),
+        migrations.RunPython(compute_route_start_times, migrations.RunPython.noop),
+    ]
@@ -15,13 +15,14 @@
  
  SPDX-License-Identifier: Apache-2.0
 """
-from datetime import datetime
-from dateutil.parser import parse
+from collections import defaultdict
+from datetime import datetime, timezone
 from typing import List
 
 from django.db import models
 from django.db.models.expressions import RawSQL
 
+from routing.polyline import SEPARATOR, decode_polyline
 from routing.routingClasses import MobyLoad, VehicleCapacity
 
 class LocationManager(models.Manager):
@@ -61,6 +62,49 @@ class Station(models.Model):
     def __str__(self):
         return f'<Station({self.name}/{self.mapId}, {self.community}, ({self.latitude}, {self.longitude}))>'
 
+class MapNodeCache(models.Model):
+    """ Nearest map node of rounded coordinates, saves repeated nearest requests to OSRM. """
+    key = models.CharField(max_length=64, unique=True)
+    mapId = models.CharField(max_length=256, null=False)
+    def __str__(self):
+        return f'<MapNodeCache({self.key}: {self.mapId})>'
+
+class FleetState(models.Model):
+    """ Version of the routing relevant data (routes, busses, stops) of a community, increased on every change. """
+    community = models.PositiveIntegerField(unique=True)
+    version = models.PositiveIntegerField(default=0)
+
+    @classmethod
+    def current(cls, community) -> int:
+        version = cls.objects.filter(community=community).values_list('version', flat=True).first()
+        return version if version is not None else 0
+
+    @classmethod
+    def bump(cls, community):
+        if community is None:
+            return
+        if cls.objects.filter(community=community).update(version=models.F('version')+1) == 0:
+            cls.objects.get_or_create(community=community, defaults={'version': 1})
+
+    def __str__(self):
+        return f'<FleetState({self.community}: {self.version})>'
+
+class TaskWatermark(models.Model):
+    """ Time up to which a maintenance task has processed the routes, see tasks.py. """
+    name = models.CharField(max_length=64, unique=True)
+    time = models.DateTimeField()
+
+    @classmethod
+    def current(cls, name):
+        return cls.objects.filter(name=name).values_list('time', flat=True).first()
+
+    @classmethod
+    def advance(cls, name, time):
+        cls.objects.update_or_create(name=name, defaults={'time': time})
+
+    def __str__(self):
+        return f'<TaskWatermark({self.name}: {self.time})>'
+
 class Bus(models.Model):
     uid  = models.PositiveIntegerField(unique=True)
     name = models.CharField(max_length=256, null=True)
@@ -98,49 +142,18 @@ class RouteManager(models.Manager):
     def empty(self):
         return self.get_queryset().filter(nodes__isnull=True)
 
-    def to_be_deleted_oldest(self, num_routes_remaininig) -> dict:
-        # extract the oldest delete candidates
-        delete_candidates_all = self.to_be_deleted().order_by('id')
-
-        id_date: dict[int, datetime] = {}
-        id_route: dict = {}
-        routes_to_delete_final: dict = {}
-
-        if delete_candidates_all.count() > num_routes_remaininig:
-            # find out oldest routes and reduce list  
-            # ordered by tMin of first node
-            # if nodes are empty: use default date      
+    def to_be_deleted_oldest(self, num_routes_remaininig) -> List[int]:
+        # extract the oldest delete candidates, ordered by the time of the first node (index route_status_start_idx)
+        # routes without nodes are the oldest
+        delete_candidates_all = self.to_be_deleted()
 
-            time_none: datetime = parse('1950-01-01T06:00.000+00:00')
-            for route in delete_candidates_all:
-                id_route[route.id] = route
+        num_routes_to_delete = delete_candidates_all.count() - num_routes_remaininig
+        if num_routes_to_delete <= 0:
+            return []
 
-                if route.nodes.count():
-                    #print(route.nodes.first().tMin)
-                    id_date[route.id] = route.nodes.first().tMin
-                else:
-                    id_date[route.id] = time_none
-
-
-            # print(id_date) 
-            # print(len(id_date))
-            
-            # sort ids by date            
-            id_date_sorted = sorted(id_date, key=id_date.get)
-
-            # extract delete candidates and save in final data
-            for key in id_date_sorted:
-                routes_to_delete_final[key] = id_route[key]
-
-                if len(routes_to_delete_final) + num_routes_remaininig == len(id_date):
-                    # break if number of remaining routes is reached
-                    break
-
-            # print(routes_to_delete_final)
-            # print(len(routes_to_delete_final))           
-
-        # return a dictionary of (id, route) with the routes to be deleted
-        return routes_to_delete_final
+        # return the ids of the routes to be deleted, oldest first
+        return list(delete_candidates_all.order_by(models.F('timeStart').asc(nulls_first=True), 'id')
+                    .values_list('id', flat=True)[:num_routes_to_delete])
 
 class Route(models.Model):
 
@@ -155,9 +168,19 @@ class Route(models.Model):
     bus = models.ForeignKey(Bus, related_name='routes', on_delete=models.PROTECT, null=False)
     status = models.CharField(max_length=3, choices=STATUSES, default=DRAFT)
     community = models.PositiveIntegerField(null=True)
+    # paths between the stop nodes (only stops are Node rows), one encoded polyline per leg, see legs
+    geometry = models.TextField(null=True, blank=True, default=None)
+    # time of the first node and time of the last change, maintained by update_loads for the maintenance tasks
+    timeStart = models.DateTimeField(null=True, default=None)
+    modified = models.DateTimeField(auto_now=True)
 
     objects = RouteManager()
 
+    class Meta:
+        indexes = [models.Index(fields=['community', 'status'], name='route_community_status_idx'),
+                   models.Index(fields=['status', 'timeStart'], name='route_status_start_idx'),
+                   models.Index(fields=['modified'], name='route_modified_idx')]
+
     @property
     def busId(self):
         return self.bus.uid
@@ -182,13 +205,41 @@ class Route(models.Model):
     
     @property
     def loads(self) -> List[MobyLoad]:
-        load = MobyLoad(0,0)
-        cummulative_load: List[MobyLoad] = []
-
-        for node in self.nodes.prefetch_related('hopOns', 'hopOffs'):
-            load += node.loadAll_change
-            cummulative_load.append(load)
-        return cummulative_load
+        # cumulative loads are materialized in the nodes, see update_loads
+        return [node.loadAll for node in self.nodes.all()]
+
+    def update_loads(self):
+        """ Recomputes the cumulative loads of the nodes and the start time of the route, needed whenever orders or nodes of the route change. """
+        changes = defaultdict(lambda: [0, 0])
+        orders = Order.objects.filter(models.Q(hopOnNode__route_id=self.id) | models.Q(hopOffNode__route_id=self.id))
+        for hopOnNode_id, hopOffNode_id, load, loadWheelchair in orders.values_list('hopOnNode_id', 'hopOffNode_id', 'load', 'loadWheelchair'):
+            if hopOnNode_id is not None:
+                changes[hopOnNode_id][0] += load
+                changes[hopOnNode_id][1] += loadWheelchair
+            if hopOffNode_id is not None:
+                changes[hopOffNode_id][0] -= load
+                changes[hopOffNode_id][1] -= loadWheelchair
+
+        loadSeats = 0
+        loadWheelchairs = 0
+        nodes_changed = []
+        time_start = None
+        for node in Node.objects.filter(route_id=self.id):
+            if time_start is None:
+                time_start = node.tMin
+            loadSeats += changes[node.id][0]
+            loadWheelchairs += changes[node.id][1]
+            if node.loadSeats != loadSeats or node.loadWheelchairs != loadWheelchairs:
+                node.loadSeats = loadSeats
+                node.loadWheelchairs = loadWheelchairs
+                nodes_changed.append(node)
+
+        if nodes_changed:
+            Node.objects.bulk_update(nodes_changed, ['loadSeats', 'loadWheelchairs'])
+
+        self.timeStart = time_start
+        self.modified = datetime.now(timezone.utc)
+        Route.objects.filter(pk=self.pk).update(timeStart=self.timeStart, modified=self.modified)
     
     @property
     def needed_capacity(self):
@@ -202,6 +253,17 @@ class Route(models.Model):
         return max_load
     
 
+    def legs(self):
+        """ Paths between consecutive stop nodes, each a list of (mapId, tMin, tMax) of the passed map nodes. """
+        if not self.geometry:
+            return []
+
+        legs = []
+        for leg in self.geometry.split(SEPARATOR):
+            legs.append([(str(mapId), datetime.fromtimestamp(tMin, tz=timezone.utc), datetime.fromtimestamp(tMin+dt, tz=timezone.utc))
+                         for (mapId, tMin, dt) in decode_polyline(leg, 3)])
+        return legs
+
     @property
     def draft(self):
         return self.status == self.DRAFT
@@ -238,11 +300,19 @@ class Node(models.Model):
     latitude = models.FloatField(null=True)
     longitude = models.FloatField(null=True)
     route = models.ForeignKey(Route, related_name='nodes', null=True, on_delete=models.CASCADE)
+    # station of the stop, linked when the route is committed (see RoutesDummy.create_or_update_route)
+    station = models.ForeignKey(Station, related_name='nodes', null=True, default=None, on_delete=models.SET_NULL)
+    # cumulative load of the route after this node, i.e. including its hop ons and offs (see Route.update_loads)
+    loadSeats = models.IntegerField(null=False, default=0)
+    loadWheelchairs = models.IntegerField(null=False, default=0)
 
     class Meta:
         ordering = ['tMin']
 
     def equalsStation(self, station)->bool:
+        if self.station_id is not None and getattr(station, 'id', None) is not None:
+            return self.station_id == station.id
+
         if self.mapId == station.mapId:
             return True
         
@@ -259,6 +329,10 @@ class Node(models.Model):
 
         return f'<Node(id={self.id},mapId={mapID}, tMin/tMax({self.tMin}-{self.tMax}), hopOns/hopOffs({self.hopOns}, {self.hopOffs}), route_id({self.route.id}), lat/lon({self.latitude},{self.longitude}))>'
     
+    @property
+    def loadAll(self):
+        return MobyLoad(self.loadSeats, self.loadWheelchairs)
+
     @property
     def loadSeats_hopOns(self):
         return sum(o.load for o in self.hopOns.all())
@@ -39,7 +39,7 @@ class NodeSerializer(serializers.ModelSerializer):
         fields=('pk', 'mapId', 'tMin', 'tMax', 'hopOns', 'hopOffs', 'latitude', 'longitude')
 
 class RouteSerializer(serializers.ModelSerializer):
-    nodes = NodeSerializer(many=True)
+    nodes = serializers.SerializerMethodField()
     routeId = serializers.IntegerField(source='pk')
     status = serializers.ChoiceField(Route.STATUSES, source='get_status_display')
     #busId = serializers.PrimaryKeyRelatedField(many=True, read_only=True, pk_field='uid')
@@ -48,6 +48,24 @@ class RouteSerializer(serializers.ModelSerializer):
         model=Route
         fields=('routeId', 'busId', 'status', 'nodes')
 
+    def get_nodes(self, route):
+        """
+        Stop nodes and the map nodes of the paths in between in order of time. Only stops are saved as nodes,
+        the path nodes are decoded from the geometry of the route (see Route.legs) and have no pk, orders or coordinates.
+        """
+        stops = list(route.nodes.all())
+        nodes = [(node.tMin, data) for node, data in zip(stops, NodeSerializer(stops, many=True).data)]
+
+        times = serializers.DateTimeField()
+        for leg in route.legs():
+            for (mapId, tMin, tMax) in leg:
+                nodes.append((tMin, {'pk': None, 'mapId': mapId, 'tMin': times.to_representation(tMin), 'tMax': times.to_representation(tMax),
+                                     'hopOns': [], 'hopOffs': [], 'latitude': None, 'longitude': None}))
+
+        # stable sort: a stop stays ahead of a path node of the same time
+        nodes.sort(key=lambda entry: entry[0])
+        return [data for (_, data) in nodes]
+
 """
 utility classes for external information
 """
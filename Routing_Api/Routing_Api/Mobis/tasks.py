@@ -15,19 +15,24 @@
  
  SPDX-License-Identifier: Apache-2.0
 """
+import gzip
 import logging
+import os
+import time
+from contextlib import contextmanager
 from datetime import datetime, timedelta
 
 #from Routing_Api.celery import app
 from celery import shared_task
+from django.conf import settings
 from dateutil.relativedelta import relativedelta
 from dateutil.tz import tzutc
-from django.db.models import Q
+from django.db.models import Exists, Min, OuterRef, Q
 from django.db import transaction
 
 from routing.routingClasses import MobyLoad
 
-from .models import Node, Route, Order, Station
+from .models import Node, Route, Order, Station, FleetState, TaskWatermark
 from .signals import RabbitMqSender as Publisher
 from .serializers import RouteSerializer
 import json
@@ -36,6 +41,51 @@ LOGGER = logging.getLogger('Mobis.tasks')
 UTC = tzutc()
 sender = Publisher(threaded=False)
 
+# deleted routes are archived and deleted in batches of this size
+ARCHIVE_BATCH_SIZE = 500
+
+# changes are stamped by the api processes (Route.modified) before their transaction commits,
+# watermarks overlap by this margin to tolerate clock differences and booking transactions
+WATERMARK_OVERLAP = timedelta(minutes=settings.ROUTING_TASK_WATERMARK_OVERLAP_MINUTES)
+# changes that become visible later than the overlap are caught by a full scan in this interval
+WATERMARK_FULL_SCAN = timedelta(minutes=settings.ROUTING_TASK_FULL_SCAN_MINUTES)
+
+@contextmanager
+def task_report(name):
+    """ Counts the rows a maintenance task touched (report['rows']) and logs them with the run time when the task is done. """
+    report = {'task': name, 'rows': 0, 'duration_ms': 0.0}
+    time_start = time.perf_counter()
+    try:
+        yield report
+    finally:
+        report['duration_ms'] = round((time.perf_counter()-time_start)*1000.0, 1)
+        LOGGER.info(f'{name} finished, {report["rows"]} rows touched in {report["duration_ms"]} ms')
+
+def full_scan_due(name, run_start) -> bool:
+    """ True on the first run of the task and if its last full scan is older than WATERMARK_FULL_SCAN. """
+    last_full_scan = TaskWatermark.current(f'{name}_full_scan')
+    return TaskWatermark.current(name) is None or last_full_scan is None or last_full_scan <= run_start - WATERMARK_FULL_SCAN
+
+def changed_since(routes, name, full_scan):
+    """ Routes modified since the last run of the task, all routes for a full scan. """
+    if full_scan:
+        return routes
+    return routes.filter(modified__gt=TaskWatermark.current(name) - WATERMARK_OVERLAP)
+
+def advance_watermark(name, run_start, full_scan):
+    TaskWatermark.advance(name, run_start)
+    if full_scan:
+        TaskWatermark.advance(f'{name}_full_scan', run_start)
+
+def tables_exist(name) -> bool:
+    try:
+        Route.objects.exists()
+        return True
+    except Exception as e:
+        LOGGER.error(f'{name}: database model not existing')
+        LOGGER.error(e)
+        return False
+
 @shared_task
 def split_routes(delta_time_min_for_split=30):
     '''Split booked routes where the bus could be exchanged.'''
@@ -46,79 +96,99 @@ def split_routes(delta_time_min_for_split=30):
     # gibt es mehr als einen Bus verfuegbar im Zeitraum?
     # ist es ueberhaupt sinnvoll zu splitten oder kann der Bus viel effizienter alles auf einer Route abfahren?
     
-    numRoutes = 0
-
-    try:
-        numRoutes = Route.objects.count()        
-    except Exception as e:
-        LOGGER.error(f'split_routes: database model not existing')    
-        LOGGER.error(e)
-
-    if numRoutes > 0:
-        with transaction.atomic():
-            routes = Route.objects.prefetch_related('nodes').filter(status=Route.BOOKED)
-            for route in routes:  
-                # splitting should not be done if time is too close
-                time_min_node_old = None
-
-                loads: List[MobyLoad] = route.loads
-                # find node where the bus is empty
-                # this should happen whenever the number of hopOffs equals the previous load
-                current_route = route
-                route_id = route.pk  # use the primary key, because the object reference itself changes further down
-                first = True  # it's possible to detect a valid change for the very first node - this isn't wanted, so set a flag
-                previous_load = MobyLoad(0,0)  # assume the bus is empty before arriving at the first stop
-                for load, node in zip(loads, route.nodes.all()):
-                    if first == True:
-                        time_min_node_old = node.tMin + timedelta(minutes=100000)
-
-                    if route_id != current_route.pk:  # update orders only if the route has changed
-                        for order in node.hopOffs.all():
-                            # we iterate over hopOffs only, because the route for hopOns might still change
-                            hopOnNode = order.hopOnNode
-                            try:
-                                sender.RouteChangedIntegrationEvent(
-                                    orderId=order.uid, oldRouteId=route_id, newRouteId=node.route.pk,
-                                    startTimeMinimum=hopOnNode.tMin, startTimeMaximum=hopOnNode.tMax,
-                                    destinationTimeMinimum=node.tMin, destinationTimeMaximum=node.tMax, busId=route.busId)
-                            except Exception as err:
-                                LOGGER.error('split_routes: failed to send RouteChangedEvent for oldRouteId {route_id} with: %s', err, exc_info=True)
-                                raise err
-                        node.route = current_route
-                        node.save()
-
-                    # splitting if hop_offs are equivalent to previous load, i.e. bus is empty after hop_off
-                    hopOffsTmp = node.loadAll_hopOffs
-                    if previous_load.equals(hopOffsTmp) and not first:
-                        time_min_for_splitting = time_min_node_old + timedelta(minutes=delta_time_min_for_split)
-                        # splitting is allowed if any moby enters the empty bus and the time step is large enough
-                        #print(f'split_routes: splitting candidate, time is {node.tMin}, time min for split is {time_min_for_splitting}')
-                        if not node.loadAll_hopOns.isEmpty() and node.tMin >= time_min_for_splitting:
-                            # it's empty at this stop, we could exchange the bus now
-                            # create a new route
-                            current_route.pk = None  # yes, this is how django objects are duplicated with new id
-                            current_route.save()
-                            
-                            # if there are any hopOns, we need to copy the current node as well
-                            hopOns = node.hopOns.all()
-                            if hopOns:
-                                if hopOffsTmp.isEmpty():
-                                    # do not copy node
-                                    node.route = current_route
-                                    node.save()
-                                else:
-                                    node.pk = None
-                                    node.route = current_route
-                                    node.save()
-                                    hopOns.update(hopOnNode=node)
-
-                            LOGGER.info(f'split_routes: new route created {current_route} with id {current_route.pk}')
+    with task_report('split_routes') as report:
+        if tables_exist('split_routes'):
+            run_start = datetime.now(UTC)
+            full_scan = full_scan_due('split_routes', run_start)
+            with transaction.atomic():
+                # unchanged routes have been checked by a previous run already
+                report['rows'] = split_booked_routes(changed_since(Route.objects.filter(status=Route.BOOKED), 'split_routes', full_scan), delta_time_min_for_split)
+                advance_watermark('split_routes', run_start, full_scan)
+    return report
+
+def split_booked_routes(routes, delta_time_min_for_split) -> int:
+    """ Splits the given booked routes, the moved nodes are written with one update per new route, returns the number of changed rows. """
+    rows = 0
+
+    # cumulative loads are materialized, the hop ons and offs are needed for the loads of single nodes only
+    routes = routes.select_related('bus').prefetch_related('nodes', 'nodes__hopOns', 'nodes__hopOffs', 'nodes__hopOffs__hopOnNode')
+    for route in routes:  
+        # splitting should not be done if time is too close
+        time_min_node_old = None
+
+        loads: List[MobyLoad] = route.loads
+        # find node where the bus is empty
+        # this should happen whenever the number of hopOffs equals the previous load
+        current_route = route
+        route_id = route.pk  # use the primary key, because the object reference itself changes further down
+        route_ids_split = [route_id]
+        node_moves = {}  # node id -> new route, written after the loop
+        first = True  # it's possible to detect a valid change for the very first node - this isn't wanted, so set a flag
+        previous_load = MobyLoad(0,0)  # assume the bus is empty before arriving at the first stop
+        for load, node in zip(loads, route.nodes.all()):
+            if first == True:
+                time_min_node_old = node.tMin + timedelta(minutes=100000)
+
+            if route_id != current_route.pk:  # update orders only if the route has changed
+                node.route = current_route
+                node_moves[node.pk] = current_route
+                for order in node.hopOffs.all():
+                    # we iterate over hopOffs only, because the route for hopOns might still change
+                    hopOnNode = order.hopOnNode
+                    try:
+                        sender.RouteChangedIntegrationEvent(
+                            orderId=order.uid, oldRouteId=route_id, newRouteId=node.route.pk,
+                            startTimeMinimum=hopOnNode.tMin, startTimeMaximum=hopOnNode.tMax,
+                            destinationTimeMinimum=node.tMin, destinationTimeMaximum=node.tMax, busId=route.busId)
+                    except Exception as err:
+                        LOGGER.error('split_routes: failed to send RouteChangedEvent for oldRouteId {route_id} with: %s', err, exc_info=True)
+                        raise err
+
+            # splitting if hop_offs are equivalent to previous load, i.e. bus is empty after hop_off
+            hopOffsTmp = node.loadAll_hopOffs
+            if previous_load.equals(hopOffsTmp) and not first:
+                time_min_for_splitting = time_min_node_old + timedelta(minutes=delta_time_min_for_split)
+                # splitting is allowed if any moby enters the empty bus and the time step is large enough
+                #print(f'split_routes: splitting candidate, time is {node.tMin}, time min for split is {time_min_for_splitting}')
+                if not node.loadAll_hopOns.isEmpty() and node.tMin >= time_min_for_splitting:
+                    # it's empty at this stop, we could exchange the bus now
+                    # create a new route
+                    current_route.pk = None  # yes, this is how django objects are duplicated with new id
+                    current_route.save()
+                    rows += 1
                     
-                    previous_load = load
-                    first = False
-                    time_min_node_old = node.tMin
-
-    LOGGER.info(f'split_routes finished')
+                    # if there are any hopOns, we need to copy the current node as well
+                    hopOns = node.hopOns.all()
+                    if hopOns:
+                        if hopOffsTmp.isEmpty():
+                            # do not copy node
+                            node.route = current_route
+                            node_moves[node.pk] = current_route
+                        else:
+                            node.pk = None
+                            node.route = current_route
+                            node.save()
+                            rows += 1 + Order.objects.filter(pk__in=[order.pk for order in hopOns]).update(hopOnNode=node)
+
+                    LOGGER.info(f'split_routes: new route created {current_route} with id {current_route.pk}')
+                    FleetState.bump(current_route.community)
+                    route_ids_split.append(current_route.pk)
+            
+            previous_load = load
+            first = False
+            time_min_node_old = node.tMin
+
+        # nodes have moved to the new routes
+        if len(route_ids_split) > 1:
+            moves_by_route = {}
+            for node_id, new_route in node_moves.items():
+                moves_by_route.setdefault(new_route.pk, []).append(node_id)
+            for new_route_id, node_ids in moves_by_route.items():
+                rows += Node.objects.filter(pk__in=node_ids).update(route_id=new_route_id)
+            for route_split in Route.objects.filter(pk__in=route_ids_split):
+                route_split.update_loads()
+
+    return rows
 
 @shared_task
 def freeze_routes(social_time_min=15):
@@ -127,60 +197,69 @@ def freeze_routes(social_time_min=15):
         social_time_min = 0
 
     LOGGER.info(f'freeze_routes with time delta {social_time_min}...')
-    numRoutes = 0    
 
-    try:
-        numRoutes = Route.objects.count()       
-    except Exception as e:
-        LOGGER.error(f'freeze_routes: database model not existing')
-
-    if numRoutes > 0:
-        now = datetime.now(UTC)
-        routes = Route.objects.prefetch_related('nodes').filter(status=Route.BOOKED).distinct()
-        for route in routes:
-            if route.nodes.count() == 0:
-                continue
-
-            time_start = route.nodes.first().tMin
-            if time_start <= now + relativedelta(minutes=social_time_min):
-                # remove nodes without hopOn or hopOff
-                for node in route.nodes.all():
-                    if not node.has_order:
-                        node.delete()
-                # freeze routes with nodes containing orders only
-                route.status = Route.FROZEN
-                route.save()
-                LOGGER.info(f'froze {route}')   
-
-                # publish event
+    with task_report('freeze_routes') as report:
+        if tables_exist('freeze_routes'):
+            run_start = datetime.now(UTC)
+            horizon = run_start + relativedelta(minutes=social_time_min)
+            # routes without nodes have no start time and are not frozen
+            # the stored start time is a pre-filter (index route_status_start_idx), the first node decides
+            routes = Route.objects.filter(status=Route.BOOKED, timeStart__lte=horizon)
+
+            # routes up to the last horizon have been frozen already unless they changed since
+            full_scan = full_scan_due('freeze_routes', run_start)
+            last_horizon = TaskWatermark.current('freeze_routes_horizon')
+            if not full_scan and last_horizon is not None:
+                routes = routes.filter(Q(timeStart__gt=last_horizon - WATERMARK_OVERLAP) | Q(modified__gt=TaskWatermark.current('freeze_routes') - WATERMARK_OVERLAP))
+
+            routes = routes.annotate(time_first=Min('nodes__tMin')).filter(time_first__lte=horizon)
+            routes = list(routes.values_list('id', 'community', 'time_first'))
+            route_ids = [route_id for (route_id, _, _) in routes]
+
+            with transaction.atomic():
+                if route_ids:
+                    # remove nodes without hopOn or hopOff, freeze routes with nodes containing orders only
+                    empty_nodes = Node.objects.filter(route_id__in=route_ids, hopOns__isnull=True, hopOffs__isnull=True)
+                    # loads and start times of the routes change with their nodes
+                    route_ids_changed = set(empty_nodes.values_list('route_id', flat=True))
+                    nodes_deleted, _ = empty_nodes.delete()
+                    for route in Route.objects.filter(id__in=route_ids_changed):
+                        route.update_loads()
+                    routes_frozen = Route.objects.filter(id__in=route_ids).update(status=Route.FROZEN)
+                    for community in set(community for (_, community, _) in routes):
+                        FleetState.bump(community)
+                    report['rows'] = nodes_deleted + routes_frozen
+                advance_watermark('freeze_routes', run_start, full_scan)
+                TaskWatermark.advance('freeze_routes_horizon', horizon)
+
+            # publish events
+            for route_id, _, time_start in routes:
+                LOGGER.info(f'froze route {route_id}')
                 try:
-                    sender.RouteFrozenIntegrationEvent(routeId=route.id, startTimeMinimum=time_start)
+                    sender.RouteFrozenIntegrationEvent(routeId=route_id, startTimeMinimum=time_start)
                 except Exception as err:
-                    LOGGER.error('freeze_routes: failed to send RouteFrozenIntegrationEvent for route_id {route.id} with: %s', err, exc_info=True)
+                    LOGGER.error('freeze_routes: failed to send RouteFrozenIntegrationEvent for route_id {route_id} with: %s', err, exc_info=True)
                     raise err 
 
-    LOGGER.info(f'freeze_routes finished')
+    return report
 
 @shared_task
 def delete_empty_routes():
-    # this could be used if we didn't intermediate nodes - tbd
-    # empty_routes = Route.objects.empty()
-    # LOGGER.info(f'delete empty routes: {empty_routes}')
-    # empty_routes.delete()    
-    
-    numRoutes = 0
-
-    try:
-        numRoutes = Route.objects.count()       
-    except Exception:
-        LOGGER.error(f'delete_empty_routes: database model not existing')
-
-    if numRoutes > 0:
-        routes = Route.objects.prefetch_related('nodes','nodes__hopOns', 'nodes__hopOffs').all()
-        for route in routes:
-            if len(route.clients()) == 0:
-                LOGGER.info(f'delete empty route: {route}')
-                route.delete()    
+    with task_report('delete_empty_routes') as report:
+        if tables_exist('delete_empty_routes'):
+            run_start = datetime.now(UTC)
+            full_scan = full_scan_due('delete_empty_routes', run_start)
+            # routes none of whose nodes is a hop on or hop off node of an order, orders only leave routes that are modified
+            has_orders = Order.objects.filter(Q(hopOnNode__route_id=OuterRef('pk')) | Q(hopOffNode__route_id=OuterRef('pk')))
+            empty_routes = list(changed_since(Route.objects.filter(~Exists(has_orders)), 'delete_empty_routes', full_scan).values_list('id', 'community'))
+            with transaction.atomic():
+                if empty_routes:
+                    LOGGER.info(f'delete empty routes: {[route_id for (route_id, _) in empty_routes]}')
+                    report['rows'], _ = Route.objects.filter(id__in=[route_id for (route_id, _) in empty_routes]).delete()
+                    for community in set(community for (_, community) in empty_routes):
+                        FleetState.bump(community)
+                advance_watermark('delete_empty_routes', run_start, full_scan)
+    return report
 
 @shared_task
 def delete_unused_nodes():
@@ -199,7 +278,12 @@ def delete_unused_nodes():
         is_station = Q(mapId__in=station_mapIds)
         is_empty = Q(hopOns__isnull=True, hopOffs__isnull=True)
         empty_non_stations = is_empty & ~is_station
-        Node.objects.filter(empty_non_stations).delete()
+        with transaction.atomic():
+            # loads and start times of the routes change with their nodes
+            route_ids = set(Node.objects.filter(empty_non_stations).exclude(route_id=None).values_list('route_id', flat=True))
+            Node.objects.filter(empty_non_stations).delete()
+            for route in Route.objects.filter(id__in=route_ids):
+                route.update_loads()
     
 
     LOGGER.info(f'delete_unused_nodes finished')
@@ -208,45 +292,39 @@ def delete_unused_nodes():
 def delete_routes():
     LOGGER.info(f'delete_routes...')
 
-    numRoutes = 0
     numRoutesRemaining = 100 # do not remove all routes immediately
-    numRoutesDeleted = 0
 
-    try:
-        numRoutes = Route.objects.count()       
-    except Exception:
-        LOGGER.error(f'delete_routes: database model not existing')
-
-    if numRoutes > numRoutesRemaining:
-        delete_candidates = Route.objects.to_be_deleted_oldest(numRoutesRemaining)   
-              
-        for id in delete_candidates:
-            route = delete_candidates[id]
-            print(f'delete_routes: route {route.id} deleted')
-            LOGGER.info(f'delete_routes: route {route.id} deleted')
-            try:
-                dump(route)
-            except:
-                LOGGER.error(f'delete_routes: dump route failed')
-
-            route.delete() 
-            numRoutesDeleted += 1                      
-
-    LOGGER.info(f'delete_routes finished, {numRoutesDeleted} routes deleted')
-
-def dump(route):
-    rs = RouteSerializer()
+    with task_report('delete_routes') as report:
+        if tables_exist('delete_routes'):
+            delete_candidates = Route.objects.to_be_deleted_oldest(numRoutesRemaining)
 
-    # todo location to be dumped must be created
-    # todo maybe dumping to archive database?
-    jsontxt = json.dumps(rs.to_representation(route))
-    outpath = f'/log/deleted_routes/route_{route.id:010}'
+            for i in range(0, len(delete_candidates), ARCHIVE_BATCH_SIZE):
+                route_ids = delete_candidates[i:i+ARCHIVE_BATCH_SIZE]
+                # routes are only deleted once they are archived
+                try:
+                    dump(Route.objects.filter(id__in=route_ids).order_by('id'))
+                except Exception as err:
+                    LOGGER.error(f'delete_routes: archiving routes failed, {len(delete_candidates)-i} routes not deleted: {err}')
+                    break
+                rows, _ = Route.objects.filter(id__in=route_ids).delete()
+                report['rows'] += rows
+                # the batch is ordered by start time, its ids are no range
+                LOGGER.info(f'delete_routes: {len(route_ids)} routes with ids {min(route_ids)} to {max(route_ids)} deleted')
+    return report
+
+def dump(routes):
+    """ Appends the routes as JSON lines to the gzip archive of the day, every call adds one gzip member. """
+    rs = RouteSerializer()
+    routes = routes.select_related('bus').prefetch_related('nodes', 'nodes__hopOns', 'nodes__hopOffs')
+    lines = [json.dumps(rs.to_representation(route)) for route in routes]
 
-    print(jsontxt)
+    os.makedirs(settings.ROUTING_ARCHIVE_PATH, exist_ok=True)
+    outpath = os.path.join(settings.ROUTING_ARCHIVE_PATH, f'routes_{datetime.now(UTC):%Y%m%d}.jsonl.gz')
 
-    with open(outpath, 'w') as logfile:
-        logfile.write(jsontxt)
-        logfile.write("\n")
+    with gzip.open(outpath, 'at', encoding='utf-8') as archive:
+        for line in lines:
+            archive.write(line)
+            archive.write("\n")
 
 @shared_task
 def check_routing_data() -> bool:
@@ -254,29 +332,20 @@ def check_routing_data() -> bool:
 
     result: bool = True    
 
-    numOrders = 0
+    with task_report('check_routing_data') as report:
+        if tables_exist('check_routing_data'):
+            # hop on/off nodes and their routes of all orders with one query
+            orders = Order.objects.values_list('id', 'hopOnNode_id', 'hopOffNode_id', 'hopOnNode__route_id', 'hopOffNode__route_id')
+            for order_id, node_id_hop_on, node_id_hop_off, route_id_hop_on, route_id_hop_off in orders.iterator():
+                report['rows'] += 1
+
+                if node_id_hop_on is not None and node_id_hop_off is not None:
+                    if route_id_hop_on != route_id_hop_off:
+                        LOGGER.error(f'check_routing_data: problem in order {order_id}: hop on/off nodes have different routes')
+                        result = False
+                elif node_id_hop_on is not None or node_id_hop_off is not None:   
+                    # this is never allowed: one is null, the other is not null         
+                    LOGGER.error(f'check_routing_data: problem in order {order_id}: only one of the hop on/off nodes is null')
+                    result = False    
 
-    try:
-        numOrders = Order.objects.count()       
-    except Exception:
-        LOGGER.error(f'check_routing_data: database model not existing')
-
-    if numOrders > 0:
-        for order in Order.objects.all():
-            node_id_hop_on = order.hopOnNode_id
-            node_id_hop_off = order.hopOffNode_id
-
-            if node_id_hop_on is not None and node_id_hop_off is not None:
-                node_hop_on = Node.objects.get(id=node_id_hop_on)
-                node_hop_off = Node.objects.get(id=node_id_hop_off)
-
-                if node_hop_on.route_id != node_hop_off.route_id:
-                    LOGGER.error(f'check_routing_data: problem in order {order.id}: hop on/off nodes have different routes')
-                    result = False
-            elif node_id_hop_on is not None or node_id_hop_off is not None:   
-                # this is never allowed: one is null, the other is not null         
-                LOGGER.error(f'check_routing_data: problem in order {order.id}: only one of the hop on/off nodes is null')
-                result = False    
-
-    LOGGER.info(f'check_routing_data finished')
     return result
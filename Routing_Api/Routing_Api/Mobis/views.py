@@ -204,6 +204,9 @@ def RouteFinished(request, routeId):
 def HealthCheck(request):
     return HttpResponse('', status=200)
 
+def Metrics(request):
+    return JsonResponse(API.Metrics(), status=200)
+
 # error views:
 def handler500(request, *args, **argv):
     context = {
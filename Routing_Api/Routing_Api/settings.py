@@ -187,6 +187,13 @@ else:
     }
 
 ROUTING_TIMEOFFSET_MINMINUTESTOORDERFROMNOW = (int)(os.environ.get('ROUTING_FREEZE_TIME_DELTA', '15')) 
+ROUTING_OSRM_LATENCY_BUDGET_SECONDS = (float)(os.environ.get('ROUTING_OSRM_LATENCY_BUDGET_SECONDS', '20'))
+ROUTING_SOLVER_WORKERS = (int)(os.environ.get('ROUTING_SOLVER_WORKERS', '0'))
+ROUTING_SOLVER_TIMEOUT_SECONDS = (float)(os.environ.get('ROUTING_SOLVER_TIMEOUT_SECONDS', '30'))
+ROUTING_ORDER_BATCH_SECONDS = (float)(os.environ.get('ROUTING_ORDER_BATCH_SECONDS', '0'))
+ROUTING_ARCHIVE_PATH = os.environ.get('ROUTING_ARCHIVE_PATH', '/log/deleted_routes')
+ROUTING_TASK_WATERMARK_OVERLAP_MINUTES = (float)(os.environ.get('ROUTING_TASK_WATERMARK_OVERLAP_MINUTES', '10'))
+ROUTING_TASK_FULL_SCAN_MINUTES = (float)(os.environ.get('ROUTING_TASK_FULL_SCAN_MINUTES', '60'))
 
 # Other Celery settings
 CELERY_BEAT_SCHEDULE = {
@@ -326,6 +333,11 @@ LOGGING = {
             'level': 'DEBUG',
             'propagate': True,
         },
+        'routing.OSRM': {
+            'handlers': ['console', 'console_debug_false', 'log_file_routing'],
+            'level': 'INFO',
+            'propagate': True,
+        },
         'Mobis.tasks': {
             'handlers': ['console', 'console_debug_false', 'log_file_routing'],
             'level': 'INFO',
@@ -18,7 +18,7 @@
 from django.conf import settings
 from django.conf.urls import include
 from django.urls import path
-from Routing_Api.Mobis.views import UnverbindlicheAnfrage as UnverbindlicheAnfrage_view, RoutendetailsAnfrageMobi as RoutendetailsAnfrageMobi_view, RoutendetailsAnfrageBusfahrer as RoutendetailsAnfrageBusfahrer_view, RouteStarted as RouteStarted_view, RouteFinished as RouteFinished_view, RoutendetailsBusId as RoutendetailsBusId_view, HealthCheck as HealthCheck_view, VerbindlicheAnfrage as VerbindlicheAnfrage_view, reset
+from Routing_Api.Mobis.views import UnverbindlicheAnfrage as UnverbindlicheAnfrage_view, RoutendetailsAnfrageMobi as RoutendetailsAnfrageMobi_view, RoutendetailsAnfrageBusfahrer as RoutendetailsAnfrageBusfahrer_view, RouteStarted as RouteStarted_view, RouteFinished as RouteFinished_view, RoutendetailsBusId as RoutendetailsBusId_view, HealthCheck as HealthCheck_view, Metrics as Metrics_view, VerbindlicheAnfrage as VerbindlicheAnfrage_view, reset
 
 urlpatterns = [
     path('routes/', UnverbindlicheAnfrage_view, name='UnverbindlicheAnfrage'),
@@ -30,6 +30,7 @@ urlpatterns = [
     path('routes/<int:routeId>/finished/', RouteFinished_view, name='RouteFinished'),
     path('routes/buses/<int:busId>', RoutendetailsBusId_view, name='RoutendetailsBusId'),
     path('health', HealthCheck_view, name='HealthCheck'),
+    path('metrics', Metrics_view, name='Metrics'),
 ]
 
 if settings.DEBUG:
@@ -17,6 +17,169 @@
 """
 import requests
 import os
+import threading
+import time
+from contextlib import contextmanager
+
+from .errors import OSRMUnavailable
+
+import logging
+logger = logging.getLogger('routing.OSRM')
+
+
+class CircuitBreaker:
+    """Stops calling OSRM for a cooldown period after repeated slow or failed responses.
+
+    States: closed (calls allowed), open (calls rejected until cooldown is over) and
+    half open (one probe call is allowed, its result closes or re-opens the breaker,
+    other calls are rejected until then).
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, failure_threshold: int = 3, slow_call_seconds: float = 2.0, cooldown_seconds: float = 30.0):
+        self.failure_threshold = max(1, failure_threshold)
+        self.slow_call_seconds = slow_call_seconds
+        self.cooldown_seconds = cooldown_seconds
+
+        self._lock = threading.Lock()
+        self._state = self.CLOSED
+        self._failures_in_row = 0
+        self._opened_at = 0.0
+        # thread of the probe call in half open state (None: no probe running)
+        self._probe_owner = None
+        # outcomes of the calls within a solver process, replayed by the breaker of the client (see recording)
+        self._events = None
+
+        # counters exported as metrics
+        self._count_calls = 0
+        self._count_failures = 0
+        self._count_slow = 0
+        self._count_rejected = 0
+        self._count_trips = 0
+        self._count_fallbacks = {}
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            return self._current_state()
+
+    @property
+    def is_open(self) -> bool:
+        return self.state == self.OPEN
+
+    def _current_state(self) -> str:
+        # lock must be held by caller
+        if self._state == self.OPEN and time.monotonic() - self._opened_at >= self.cooldown_seconds:
+            self._state = self.HALF_OPEN
+        return self._state
+
+    def allow_request(self) -> bool:
+        with self._lock:
+            state = self._current_state()
+            if state == self.OPEN or (state == self.HALF_OPEN and self._probe_owner is not None):
+                self._count_rejected += 1
+                return False
+            if state == self.HALF_OPEN:
+                self._probe_owner = threading.get_ident()
+            return True
+
+    def release_probe(self) -> None:
+        """The call of this thread ended without a result for the breaker, another call may probe OSRM."""
+        with self._lock:
+            if self._probe_owner == threading.get_ident():
+                self._probe_owner = None
+
+    def _record_event(self, kind: str, value) -> None:
+        with self._lock:
+            if self._events is not None:
+                self._events.append((kind, value))
+
+    def record_success(self, duration_seconds: float) -> None:
+        self._record_event('success', duration_seconds)
+        if duration_seconds > self.slow_call_seconds:
+            with self._lock:
+                self._count_slow += 1
+            self._record_failure(reason=f'slow response ({duration_seconds:.2f}s)')
+            return
+
+        with self._lock:
+            self._count_calls += 1
+            if self._state != self.CLOSED:
+                logger.info('OSRM circuit breaker closed')
+            self._state = self.CLOSED
+            self._failures_in_row = 0
+            self._probe_owner = None
+
+    def record_failure(self, reason: str = '') -> None:
+        self._record_event('failure', reason)
+        self._record_failure(reason)
+
+    def _record_failure(self, reason: str) -> None:
+        with self._lock:
+            self._count_calls += 1
+            self._count_failures += 1
+            self._failures_in_row += 1
+
+            if self._current_state() == self.HALF_OPEN or self._failures_in_row >= self.failure_threshold:
+                if self._state != self.OPEN:
+                    self._count_trips += 1
+                    logger.warning(f'OSRM circuit breaker opened after {self._failures_in_row} failed calls, last: {reason}')
+                self._state = self.OPEN
+                self._opened_at = time.monotonic()
+            self._probe_owner = None
+
+    def record_fallback(self, kind: str) -> None:
+        self._record_event('fallback', kind)
+        with self._lock:
+            self._count_fallbacks[kind] = self._count_fallbacks.get(kind, 0) + 1
+
+    @contextmanager
+    def recording(self, state_client: str):
+        """For the calls of a job in a solver process: the breaker starts from the state of the breaker of the client
+        (open or not) and the outcomes of the calls are collected in the yielded list, see replay."""
+        with self._lock:
+            if state_client == self.OPEN:
+                self._state = self.OPEN
+                self._opened_at = time.monotonic()
+            else:
+                self._state = self.CLOSED
+                self._failures_in_row = 0
+            self._probe_owner = None
+            events = []
+            self._events = events
+        try:
+            yield events
+        finally:
+            with self._lock:
+                self._events = None
+
+    def replay(self, events: list) -> None:
+        """Applies the outcomes of calls made by a solver process (see recording), i.e. they trip this breaker and are part of its metrics."""
+        record = {'success': self.record_success, 'failure': self.record_failure, 'fallback': self.record_fallback}
+        for kind, value in events:
+            record[kind](value)
+
+    def reset(self) -> None:
+        with self._lock:
+            self._state = self.CLOSED
+            self._failures_in_row = 0
+            self._probe_owner = None
+
+    def metrics(self) -> dict:
+        with self._lock:
+            return {
+                'state': self._current_state(),
+                'calls': self._count_calls,
+                'failures': self._count_failures,
+                'slow_calls': self._count_slow,
+                'rejected_calls': self._count_rejected,
+                'trips': self._count_trips,
+                'fallbacks': dict(self._count_fallbacks),
+            }
+
 
 class OSRM:
     @classmethod
@@ -54,9 +217,81 @@ class OSRM:
     def setDefaultUrl(cls, url: str):        
         cls.url_default = url
 
+    # timeout per OSRM call in s, shortened further by the latency budget of the current request
+    timeout_default = float(os.environ.get('OSRM_TIMEOUT_SECONDS', 10))
+
+    circuit_breaker = CircuitBreaker(
+        failure_threshold=int(os.environ.get('OSRM_BREAKER_FAILURES', 3)),
+        slow_call_seconds=float(os.environ.get('OSRM_BREAKER_SLOW_SECONDS', 2)),
+        cooldown_seconds=float(os.environ.get('OSRM_BREAKER_COOLDOWN_SECONDS', 30)))
+
+    # deadline of the routing request handled by the current thread (greenlet with gevent)
+    _budget = threading.local()
+
+    @classmethod
+    @contextmanager
+    def latency_budget(cls, seconds: float):
+        """All OSRM calls within this context share one deadline, each call gets the remaining time as timeout."""
+        deadline_old = getattr(cls._budget, 'deadline', None)
+        if seconds is not None and seconds > 0:
+            deadline = time.monotonic() + seconds
+            if deadline_old is not None:
+                deadline = min(deadline, deadline_old)
+            cls._budget.deadline = deadline
+        try:
+            yield
+        finally:
+            cls._budget.deadline = deadline_old
+
+    @classmethod
+    def budget_remaining(cls):
+        """Remaining latency budget of the current thread in s (None: no budget), at least 1 ms, i.e. an exhausted budget
+        stays exhausted if it is passed to another process."""
+        deadline = getattr(cls._budget, 'deadline', None)
+        if deadline is None:
+            return None
+        return max(deadline - time.monotonic(), 0.001)
+
+    @classmethod
+    def call_timeout(cls) -> float:
+        timeout = cls.timeout_default
+        deadline = getattr(cls._budget, 'deadline', None)
+        if deadline is not None:
+            timeout = min(timeout, deadline - time.monotonic())
+        return timeout
+
     def __init__(self, url):
         self.url = url
 
+    def _get(self, url, params=None):
+        """GET with timeout from latency budget, guarded by the circuit breaker."""
+        if not self.circuit_breaker.allow_request():
+            raise OSRMUnavailable('OSRM circuit breaker is open.')
+
+        timeout = self.call_timeout()
+        if timeout <= 0:
+            self.circuit_breaker.release_probe()
+            raise OSRMUnavailable('Latency budget for OSRM calls is exhausted.')
+
+        timeStarted = time.monotonic()
+        try:
+            response = requests.get(url, params=params, timeout=timeout)
+        except requests.exceptions.RequestException as err:
+            self.circuit_breaker.record_failure(reason=str(err))
+            raise OSRMUnavailable(f'OSRM request failed: {err}')
+
+        if response.status_code == 407:
+            self.circuit_breaker.release_probe()
+            raise ValueError((' '.join((str(response.status_code), 'Check your proxy settings'))))
+        elif response.status_code == 429 or response.status_code >= 500:
+            self.circuit_breaker.record_failure(reason=f'status code {response.status_code}')
+            if response.status_code == 429:
+                raise OSRMUnavailable((' '.join((str(response.status_code), 'Too many requests, check again later'))))
+            raise OSRMUnavailable(f'OSRM request failed with status code {response.status_code}')
+
+        self.circuit_breaker.record_success(time.monotonic()-timeStarted)
+        return response
+
     def nearest_segments(self, latitude, longitude, profile='driving', number=1):
         #http://project-osrm.org/docs/v5.22.0/api/#nearest-service
 
@@ -64,11 +299,7 @@ class OSRM:
         url = f'{self.url}/nearest/v1/{profile}/{coordstring}.json'
         # print(url)
 
-        response = requests.get(url, params={'number': number})
-        if response.status_code == 407:
-            raise ValueError((' '.join((str(response.status_code), 'Check your proxy settings'))))
-        elif response.status_code == 429:
-            raise ValueError((' '.join((str(response.status_code), 'Too many requests, check again later'))))
+        response = self._get(url, params={'number': number})
         
         # print(response.status_code)
 
@@ -115,12 +346,7 @@ class OSRM:
         coordstring = self.coords2string(coordinates)
         url = f'{self.url}/table/v1/{profile}/{coordstring}.json'
         # print(url)
-        response = requests.get(url)        
-
-        if response.status_code == 407:
-            raise ValueError((' '.join((str(response.status_code), 'Check your proxy settings'))))
-        elif response.status_code == 429:
-            raise ValueError((' '.join((str(response.status_code), 'Too many requests, check again later'))))
+        response = self._get(url)
 
         # print(response.status_code)
         
@@ -152,12 +378,7 @@ class OSRM:
         coordstring = self.coords2string(coordinates)
         url = f'{self.url}/route/v1/{profile}/{coordstring}.json'
         #print(url)
-        response = requests.get(url, params={'annotations': 'true', 'geometries': 'geojson'})
-        
-        if response.status_code == 407:
-            raise ValueError((' '.join((str(response.status_code), 'Check your proxy settings'))))
-        elif response.status_code == 429:
-            raise ValueError((' '.join((str(response.status_code), 'Too many requests, check again later'))))
+        response = self._get(url, params={'annotations': 'true', 'geometries': 'geojson'})
         
         data = response.json()
         #print(data)
@@ -93,4 +93,10 @@ class SolutionFormattingError(Exception):
     '''Raise on orders that evolve an imporper solution format'''
     def __init__(self, message="Unexpected solution formatting."):
         self.message = message
-        super().__init__(self.message)
\ No newline at end of file
+        super().__init__(self.message)
+
+class OSRMUnavailable(ValueError):
+    '''Raise if OSRM is not reachable in time or the circuit breaker is open'''
+    def __init__(self, message="OSRM service unavailable."):
+        self.message = message
+        super().__init__(self.message)
@@ -0,0 +1,61 @@
+"""
+ Copyright  2025 IAV GmbH Ingenieurgesellschaft Auto und Verkehr, All Rights Reserved.
+ 
+ Licensed under the Apache License, Version 2.0 (the "License");
+ you may not use this file except in compliance with the License.
+ You may obtain a copy of the License at
+ 
+ http://www.apache.org/licenses/LICENSE-2.0
+ 
+ Unless required by applicable law or agreed to in writing, software
+ distributed under the License is distributed on an "AS IS" BASIS,
+ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ See the License for the specific language governing permissions and
+ limitations under the License.
+ 
+ SPDX-License-Identifier: Apache-2.0
+"""
+from typing import Iterable, List, Sequence, Tuple
+
+# characters of the encoding are 63..126, thus this separator may join several polylines
+SEPARATOR = ';'
+
+
+def encode_polyline(points: Iterable[Sequence[int]]) -> str:
+    """Encodes integer tuples with the polyline algorithm: the delta to the previous point per dimension,
+    shifted sign bit and chunks of 5 bits as characters (chunk + 63, bit 0x20 set if more chunks follow)."""
+    chars = []
+    previous = None
+    for point in points:
+        if previous is None:
+            previous = [0]*len(point)
+        for dim, value in enumerate(point):
+            delta = int(value) - previous[dim]
+            previous[dim] = int(value)
+            delta = ~(delta << 1) if delta < 0 else (delta << 1)
+            while delta >= 0x20:
+                chars.append(chr((0x20 | (delta & 0x1f)) + 63))
+                delta >>= 5
+            chars.append(chr(delta + 63))
+    return ''.join(chars)
+
+
+def decode_polyline(text: str, dimensions: int) -> List[Tuple[int, ...]]:
+    """Inverse of encode_polyline."""
+    points = []
+    values = [0]*dimensions
+    index = 0
+    while index < len(text):
+        for dim in range(dimensions):
+            shift = 0
+            result = 0
+            while True:
+                chunk = ord(text[index]) - 63
+                index += 1
+                result |= (chunk & 0x1f) << shift
+                shift += 5
+                if chunk < 0x20:
+                    break
+            values[dim] += ~(result >> 1) if result & 1 else (result >> 1)
+        points.append(tuple(values))
+    return points
@@ -0,0 +1,111 @@
+"""
+ Copyright  2025 IAV GmbH Ingenieurgesellschaft Auto und Verkehr, All Rights Reserved.
+ 
+ Licensed under the Apache License, Version 2.0 (the "License");
+ you may not use this file except in compliance with the License.
+ You may obtain a copy of the License at
+ 
+ http://www.apache.org/licenses/LICENSE-2.0
+ 
+ Unless required by applicable law or agreed to in writing, software
+ distributed under the License is distributed on an "AS IS" BASIS,
+ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ See the License for the specific language governing permissions and
+ limitations under the License.
+ 
+ SPDX-License-Identifier: Apache-2.0
+"""
+from bisect import bisect_left, bisect_right
+
+
+class PromiseIndex():
+    """
+    Active promises of one community at a given fleet state version, per bus sorted by the hop on times for interval queries.
+    The index contains at least the changes up to its version, changed routes are replaced by update_routes.
+    """
+
+    def __init__(self, version, orders):
+        self.version = version
+        self._promises = {} # order uid -> promise
+        self._routes = {} # route id -> [order uid]
+        self._bus_routes = {} # bus uid -> {route id}
+        self._buses = {} # bus uid -> ([hop on tMin], [(hop on tMax, route id)]) sorted by hop on tMin
+
+        for bus_uid in self._add(orders):
+            self._sort_bus(bus_uid)
+
+    def update_routes(self, route_ids, orders):
+        """ Replaces the promises of the routes by the orders, i.e. the active orders of these routes now (none for deleted routes) """
+        buses = set()
+        for route_id in route_ids:
+            for order_uid in list(self._routes.get(route_id, [])):
+                buses.add(self._remove(order_uid))
+        buses |= self._add(orders)
+        for bus_uid in buses:
+            self._sort_bus(bus_uid)
+
+    def _remove(self, order_uid):
+        """ Removes the promise of the order, returns its bus uid """
+        promise = self._promises.pop(order_uid)
+        route_id = promise['route_id']
+        self._routes[route_id].remove(order_uid)
+        if not self._routes[route_id]:
+            del self._routes[route_id]
+            self._bus_routes[promise['bus_uid']].discard(route_id)
+        return promise['bus_uid']
+
+    def _add(self, orders) -> set:
+        """ Adds the promises of the orders, returns the bus uids whose entries must be sorted again """
+        buses = set()
+        for order in orders:
+            if order.uid in self._promises:
+                # the order has moved to another route
+                buses.add(self._remove(order.uid))
+            hopOn = order.hopOnNode
+            hopOff = order.hopOffNode
+            route = hopOn.route
+            self._promises[order.uid] = {
+                'start': (hopOn.mapId, (hopOn.tMin, hopOn.tMax)),
+                'start_lat_lon': (hopOn.latitude, hopOn.longitude),
+                'stop': (hopOff.mapId, (hopOff.tMin, hopOff.tMax)),
+                'stop_lat_lon': (hopOff.latitude, hopOff.longitude),
+                'load': order.load,
+                'loadWheelchair': order.loadWheelchair,
+                'route_status': route.status,
+                'bus_uid': route.bus.uid,
+                'route_id': route.id}
+            self._routes.setdefault(route.id, []).append(order.uid)
+            self._bus_routes.setdefault(route.bus.uid, set()).add(route.id)
+            buses.add(route.bus.uid)
+        return buses
+
+    def _sort_bus(self, bus_uid):
+        bus_entries = [(promise['start'][1][0], promise['start'][1][1], route_id)
+                       for route_id in self._bus_routes.get(bus_uid, ())
+                       for promise in (self._promises[order_uid] for order_uid in self._routes[route_id])]
+        if not bus_entries:
+            self._buses.pop(bus_uid, None)
+            self._bus_routes.pop(bus_uid, None)
+            return
+        bus_entries.sort(key=lambda entry: entry[0])
+        self._buses[bus_uid] = ([entry[0] for entry in bus_entries], [(entry[1], entry[2]) for entry in bus_entries])
+
+    def query(self, bus_ids, shift_start, shift_end, time_now) -> dict:
+        """ Same result as the database query of RoutesDummy.get_promises """
+        route_ids = []
+        for bus_uid in bus_ids:
+            if bus_uid not in self._buses:
+                continue
+            starts, rest = self._buses[bus_uid]
+            for i in range(bisect_left(starts, shift_start), bisect_right(starts, shift_end)):
+                tMax, route_id = rest[i]
+                if tMax <= shift_end and route_id not in route_ids:
+                    route_ids.append(route_id)
+
+        promises = {}
+        for route_id in route_ids:
+            for order_uid in self._routes[route_id]:
+                promise = self._promises[order_uid]
+                if promise['stop'][1][1] > time_now:
+                    promises[order_uid] = dict(promise)
+        return promises
@@ -16,18 +16,22 @@
  SPDX-License-Identifier: Apache-2.0
 """
 from functools import partial
+from operator import itemgetter
 
 # do not change order of ortools imports - may lead to segfaults in docker images (issue #246)
 from ortools.constraint_solver import routing_enums_pb2
 from ortools.constraint_solver import pywrapcp
 
+import os
 import pickle
+import time
 from pprint import pprint
-from collections import defaultdict, namedtuple
+from collections import defaultdict, namedtuple, OrderedDict
 import networkx as nx
+import numpy as np
 from uuid import uuid4
-from copy import deepcopy
-from .routingClasses import Group, Station, Moby, MobyLoad, Vehicle, VehicleCapacity, Node, MapNode, TimeWindow, LocationIndex, BusIndex, Passenger, StationConstraint
+from copy import copy
+from .routingClasses import Group, Station, Moby, MobyLoad, Vehicle, VehicleCapacity, Node, MapNode, TimeWindow, LocationIndex, BusIndex, BusID, Passenger, StationConstraint
 
 from typing import List, Tuple, Dict, Callable, Optional, Union, Any
 
@@ -40,8 +44,13 @@ logger = logging.getLogger('routing.routing')
 
 # end debug stuff ################
 
-from .rutils import Path, durations_matrix_OSRM, durations_matrix_graph, shortest_path_OSRM, shortest_path_OSRM_multi, shortest_path_graph, shortest_path_graph_gps, ConsolePrinter, travel_time, multi2single, STNIMMERLEIN
-from .errors import NoRouteException, NoRouteExceptionInternalError
+from .rutils import Path, durations_matrix_OSRM, durations_matrix_graph, durations_matrix_graph_fallback, shortest_path_OSRM, shortest_path_OSRM_multi, shortest_path_graph, shortest_path_graph_gps, ConsolePrinter, travel_time, multi2single, STNIMMERLEIN
+from .errors import NoRouteException, NoRouteExceptionInternalError, OSRMUnavailable
+from .OSRM_directions import OSRM
+from .timing import timer
+
+# penalty per min outside of the preferred time window (smaller slack) of a request
+SLACK_SOFT_PENALTY = 1000
 
 ###########################
 # Problem Data Definition #
@@ -62,7 +71,7 @@ class DataProblem():
         self._vehicles: List[Vehicle] = []
         for vehicle in capacities:
             if isinstance(vehicle, Vehicle):
-                self._vehicles.append(deepcopy(vehicle))
+                self._vehicles.append(vehicle)
             else:
                 raise TypeError('given capacity arguments contains no Vehicle object, but {}', vehicle)
 
@@ -142,10 +151,10 @@ class CreateDistanceEvaluator(object):
 
 
 class CreateDemandEvaluator(object):
-    """Creates callback to get demands at each location."""
+    """Creates demand vectors (per location) for the capacity dimensions."""
 
     def __init__(self, data:DataProblem):
-        """Initializes the demand array."""
+        """Initializes the demand vectors."""
 
         self._demands = data.demands
         self._wheelchair_weight = 0
@@ -153,51 +162,50 @@ class CreateDemandEvaluator(object):
         for v in data.vehicles:
             self._wheelchair_weight = max(v.capacity.seatsBlockedPerWheelchair, self._wheelchair_weight)
 
+        wheelchair_weight = 2
+
+        if self._wheelchair_weight > wheelchair_weight:
+            logger.debug(f'Wheelchair weight can be max {wheelchair_weight}')
+            raise ValueError(f'Wheelchair weight can be max {wheelchair_weight}') # otherwise our weighted sum constraint will not work
+
+        # the solver reads these vectors directly (no python callbacks while solving - performance!)
+        self.demands_seats: List[int] = [demand.standardSeats for demand in self._demands]
+        self.demands_wheelchairs: List[int] = [demand.wheelchairs for demand in self._demands]
+        # calc a weighted sum for seats and wheelchairs that allows us to limit demands such that wheelchairs can reduce standard seats
+        self.demands_weighted_sum: List[int] = [demand.standardSeats + wheelchair_weight*demand.wheelchairs for demand in self._demands]
+
     def demand_evaluator_seats(self, from_node: LocationIndex)->int:
         """Returns the demand of the current node""" 
 
-        if from_node < len(self._demands):
-            retTmp = self._demands[from_node].standardSeats
-            # logger.debug(f'demand_evaluator_seats for seats = {retTmp}')
-            return retTmp            
+        if from_node < len(self.demands_seats):
+            return self.demands_seats[from_node]
         return 0
 
     def demand_evaluator_wheelchairs(self, from_node: LocationIndex)->int:
         """Returns the demand of the current node""" 
 
-        if from_node < len(self._demands):
-            retTmp = self._demands[from_node].wheelchairs
-            # logger.debug(f'demand_evaluator_wheelchairs for wheelchairs = {retTmp}')
-            return retTmp
+        if from_node < len(self.demands_wheelchairs):
+            return self.demands_wheelchairs[from_node]
         return 0
 
     def demand_evaluator_weighted_sum(self, from_node: LocationIndex)->int:
         """Returns the demand of the current node""" 
 
-        wheelchair_weight = 2
-
-        if self._wheelchair_weight > wheelchair_weight:
-            logger.debug(f'Wheelchair weight can be max {wheelchair_weight}')
-            raise ValueError(f'Wheelchair weight can be max {wheelchair_weight}') # otherwise our weighted sum constraint will not work
-
-        # calc a weighted sum for seats and wheelchairs that allows us to limit demands such that wheelchairs can reduce standard seats
-        if from_node < len(self._demands):
-            retTmp = self._demands[from_node].standardSeats + wheelchair_weight*(self._demands[from_node].wheelchairs)
-            # logger.debug(f'demand_evaluator_weighted_sum for seats and wheelchairs = {retTmp}')
-            return retTmp
+        if from_node < len(self.demands_weighted_sum):
+            return self.demands_weighted_sum[from_node]
         return 0
 
 
 def add_capacity_constraints(routing:pywrapcp.RoutingModel,
                              data:DataProblem,
-                             demand_evaluator_seats: Callable[[LocationIndex],int], demand_evaluator_wheelchairs: Callable[[LocationIndex],int], demand_evaluator_weighted_sum: Callable[[LocationIndex],int])->None:
+                             demands_seats: List[int], demands_wheelchairs: List[int], demands_weighted_sum: List[int])->None:
 
     """Adds capacity constraint"""
     capacity = "Capacity"   
     
      # standard seats
     capacity = 'Capacity'     
-    demand_callback_index_seats = routing.RegisterUnaryTransitCallback(demand_evaluator_seats)
+    demand_callback_index_seats = routing.RegisterUnaryTransitVector(demands_seats)
 
     vCapaStandardTmp = [v.capacity.maxNumStandardSeats for v in data.vehicles]
     #print(f'capa standard {vCapaStandardTmp}')
@@ -211,7 +219,7 @@ def add_capacity_constraints(routing:pywrapcp.RoutingModel,
 
     # wheelchairs
     capacityWheelchair = 'CapacityWheelchair'       
-    demand_callback_index_wheelchair = routing.RegisterUnaryTransitCallback(demand_evaluator_wheelchairs)
+    demand_callback_index_wheelchair = routing.RegisterUnaryTransitVector(demands_wheelchairs)
 
     vCapaWheelchairTmp = [v.capacity.maxNumWheelchairs for v in data.vehicles]
     #print(f'capa wheelchair {vCapaWheelchairTmp}')
@@ -227,7 +235,7 @@ def add_capacity_constraints(routing:pywrapcp.RoutingModel,
     # works only if a wheelchair reduces the seats max by 2
 
     capacityWeightedSum = 'CapacityWeightedSum'       
-    demand_callback_index_weighted_sum = routing.RegisterUnaryTransitCallback(demand_evaluator_weighted_sum)
+    demand_callback_index_weighted_sum = routing.RegisterUnaryTransitVector(demands_weighted_sum)
 
     vCapaWeightedTmp = [((2-v.capacity.seatsBlockedPerWheelchair)*v.capacity.maxNumWheelchairs+v.capacity.maxNumStandardSeats) for v in data.vehicles]
     #print(f'capa weighted {vCapaWeightedTmp}')
@@ -240,72 +248,60 @@ def add_capacity_constraints(routing:pywrapcp.RoutingModel,
         capacityWeightedSum)
 
 class CreateTimeEvaluator(object):
-    """Creates callback to get total times between locations."""
-    @staticmethod
-    def service_time_per_stop(data:DataProblem, from_node, to_node)->float:
-        """Gets the service time for the specified location.
-        from_node, to_node can be Stations, or str 'Depot'."""
-
-        if from_node == 'Depot' or to_node == 'Depot' or from_node == to_node:
-            return 0
-        else:
-            return 1
-
+    """Creates integer matrices of total times between locations."""
     def __init__(self, data:DataProblem, durations_dict, service_time_load_seat:int, service_time_load_wheelchair: int):
         """Initializes the total time matrix."""        
-        self._total_time = {}
-        self._total_time_weighted = {}
+        num_locations = len(data.locations)
 
-        for from_index, from_node in enumerate(data.locations):
-            self._total_time[from_index] = {}
-            self._total_time_weighted[from_index] = {}
+        # location indexed durations, rows are read at once from durations_dict (keys are Stations, or str 'Depot')
+        get_row = itemgetter(*data.locations)
+        durations = np.array([get_row(durations_dict[from_node]) for from_node in data.locations], dtype=float).reshape(num_locations, num_locations)
 
-            # take into account service times for passengers hop on
-            service_time_per_hop_on_passenger = service_time_load_seat 
-            number_passengers_hop_on = max(data.demands[from_index].standardSeats,0) # hop off is < 0
-            service_time_per_hop_on_wheelchair = service_time_load_wheelchair
-            number_wheelchairs_hop_on_off = abs(data.demands[from_index].wheelchairs) # hop off is < 0, wheelchair hop off takes lot of time, too
+        # take into account service times for passengers hop on
+        is_station = np.array([location != 'Depot' for location in data.locations])
+        number_passengers_hop_on = np.array([max(demand.standardSeats, 0) for demand in data.demands], dtype=float) # hop off is < 0
+        number_wheelchairs_hop_on_off = np.array([abs(demand.wheelchairs) for demand in data.demands], dtype=float) # hop off is < 0, wheelchair hop off takes lot of time, too
 
-            # TODO sehr pauschal: Rollstuhlfahrer, Gruppe mit einem Ticket... waere anders zu modellieren, Aussteigen noch gar nicht modelliert Aussteigen mit weniger Zeitoffset...
-            # Rollstuhlfahrer werden vom Optimierer durch die laengeren Service-Zeiten stark benachteiligt, die will man ja eigentlich bevorzugen -> kann man anderswo normale Seats mit penalties versehen, wenn Rollstuhl gebucht wird?
-            
-            for to_index, to_node in enumerate(data.locations):
-                # durations should not be rounded to zero when casted to integer (which is done always)!
-                duration_tmp = durations_dict[from_node][to_node]
+        # TODO sehr pauschal: Rollstuhlfahrer, Gruppe mit einem Ticket... waere anders zu modellieren, Aussteigen noch gar nicht modelliert Aussteigen mit weniger Zeitoffset...
+        # Rollstuhlfahrer werden vom Optimierer durch die laengeren Service-Zeiten stark benachteiligt, die will man ja eigentlich bevorzugen -> kann man anderswo normale Seats mit penalties versehen, wenn Rollstuhl gebucht wird?
+        service_time_hop_on = service_time_load_seat*number_passengers_hop_on + service_time_load_wheelchair*number_wheelchairs_hop_on_off
+
+        # service time per stop is 1, not for depot
+        service_time_per_stop = np.logical_and(is_station[:, None], is_station[None, :]).astype(float)
 
-                if duration_tmp > 0:
-                    duration_tmp = max(1.0, duration_tmp)
-                    service_time_total = self.service_time_per_stop(data, from_node, to_node) + service_time_per_hop_on_passenger*number_passengers_hop_on + service_time_per_hop_on_wheelchair*number_wheelchairs_hop_on_off
-                elif duration_tmp == 0:
-                    # no service_time, if from and to is the same station, i.e. multiple mobies at same station
-                    service_time_total = 0
+        # durations should not be rounded to zero when casted to integer (which is done always)!
+        # no service_time, if from and to is the same station, i.e. multiple mobies at same station (duration is 0)
+        is_moving = durations > 0
+        durations = np.where(is_moving, np.maximum(durations, 1.0), durations)
+        service_time_total = np.where(is_moving, service_time_per_stop + service_time_hop_on[:, None], 0.0)
 
-                # add service time for hop on/off
-                self._total_time[from_index][to_index] = duration_tmp + service_time_total
+        # add service time for hop on/off
+        self._total_time = durations + service_time_total
 
-                # calc a weighted distance: segments with passengers should have short routing times - increase costs
-                # reason: optimizer should not minimize distances without load, mobis should have shortest times
-                # however: note that this is not a general solution, since the load at nodes is NEVER KNOWN, the hop_ons is only a small part of reality
-                # as second rule we implement additional constraint
-                self._total_time_weighted[from_index][to_index] = self._total_time[from_index][to_index]*(1+2*number_passengers_hop_on+3*number_wheelchairs_hop_on_off)                
+        # calc a weighted distance: segments with passengers should have short routing times - increase costs
+        # reason: optimizer should not minimize distances without load, mobis should have shortest times
+        # however: note that this is not a general solution, since the load at nodes is NEVER KNOWN, the hop_ons is only a small part of reality
+        # as second rule we implement additional constraint
+        self._total_time_weighted = self._total_time*(1+2*number_passengers_hop_on+3*number_wheelchairs_hop_on_off)[:, None]
 
-                # logger.debug(f'service time {from_index} {to_index} {self._total_time[from_index][to_index]}')
+        # take care: the ortools solver solves INTEGER problems only - https://developers.google.com/optimization/cp/cp_solver
+        # the solver reads these matrices directly (no python callbacks while solving - performance!)
+        self.time_matrix: List[List[int]] = self._total_time.astype(np.int64).tolist()
+        self.time_matrix_weighted: List[List[int]] = self._total_time_weighted.astype(np.int64).tolist()
 
     def time_evaluator(self, from_index:LocationIndex, to_index:LocationIndex)->int:
         """Returns the total time between the two nodes"""
 
-        # take care: the ortools solver solves INTEGER problems only - https://developers.google.com/optimization/cp/cp_solver
-        if from_index < len(self._total_time) and to_index < len(self._total_time):            
-            return int(self._total_time[from_index][to_index])
+        if from_index < len(self.time_matrix) and to_index < len(self.time_matrix):            
+            return self.time_matrix[from_index][to_index]
         else:
             return 0
 
     def time_evaluator_weighted_demands(self, from_index:LocationIndex, to_index:LocationIndex)->int:
         """Returns the total time between the two nodes"""
 
-        # take care: the ortools solver solves INTEGER problems only - https://developers.google.com/optimization/cp/cp_solver
-        if from_index < len(self._total_time_weighted) and to_index < len(self._total_time_weighted):   
-            return int(self._total_time_weighted[from_index][to_index])
+        if from_index < len(self.time_matrix_weighted) and to_index < len(self.time_matrix_weighted):   
+            return self.time_matrix_weighted[from_index][to_index]
         else:
             return 0
 
@@ -313,12 +309,12 @@ class CreateTimeEvaluator(object):
 def add_time_window_constraints(routing:pywrapcp.RoutingModel, 
                                 routingIndexManager:pywrapcp.RoutingIndexManager,
                                 data:DataProblem,
-                                time_evaluator:Callable[[LocationIndex,LocationIndex], int])->None:
+                                time_matrix:List[List[int]])->None:
     """Add Global Span constraint"""
     time = "Time"
     horizon = STNIMMERLEIN
 
-    time_callback_index = routing.RegisterTransitCallback(time_evaluator)
+    time_callback_index = routing.RegisterTransitMatrix(time_matrix)
 
     routing.AddDimension(
         time_callback_index,
@@ -351,27 +347,33 @@ def add_time_window_constraints(routing:pywrapcp.RoutingModel,
         routing.AddToAssignment(time_dimension.SlackVar(index))
         logger.debug('add slack for vehicle index: {}'.format(index))
 
+def add_soft_time_window_constraints(routing:pywrapcp.RoutingModel,
+                                     routingIndexManager:pywrapcp.RoutingIndexManager,
+                                     time_windows_soft:Dict[LocationIndex, Tuple[Optional[int], Optional[int]]],
+                                     penalty:int)->None:
+    """Penalize times outside of the preferred time windows (smaller slack), costs are per min"""
+    time = "Time"
+    time_dimension = routing.GetDimensionOrDie(time)
+    for location_idx, (lower, upper) in time_windows_soft.items():
+        index: int = routingIndexManager.NodeToIndex(location_idx)
+        if lower is not None:
+            time_dimension.SetCumulVarSoftLowerBound(index, lower, penalty)
+        if upper is not None:
+            time_dimension.SetCumulVarSoftUpperBound(index, upper, penalty)
+        logger.debug('soft time window location_idx: {}, window: {}'.format(location_idx, (lower, upper)))
+
 def add_pickup_delivery_constraints(routing:pywrapcp.RoutingModel,
                                     routingIndexManager:pywrapcp.RoutingIndexManager,
                                     time_evaluator,
                                     durations_dict,
                                     data:DataProblem,
-                                    hop_ons:Dict[LocationIndex, Optional[Passenger]],
-                                    hop_offs:Dict[LocationIndex, Optional[Passenger]])->None:
+                                    pickups_deliveries:List[Tuple[LocationIndex, LocationIndex]])->None:
     """Add Correct Order and Vehicle per Moby constraint"""
     time = "Time"
-    for pickup, moby in hop_ons.items():
-        if moby is None:
-            continue
-        deliveries = [hofs for hofs in hop_offs if hop_offs[hofs] == moby]
-
-        if len(deliveries) != 1:
-            raise NoRouteExceptionInternalError('No routing can be found due to improper deliveries')
+    for pickup, delivery in pickups_deliveries:
         if pickup == 0:
             continue
 
-        delivery = deliveries[0]
-
         logger.debug('pickup constraint pickup_id: {}, delivery_id: {}'.format(pickup, delivery))
         index_pickup = routingIndexManager.NodeToIndex(pickup)
         index_delivery = routingIndexManager.NodeToIndex(delivery)
@@ -516,7 +518,7 @@ class CreateShortestPaths(object):
 class BusTour:
     """Routing class for one complete tour."""
 
-    def __init__(self, G:nx.DiGraph, OSRM_url:str, capacities: List[Vehicle], time_offset_factor: float, time_per_demand_unit_wheelchair:int, slack:int=30):
+    def __init__(self, G:nx.DiGraph, OSRM_url:str, capacities: List[Vehicle], time_offset_factor: float, time_per_demand_unit_wheelchair:int, slack:int=30, G_fallback:nx.DiGraph=None):
         if G != None:
             logger.debug(            
                 f'new BusTour G: {G.number_of_nodes} nodes, slack: {slack}, capacities: {capacities}') # do NOT!!! write the graph, this destroys performance!        
@@ -527,29 +529,47 @@ class BusTour:
             self.G = None
 
         self.OSRM_url = OSRM_url
+        # graph used for time matrix if OSRM is not available (only relevant without G)
+        self.G_fallback = G_fallback
         self.locations:List[MapNode] = ['Depot']
         self.locations_connection: List[str] = ['']
         self.locations_arrival_fixed: List[bool] = [False]
+        # bus of the committed route for promises (None for new requests), used as initial solution
+        self.locations_bus: List[Optional[BusID]] = [None]
         self.loads:List[MobyLoad] = [MobyLoad(0,0)]
+        # vehicles are not changed by the tour (copied if necessary), thus no copies here
         self.capacities: List[Vehicle] = []
         for vehicle in capacities:
             if isinstance(vehicle, Vehicle):
-                self.capacities.append(deepcopy(vehicle))
+                self.capacities.append(vehicle)
             else:
                 raise TypeError('BusTour needs a list of vehicle objects as input')
         self.hop_ons: Dict[LocationIndex, Optional[Passenger]] = defaultdict(lambda: None)
         self.hop_offs: Dict[LocationIndex, Optional[Passenger]] = defaultdict(lambda: None)
+        # pairs of pickup and delivery location per moby, in order of adding
+        self.pickups_deliveries: List[Tuple[LocationIndex, LocationIndex]] = []
         self._time_windows: List[TimeWindow] = [(0, 0)]
         self.time_windows: List[TimeWindow] = {}
         self._slack: int = slack
+        # smaller slack that is preferred by penalties, the model is built once with the max slack
+        self._slack_soft: Optional[int] = None
+        self._time_windows_soft: Dict[LocationIndex, Tuple[Optional[int], Optional[int]]] = {}
         self._time_offset_factor = time_offset_factor
         self._time_per_demand_unit_wheelchair = time_per_demand_unit_wheelchair
         self._final_paths: Dict[BusIndex, List[Node]] = {}
         self.stations: List[Dict[str, List[BusIndex]]] = []
         self.groups: Dict[str, Group] = dict()
         self.station_closing_times:Dict[MapNode,List[TimeWindow]] = dict()
+        # upper bound of the search time of the solver in seconds (None: no limit)
+        self.time_limit_seconds: Optional[int] = None
+        # epoch time at which the problem is given up (None: no limit), the time limit of the solver is cut down to it
+        self.deadline: Optional[float] = None
+        # the solver is run as well if insertion_feasible finds an insertion, disagreements are logged (ROUTING_VERIFY_INSERTION_CHECK)
+        self.verify_insertion_check: bool = os.environ.get('ROUTING_VERIFY_INSERTION_CHECK', 'no') == 'yes'
         self.time_matrix: Dict[Dict[int]] = {}  
         self.time_matrix_save: dict[dict[int]] = {}
+        # the location lists are append-only, all other changes of mobies are recorded here to be undone, see _rollback
+        self._undo_log: List[Callable[[], Any]] = []
 
     @property
     def time_per_demand_unit_seat(self)->int:
@@ -565,14 +585,29 @@ class BusTour:
         if val>0:
             self._slack = val   
 
+    def set_slack_soft(self, val:Optional[int]):
+        if val is None or (val>0 and val<self._slack):
+            self._slack_soft = val
+
     def get_routes(self)->Dict[BusIndex, List[Node]]:
         return self._final_paths
 
     def calc_time_matrix(self, station_list)->dict:
+        with timer.phase('matrix'):
+            return self._calc_time_matrix(station_list)
+
+    def _calc_time_matrix(self, station_list)->dict:
         if self.G != None:
             return durations_matrix_graph(tuple(station_list), self.G, self._time_offset_factor, self.time_matrix_save)
         else:
-            return durations_matrix_OSRM(tuple(station_list), self.OSRM_url, self._time_offset_factor)
+            try:
+                return durations_matrix_OSRM(tuple(station_list), self.OSRM_url, self._time_offset_factor)
+            except OSRMUnavailable as err:
+                if self.G_fallback is None:
+                    raise
+                logger.warning(f'OSRM not available ({err.message}), time matrix computed on fallback graph')
+                OSRM.circuit_breaker.record_fallback('matrix')
+                return durations_matrix_graph_fallback(tuple(OrderedDict.fromkeys(station_list)), self.G_fallback, self._time_offset_factor, self.time_matrix_save)
 
     def calc_shortest_path(self, start: Station, stop: Station)->Path:
         if self.G != None:
@@ -594,7 +629,13 @@ class BusTour:
 
     def calc_shortest_path_multi(self, path_locations: List[Station])->List[List]:
         if self.G == None:
-            nodes_of_route_all = shortest_path_OSRM_multi(path_locations, self.OSRM_url, onlyGps=False)
+            try:
+                nodes_of_route_all = shortest_path_OSRM_multi(path_locations, self.OSRM_url, onlyGps=False)
+            except OSRMUnavailable as err:
+                # only stations are needed for the route, the nodes in between are optional
+                logger.warning(f'OSRM not available ({err.message}), paths are built without nodes between stations')
+                OSRM.circuit_breaker.record_fallback('path')
+                nodes_of_route_all = [[] for _ in range(0, len(path_locations)-1)]
         else:
             nodes_of_route_all = []
             for iLoc in range(0, len(path_locations)-1):
@@ -615,15 +656,20 @@ class BusTour:
 
     def add_moby(self, moby:Moby, build_paths = True, *args, **kwargs)->Optional[str]:
         logger.debug(f'add_moby args: {args}, kwargs: {kwargs}')
+
+        # save old data (time windows are replaced, not changed by update)
+        snapshot = self._snapshot()
+        time_windows_old = self.time_windows
         try:
-            # save old data
-            locations_old = deepcopy(self.locations)            
-            loads_old = deepcopy(self.loads)
-            groups_old = deepcopy(self.groups)
-            time_windows_old = deepcopy(self.time_windows)
-            _time_windows_old = deepcopy(self._time_windows)
-            
             group_id = self._add_moby(moby, *args, **kwargs)
+            if not build_paths:
+                with timer.phase('insertion_check'):
+                    insertion_feasible = self.insertion_feasible()
+                if insertion_feasible:
+                    if self.verify_insertion_check:
+                        self.verify_insertion_feasible()
+                    # only feasibility is requested and the moby fits into a committed route, no (further) solver run needed
+                    return group_id
             self.update()
             if build_paths:
                 self.build_paths()
@@ -631,22 +677,8 @@ class BusTour:
             logger.error('NoRouteException in add_moby: {}'.format(err))
 
             # reset data - if moby cannot be added successfully, all moby-specific data must be removed
-            self.locations = locations_old            
-            self.loads = loads_old
-            self.groups = groups_old   
-            self.time_windows = time_windows_old 
-            self._time_windows = _time_windows_old 
-
-            # remove moby from hop_on/off 
-            # (note: deepcopy of hop_on/off does not work, since internally the moby objects are compared by memory address, i.e. moby1==moby2)   
-
-            for hop in list(self.hop_ons.keys()):
-                if self.hop_ons[hop] == moby:  
-                       del self.hop_ons[hop]
-
-            for hop in list(self.hop_offs.keys()):
-                if self.hop_offs[hop] == moby:  
-                       del self.hop_offs[hop]            
+            self._rollback(snapshot)
+            self.time_windows = time_windows_old
 
             return None
         except Exception as err:
@@ -656,16 +688,40 @@ class BusTour:
         return group_id
         # return self._final_paths
 
-    def add_mobies(self, mobies:List[Moby])->None:
+    def _snapshot(self)->Tuple[int, int]:
+        """Current state of the tour: number of locations and length of the undo log."""
+        return len(self.locations), len(self._undo_log)
+
+    def _rollback(self, snapshot:Tuple[int, int])->None:
+        """Resets the tour to the snapshot: location data is truncated, the other changes are undone in reverse order."""
+        num_locations, num_undo = snapshot
+        for location_data in (self.locations, self.locations_connection, self.locations_arrival_fixed,
+                              self.locations_bus, self.loads, self._time_windows):
+            del location_data[num_locations:]
+
+        while len(self._undo_log) > num_undo:
+            self._undo_log.pop()()
+
+    def add_mobies(self, mobies:List[Moby], build_paths = True, *args, **kwargs)->Optional[List[str]]:
+        """Adds several mobies with one solver run, either all of them are added or none (None is returned)."""
         logger.debug(f'add_mobies mobies: {mobies}')
+
+        snapshot = self._snapshot()
+        time_windows_old = self.time_windows
         group_ids = []
         try:
             for moby in mobies:
-                group_ids.append(self._add_moby(moby))
+                group_ids.append(self._add_moby(moby, *args, **kwargs))
             self.update()
-            self.build_paths()
+            if build_paths:
+                self.build_paths()
         except NoRouteException as err:  
             logger.error('NoRouteException exception in add_mobies: {}'.format(err))
+
+            self._rollback(snapshot)
+            self.time_windows = time_windows_old
+
+            return None
         except Exception as err:
             logger.error('exception in add_mobies: {}'.format(err))
             raise err
@@ -689,6 +745,10 @@ class BusTour:
         self.locations.append(moby.start_station)
         self.locations.append(moby.stop_station)
 
+        bus_id = getattr(moby, 'bus_id', None) if promised else None
+        self.locations_bus.append(bus_id)
+        self.locations_bus.append(bus_id)
+
         # Check if route may not be possible
         try:
             self.time_matrix = self.calc_time_matrix(self.locations)
@@ -704,6 +764,10 @@ class BusTour:
 
         self.hop_ons[hop_on_idx] = moby
         self.hop_offs[hop_off_idx] = moby
+        self._undo_log.append(partial(self.hop_ons.pop, hop_on_idx, None))
+        self._undo_log.append(partial(self.hop_offs.pop, hop_off_idx, None))
+        self.pickups_deliveries.append((hop_on_idx, hop_off_idx))
+        self._undo_log.append(self.pickups_deliveries.pop)
 
         self.loads.append(moby.number_passengers) # moby picked up
         self.loads.append(-moby.number_passengers) # moby leaves bus
@@ -712,9 +776,11 @@ class BusTour:
             group = Group(location_ids=[], penalty=penalty)
             group_id = group.id
             self.groups[group.id] = group
+            self._undo_log.append(partial(self.groups.pop, group.id, None))
         else:
             assert(group_id in self.groups)
         self.groups[group_id].location_ids.append(hop_on_idx)
+        self._undo_log.append(self.groups[group_id].location_ids.pop)
 
         # TODO: traffic        
         t_min = int(duration_of_route+0.5)
@@ -731,6 +797,10 @@ class BusTour:
         timewindowwider = 0
         arrivalFixed = False
 
+        # preferred bound for the time window derived from slack
+        start_window_soft_lower = None
+        stop_window_soft_upper = None
+
         if not promised:
             timewindowwider = 0
 
@@ -741,6 +811,9 @@ class BusTour:
                 # 1. add not defined arrival window
                 moby.stop_window = moby.start_window[0], moby.start_window[1]+dT
 
+                if self._slack_soft is not None:
+                    stop_window_soft_upper = moby.start_window[1]+t_min+self._slack_soft
+
                 # 2. adjust departure window for connecting                
                 moby.start_window, connection_start = self.adjust_time_window_for_connecting_times(moby.start_window, moby.start_station, True)
             else:
@@ -750,6 +823,9 @@ class BusTour:
                 # 1. add not defined start window
                 moby.start_window = moby.stop_window[0]-dT, moby.stop_window[1]
 
+                if self._slack_soft is not None:
+                    start_window_soft_lower = moby.stop_window[0]-t_min-self._slack_soft
+
                 # verify that min time allowed is satisfied for new defined start window
                 if t_min_start_time_for_orders is not None and moby.start_window[0] < t_min_start_time_for_orders:
                     logger.debug('t_min_start_time_for_orders must be included in start window: {}'.format(moby.start_window))
@@ -774,6 +850,13 @@ class BusTour:
             self._time_windows.append((moby.start_window[0],moby.start_window[1]+timewindowwider))
             self._time_windows.append((moby.stop_window[0]-timewindowwider,moby.stop_window[1]+timewindowwider))
 
+        if start_window_soft_lower is not None and start_window_soft_lower > self._time_windows[hop_on_idx][0]:
+            self._time_windows_soft[hop_on_idx] = (start_window_soft_lower, None)
+            self._undo_log.append(partial(self._time_windows_soft.pop, hop_on_idx, None))
+        if stop_window_soft_upper is not None and stop_window_soft_upper < self._time_windows[hop_off_idx][1]:
+            self._time_windows_soft[hop_off_idx] = (None, stop_window_soft_upper)
+            self._undo_log.append(partial(self._time_windows_soft.pop, hop_off_idx, None))
+
         if connection_start:
             self.locations_connection.append('DepartureFixed')
         else:
@@ -887,6 +970,7 @@ class BusTour:
         self.locations.extend([station]*n_busses)
         self.locations_connection.extend(['']*n_busses)
         self.locations_arrival_fixed.extend([False]*n_busses)
+        self.locations_bus.extend([None]*n_busses)
         self.loads.extend([MobyLoad(0,0)]*n_busses)
         self._time_windows.extend([time_window]*n_busses)
         locations_ids = sorted(
@@ -905,19 +989,22 @@ class BusTour:
             raise ValueError(f'station hat not node_id, station data: {station}')
 
     def update(self)->None:
+        with timer.phase('model'):
+            self.build_model()
+        with timer.phase('solve'):
+            self.solve()
+
+    def build_model(self)->None:
 
         # transform windows into [0 inf] domain, we don't want  negative values
         self.time_windows:List[TimeWindow] = [(0, 0)]+self._time_windows[1:]
-        # adjust vehicle hours
-        vehicles = deepcopy(self.capacities)
-
         # Instantiate the data problem.
         self.data = DataProblem(
             self.locations,
             self.locations_arrival_fixed,
             self.time_windows,
             demands=self.loads,
-            capacities=vehicles)
+            capacities=self.capacities)
 
         # Create Routing Model
         self.routingIndexManager = pywrapcp.RoutingIndexManager(self.data.num_locations,
@@ -943,6 +1030,7 @@ class BusTour:
             import sys
             logger.error("Unexpected error:", sys.exc_info()[0])
             raise
+        self.check_deadline()
 
         # todo umbauen oder entfernen - beachten dass der Ortools-Optimierer nur mit Integer rechnet
         # self.distance_evaluator =\
@@ -952,16 +1040,18 @@ class BusTour:
         self.demand_evaluator = CreateDemandEvaluator(
             self.data)
         add_capacity_constraints(
-            self.routing, self.data, self.demand_evaluator.demand_evaluator_seats, self.demand_evaluator.demand_evaluator_wheelchairs, self.demand_evaluator.demand_evaluator_weighted_sum)
+            self.routing, self.data, self.demand_evaluator.demands_seats, self.demand_evaluator.demands_wheelchairs, self.demand_evaluator.demands_weighted_sum)
 
         # Add Time Window constraint
         self.time_evaluator = CreateTimeEvaluator(
             self.data, self.time_matrix, self.time_per_demand_unit_seat, self.time_per_demand_unit_wheelchair)
         add_time_window_constraints(
-            self.routing, self.routingIndexManager, self.data, self.time_evaluator.time_evaluator)
+            self.routing, self.routingIndexManager, self.data, self.time_evaluator.time_matrix)
+        add_soft_time_window_constraints(
+            self.routing, self.routingIndexManager, self._time_windows_soft, SLACK_SOFT_PENALTY)
         # Add pickup & delivery order constraint
         add_pickup_delivery_constraints(
-            self.routing, self.routingIndexManager, self.time_evaluator.time_evaluator, self.time_matrix, self.data, self.hop_ons, self.hop_offs)
+            self.routing, self.routingIndexManager, self.time_evaluator.time_evaluator, self.time_matrix, self.data, self.pickups_deliveries)
         # Assign intermediate stops
         add_mandatory_station_constraints(
             self.routing, self.routingIndexManager, self.data, self.stations)
@@ -973,7 +1063,7 @@ class BusTour:
             add_station_closing_time_constraints(self.routing, self.routingIndexManager, self.data, self.station_closing_times)
 
         # define our cost function
-        time_callback_index = self.routing.RegisterTransitCallback(self.time_evaluator.time_evaluator_weighted_demands)
+        time_callback_index = self.routing.RegisterTransitMatrix(self.time_evaluator.time_matrix_weighted)
         self.routing.SetArcCostEvaluatorOfAllVehicles(time_callback_index)
 
         # Setting first solution heuristic (cheapest addition).
@@ -983,17 +1073,311 @@ class BusTour:
             # routing_enums_pb2.FirstSolutionStrategy.LOCAL_CHEAPEST_INSERTION)
             routing_enums_pb2.FirstSolutionStrategy.PARALLEL_CHEAPEST_INSERTION)  # 4x faster
         # routing_enums_pb2.FirstSolutionStrategy.PATH_CHEAPEST_ARC)  # default
-        # Solve the problem.
-        logger.info('solve problem...')
-        self.assignment = self.routing.SolveWithParameters(self.search_parameters)
+        self.set_time_limit()
+        self.routing.CloseModelWithParameters(self.search_parameters)
+
+    def check_deadline(self)->None:
+        if self.deadline is not None and time.time() >= self.deadline:
+            raise NoRouteException('The optimizer ran out of time.')
+
+    def set_time_limit(self)->None:
+        """Search time limit of the solver: time_limit_seconds, but not beyond the deadline."""
+        time_limit = self.time_limit_seconds
+        if self.deadline is not None:
+            self.check_deadline()
+            time_remaining = self.deadline - time.time()
+            time_limit = min(time_limit, time_remaining) if time_limit else time_remaining
+        if time_limit:
+            self.search_parameters.time_limit.FromMilliseconds(max(1, int(time_limit * 1000)))
+
+    def solve(self)->None:
+        # Solve the problem, start from committed routes if possible - only the new request needs to be inserted
+        self.assignment = None
+        initial_assignment = self.initial_assignment()
+
+        if initial_assignment is not None:
+            logger.info('solve problem from committed routes...')
+            self.assignment = self.routing.SolveFromAssignmentWithParameters(initial_assignment, self.search_parameters)
+
+        if self.assignment is None:
+            logger.info('solve problem...')
+            # the search from committed routes took its share of the time
+            self.set_time_limit()
+            self.assignment = self.routing.SolveWithParameters(self.search_parameters)
         if self.assignment is None:
             logger.info('update: no solution found SolveWithParameters')
             raise NoRouteException
         else:
             logger.info('success update: SolveWithParameters')
 
+    def committed_routes(self)->Optional[Dict[BusIndex, List[LocationIndex]]]:
+        """Locations per vehicle in order of the committed routes, None if a promise fits no vehicle."""
+        routes: Dict[BusIndex, List[LocationIndex]] = {vehicle_idx: [] for vehicle_idx in range(self.data.num_vehicles)}
+
+        for pickup, delivery in self.pickups_deliveries:
+            bus_id = self.locations_bus[pickup]
+            if bus_id is None:
+                continue
+
+            time_start = self._time_windows[pickup][0]
+            time_stop = self._time_windows[delivery][1]
+
+            # a bus may be split into several vehicles (availability slots)
+            vehicles = [vehicle_idx for vehicle_idx, vehicle in enumerate(self.data.vehicles) if str(vehicle.id) == str(bus_id)]
+            if len(vehicles) == 0:
+                return None
+            vehicles_fitting = [vehicle_idx for vehicle_idx in vehicles
+                if self.data.vehicles[vehicle_idx].work_time[0] <= time_start and time_stop <= self.data.vehicles[vehicle_idx].work_time[1]]
+
+            routes[(vehicles_fitting or vehicles)[0]].extend([pickup, delivery])
+
+        for station in self.stations:
+            for bus_idx, location_idx in zip(station['bus_ids'], station['location_ids']):
+                routes[bus_idx].append(location_idx)
+
+        return routes
+
+    def initial_assignment(self)->Optional[pywrapcp.Assignment]:
+        """Initial solution: committed routes with the new mobies inserted by time into the first vehicle that allows it."""
+        if all(bus_id is None for bus_id in self.locations_bus):
+            return None
+
+        routes = self.committed_routes()
+        if routes is None:
+            return None
+
+        routed = set(location_idx for route in routes.values() for location_idx in route)
+        new_locations = [location_idx for location_idx in range(1, len(self.locations)) if not location_idx in routed]
+
+        def by_time(location_idx:LocationIndex):
+            return (self._time_windows[location_idx][0], location_idx)
+
+        for vehicle_idx in range(self.data.num_vehicles):
+            routes_tmp = []
+            for route_vehicle_idx in range(self.data.num_vehicles):
+                route = list(routes[route_vehicle_idx])
+                if route_vehicle_idx == vehicle_idx:
+                    route.extend(new_locations)
+                routes_tmp.append([self.routingIndexManager.NodeToIndex(location_idx) for location_idx in sorted(route, key=by_time)])
+
+            # returns None if the routes violate any constraint
+            assignment = self.routing.ReadAssignmentFromRoutes(routes_tmp, True)
+            if assignment is not None:
+                logger.debug(f'initial assignment from committed routes, new locations on vehicle {vehicle_idx}')
+                return assignment
+
+        logger.debug('no initial assignment from committed routes')
+        return None
+
+    def prune_promises(self, request:Moby, promises:Dict[int, Moby], bus_ids_fixed:List[BusID]=[])->Tuple[Dict[int, Moby], List[BusIndex]]:
+        """
+        Removes promises and vehicles that cannot interact with the request, must be called before mobies are added.
+        Promises are removed per committed route only (routes must not be split), if the route ends before the request can start
+        or starts after the request has finished (including travel times from/to the request). These routes stay as committed,
+        the work time of their vehicle is clipped to the remaining time instead.
+        Returns the remaining promises and the indices of the remaining vehicles within the original vehicles.
+        """
+        vehicle_indices = list(range(len(self.capacities)))
+        bus_ids_fixed = set(str(bus_id) for bus_id in bus_ids_fixed)
+        routes: Dict[Tuple[str, Any], List[int]] = defaultdict(list)
+        for promise_id, moby in promises.items():
+            bus_id = getattr(moby, 'bus_id', None)
+            route_id = getattr(moby, 'route_id', None)
+            if bus_id is None or route_id is None:
+                # assignment unknown, everything may interact
+                return promises, vehicle_indices
+            if not str(bus_id) in bus_ids_fixed:
+                routes[(str(bus_id), route_id)].append(promise_id)
+
+        route_first = {key: promises[min(ids, key=lambda promise_id: promises[promise_id].start_window[0])] for key, ids in routes.items()}
+        route_last = {key: promises[max(ids, key=lambda promise_id: promises[promise_id].stop_window[1])] for key, ids in routes.items()}
+
+        stations = ['Depot', request.start_station, request.stop_station]
+        stations += [moby.start_station for moby in route_first.values()] + [moby.stop_station for moby in route_last.values()]
+        try:
+            durations = self.calc_time_matrix(stations)
+        except Exception as err:
+            logger.warning(f'prune_promises: no time matrix, promises are not pruned ({err})')
+            return promises, vehicle_indices
+
+        # time span of all possible stops of the request, cf. _add_moby
+        dT = int(durations[request.start_station][request.stop_station]+0.5)+self._slack
+        if request.start_window is not None and request.stop_window is not None:
+            request_begin, request_end = request.start_window[0], request.stop_window[1]
+        elif request.start_window is not None:
+            request_begin, request_end = request.start_window[0], request.start_window[1]+dT
+        else:
+            request_begin, request_end = request.stop_window[0]-dT, request.stop_window[1]
+
+        # time span of routes (promise windows are widened by 1 in _add_moby)
+        route_span = {key: (route_first[key].start_window[0]-1, route_last[key].stop_window[1]+1) for key in routes}
+        routes_before = set()
+        routes_after = set()
+        for key in routes:
+            begin, end = route_span[key]
+            if end + durations[route_last[key].stop_station][request.start_station] <= request_begin:
+                routes_before.add(key)
+            elif request_end + durations[request.stop_station][route_first[key].start_station] <= begin:
+                routes_after.add(key)
+
+        # a removed route must not be between remaining routes of its bus, otherwise the remaining routes could be moved into it
+        bus_ids = set(key[0] for key in routes)
+        clip: Dict[str, TimeWindow] = {}
+        for bus_id in bus_ids:
+            keys_bus = [key for key in routes if key[0] == bus_id]
+            while True:
+                keys_kept = [key for key in keys_bus if not key in routes_before and not key in routes_after]
+                begin_kept = min([route_span[key][0] for key in keys_kept], default=STNIMMERLEIN)
+                end_kept = max([route_span[key][1] for key in keys_kept], default=-STNIMMERLEIN)
+                keys_moved = [key for key in keys_bus if (key in routes_before and route_span[key][1] > begin_kept)
+                    or (key in routes_after and route_span[key][0] < end_kept)]
+                if len(keys_moved) == 0:
+                    break
+                routes_before.difference_update(keys_moved)
+                routes_after.difference_update(keys_moved)
+            clip[bus_id] = (max([route_span[key][1] for key in keys_bus if key in routes_before], default=-STNIMMERLEIN),
+                            min([route_span[key][0] for key in keys_bus if key in routes_after], default=STNIMMERLEIN))
+
+        routes_removed = routes_before | routes_after
+        promises_kept = {promise_id: moby for promise_id, moby in promises.items() if not (str(moby.bus_id), moby.route_id) in routes_removed}
+
+        vehicle_indices = []
+        for vehicle_idx, vehicle in enumerate(self.capacities):
+            bus_id = str(vehicle.id)
+            if vehicle.work_time is None:
+                vehicle_indices.append(vehicle_idx)
+                continue
+            if bus_id in clip:
+                vehicle = copy(vehicle) # vehicles of the caller must not be changed
+                self.capacities[vehicle_idx] = vehicle
+                vehicle.work_time = (max(vehicle.work_time[0], clip[bus_id][0]), min(vehicle.work_time[1], clip[bus_id][1]))
+            work_begin, work_end = vehicle.work_time
+
+            routes_kept = [key for key in routes if key[0] == bus_id and not key in routes_removed
+                and route_span[key][0] <= work_end and work_begin <= route_span[key][1]]
+            if bus_id in bus_ids_fixed or len(routes_kept) > 0 or (work_begin <= work_end and work_begin <= request_end and request_begin <= work_end):
+                vehicle_indices.append(vehicle_idx)
+
+        logger.info(f'prune_promises: {len(promises)-len(promises_kept)} of {len(promises)} promises and {len(self.capacities)-len(vehicle_indices)} of {len(self.capacities)} vehicles removed')
+        self.capacities = [self.capacities[vehicle_idx] for vehicle_idx in vehicle_indices]
+        return promises_kept, vehicle_indices
+
+    def insertion_feasible(self)->bool:
+        """
+        Fast check if the new mobies can be inserted into one committed route (order of the route is kept).
+        Checks time windows, work times, capacities and max travel times with the earliest arrival times.
+        False does not mean that there is no solution, the solver has to decide then.
+        """
+        # every moby has its own group, only groups of several mobies are not modelled here
+        if self.station_closing_times or any(len(group.location_ids) > 1 for group in self.groups.values()):
+            return False
+
+        try:
+            self.time_matrix = self.calc_time_matrix(self.locations)
+        except Exception as err:
+            logger.debug(f'insertion_feasible: no time matrix ({err})')
+            return False
+
+        self.data = DataProblem(
+            self.locations,
+            self.locations_arrival_fixed,
+            [(0, 0)]+self._time_windows[1:],
+            demands=self.loads,
+            capacities=self.capacities)
+
+        routes = self.committed_routes()
+        if routes is None:
+            return False
+
+        routed = set(location_idx for route in routes.values() for location_idx in route)
+        new_locations = [location_idx for location_idx in range(1, len(self.locations)) if not location_idx in routed]
+        if len(new_locations) != 2 or self.hop_ons.get(new_locations[0]) is None:
+            return False
+        pickup, delivery = new_locations
+
+        try:
+            demand_evaluator = CreateDemandEvaluator(self.data)
+        except ValueError:
+            return False
+        time_matrix = CreateTimeEvaluator(
+            self.data, self.time_matrix, self.time_per_demand_unit_seat, self.time_per_demand_unit_wheelchair).time_matrix
+
+        def by_time(location_idx:LocationIndex):
+            return (self._time_windows[location_idx][0], location_idx)
+
+        for vehicle_idx, vehicle in enumerate(self.data.vehicles):
+            route = sorted(routes[vehicle_idx], key=by_time)
+            for idx_pickup in range(0, len(route)+1):
+                for idx_delivery in range(idx_pickup, len(route)+1):
+                    route_tmp = route[:idx_pickup] + [pickup] + route[idx_pickup:idx_delivery] + [delivery] + route[idx_delivery:]
+                    if self._route_feasible(vehicle, route_tmp, time_matrix, demand_evaluator):
+                        logger.info(f'insertion_feasible: new moby fits into committed route of vehicle {vehicle_idx}')
+                        return True
+
+        logger.debug('insertion_feasible: no insertion into committed routes found')
+        return False
+
+    def verify_insertion_feasible(self)->None:
+        """Runs the solver for an insertion found by insertion_feasible, raises NoRouteException if the solver disagrees."""
+        try:
+            self.update()
+        except NoRouteException:
+            logger.error('insertion_feasible: insertion found, but the solver has no solution')
+            raise
+        logger.debug('insertion_feasible: insertion confirmed by the solver')
+
+    def _route_feasible(self, vehicle:Vehicle, route:List[LocationIndex], time_matrix:List[List[int]], demand_evaluator:CreateDemandEvaluator)->bool:
+        """Checks the constraints of the solver for one route, times are the earliest arrival times."""
+        capacity = vehicle.capacity
+        capacity_weighted = (2-capacity.seatsBlockedPerWheelchair)*capacity.maxNumWheelchairs+capacity.maxNumStandardSeats
+        load_seats = 0
+        load_wheelchairs = 0
+        load_weighted_sum = 0
+        arrivals: Dict[LocationIndex, int] = {}
+        order: Dict[LocationIndex, int] = {}
+
+        # travel times from depot are zero, vehicle starts within its work time
+        time = vehicle.work_time[0]
+        location_prev = self.data.depot
+        for location_idx in route:
+            time_window = self.data.time_windows[location_idx]
+            time = max(time + time_matrix[location_prev][location_idx], time_window[0])
+            if time > time_window[1]:
+                return False
+
+            load_seats += demand_evaluator.demands_seats[location_idx]
+            load_wheelchairs += demand_evaluator.demands_wheelchairs[location_idx]
+            load_weighted_sum += demand_evaluator.demands_weighted_sum[location_idx]
+            if load_seats > capacity.maxNumStandardSeats or load_wheelchairs > capacity.maxNumWheelchairs\
+                    or load_weighted_sum > capacity_weighted:
+                return False
+
+            arrivals[location_idx] = time
+            order[location_idx] = len(order)
+            location_prev = location_idx
+
+        if time > vehicle.work_time[1]:
+            return False
+
+        # max travel times, see add_pickup_delivery_constraints
+        for pickup, delivery in self.pickups_deliveries:
+            if not pickup in arrivals:
+                continue
+            if order[delivery] < order[pickup]:
+                return False
+            time_travel_min = int(self.time_matrix[self.locations[pickup]][self.locations[delivery]]+0.5)
+            delta_allowed = max(15, time_travel_min)
+            if arrivals[delivery] > arrivals[pickup] + int(time_matrix[pickup][delivery]+0.5) + delta_allowed:
+                return False
+
+        return True
+
     def build_paths(self)->None:
         """Build complete paths."""
+        with timer.phase('paths'):
+            self._build_paths()
+
+    def _build_paths(self)->None:
         if self.assignment is None:
             logger.warning('build_paths: no solution found')
             raise NoRouteException
@@ -1188,14 +1572,25 @@ def new_routing(G: nx.DiGraph, ORSM_url: str, request: Moby, promises: dict[int,
 
     slack_max = options['slack']
     
-    tour = BusTour(G, ORSM_url, time_offset_factor=options['time_offset_factor'], time_per_demand_unit_wheelchair=options['time_service_per_wheelchair'], slack=slack_max, capacities=busses)
+    tour = BusTour(G, ORSM_url, time_offset_factor=options['time_offset_factor'], time_per_demand_unit_wheelchair=options['time_service_per_wheelchair'], slack=slack_max, capacities=busses, G_fallback=options.get('fallback_graph'))
     
     #print(apriori_times_matrix)
     tour.time_matrix_save = apriori_times_matrix # this may boost performance considerably
+    tour.time_limit_seconds = options.get('time_limit_seconds')
+    tour.deadline = options.get('deadline')
+
+    # only promises that can interact with the request are part of the problem, the other ones stay in their routes
+    vehicle_indices = list(range(len(busses)))
+    if options.get('prune_promises', False) and len(promises) > 0:
+        bus_ids_fixed = [bus_id for station in mandatory_stations for bus_id in station.bus_ids]
+        promises, vehicle_indices = tour.prune_promises(request, promises, bus_ids_fixed)
+        if len(vehicle_indices) == 0:
+            logger.debug('new_routing - no vehicle left after pruning promises')
+            return None
 
     for station in mandatory_stations:
         # transform bus identifiers into bus indices within the problem domain
-        bus_indices = [i for i,bus in enumerate(busses) if bus.id in station.bus_ids]
+        bus_indices = [i for i,bus in enumerate(tour.capacities) if bus.id in station.bus_ids]
         # add stations without tour update, bc speed
         tour._add_station(station.station, station.time_window, bus_indices)
 
@@ -1209,8 +1604,7 @@ def new_routing(G: nx.DiGraph, ORSM_url: str, request: Moby, promises: dict[int,
     else:
         promised = False
 
-    # increase slack stepwise and start with low slack
-    # do not increase number of steps too much if performance is an issue
+    # slack is increased stepwise: the model is built with the max slack, times beyond the lowest slack are penalized
     slackValues = []
     slackSteps = 3    
     if 'sleck_steps' in options.keys():
@@ -1234,25 +1628,49 @@ def new_routing(G: nx.DiGraph, ORSM_url: str, request: Moby, promises: dict[int,
     else:
         build_paths = True
 
-    for slack in slackValues:
-        tour.set_slack(slack)
-        logger.debug('new_routing - slack iteration with slack {} and moby {}'.format(slack, request))
-        logger.debug(f'request.start_station.node_id={request.start_station.node_id}')
-        logger.debug(f'request.stop_station.node_id={request.stop_station.node_id}')
-        tour_id = tour.add_moby(request, build_paths=build_paths, promised=promised, t_min_start_time_for_orders=t_min_start_time_for_orders)  
+    if len(slackValues) > 1:
+        tour.set_slack_soft(slackValues[0])
 
-        if not(tour_id is None):
-            logger.debug(f'break if not(tour_id is None)')
-            break
-        else:
-            logger.debug(f'tour_id is None - time windows must remain unchanged')
-            # time windows must remain unchanged
-            request.start_window = time_window_start_old
-            request.stop_window = time_window_stop_old
+    logger.debug('new_routing - slack {}, preferred slack {} and moby {}'.format(slack_max, tour._slack_soft, request))
+    logger.debug(f'request.start_station.node_id={request.start_station.node_id}')
+    logger.debug(f'request.stop_station.node_id={request.stop_station.node_id}')
+    tour_id = tour.add_moby(request, build_paths=build_paths, promised=promised, t_min_start_time_for_orders=t_min_start_time_for_orders)  
+
+    if tour_id is None:
+        logger.debug(f'tour_id is None - time windows must remain unchanged')
+        # time windows must remain unchanged
+        request.start_window = time_window_start_old
+        request.stop_window = time_window_stop_old
 
     apriori_times_matrix = tour.time_matrix_save
 
     if tour_id is None:
         logger.debug(f'tour_id is None')
         return None
+    # routes are indexed by the busses of the caller
+    return tour, {vehicle_indices[vehicle_idx]: route for vehicle_idx, route in tour.get_routes().items()}
+
+def new_routing_batch(G: nx.DiGraph, ORSM_url: str, requests: List[Moby], promises: dict[int, Moby], mandatory_stations, busses, t_min_start_time_for_orders, options, apriori_times_matrix = {}):
+    """ Solve a routing problem with several new requests in one functional call, all requests are inserted or none. """
+    if len(busses) == 0:
+        raise ValueError("Can't find a route without busses!")
+
+    tour = BusTour(G, ORSM_url, time_offset_factor=options['time_offset_factor'], time_per_demand_unit_wheelchair=options['time_service_per_wheelchair'], slack=options['slack'], capacities=busses, G_fallback=options.get('fallback_graph'))
+    tour.time_matrix_save = apriori_times_matrix
+    tour.time_limit_seconds = options.get('time_limit_seconds')
+    tour.deadline = options.get('deadline')
+
+    for station in mandatory_stations:
+        bus_indices = [i for i,bus in enumerate(tour.capacities) if bus.id in station.bus_ids]
+        tour._add_station(station.station, station.time_window, bus_indices)
+
+    for promise_id, moby in promises.items():
+        logger.debug(f'add promise {promise_id}: {moby}')
+        tour._add_moby(moby, promised=True)
+
+    logger.debug(f'new_routing_batch - slack {options["slack"]} and {len(requests)} mobies')
+    group_ids = tour.add_mobies(requests, build_paths=options.get('build_paths', True), t_min_start_time_for_orders=t_min_start_time_for_orders)
+
+    if group_ids is None:
+        return None
     return tour, tour.get_routes()
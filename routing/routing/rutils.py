@@ -225,6 +225,43 @@ def durations_matrix_graph(stations:list, G: nx.DiGraph, time_offset_factor: flo
 
     return matrix_dict
 
+def stations_in_graph(stations:list, G: nx.DiGraph)->dict:
+    """
+    Map stations to copies whose node_id is a node of graph G (e.g. OSRM stations on the fallback graph).
+    Stations keep their node_id if G knows it, otherwise the nearest graph node of their gps position is used.
+    """
+    result = {}
+
+    for station in stations:
+        if station in result:
+            continue
+        if station == 'Depot':
+            result[station] = station
+            continue
+
+        node_id = station.node_id
+        if node_id is None or not str(node_id) in G:
+            if station.latitude == None or station.longitude == None:
+                raise ValueError(f'Station cannot be matched to graph without node_id or long/lat! Station data:{station}')
+            node_id = nearest_from_gps(G, longitude=station.longitude, latitude=station.latitude, n_nearests=1)[0]
+        result[station] = Station(str(node_id), station.longitude, station.latitude, station.name)
+
+    return result
+
+def durations_matrix_graph_fallback(stations:list, G: nx.DiGraph, time_offset_factor: float, time_matrix_apriori:dict[dict[int]])->dict:
+    """
+    Same result as durations_matrix_OSRM (keyed by the given stations) but computed on graph G,
+    used if OSRM is not available.
+    """
+    stations_graph = stations_in_graph(stations, G)
+    matrix_graph = durations_matrix_graph(tuple(stations_graph[station] for station in stations), G, time_offset_factor, time_matrix_apriori)
+
+    matrix_dict = {}
+    for from_node in stations:
+        row_graph = matrix_graph[stations_graph[from_node]]
+        matrix_dict[from_node] = {to_node: row_graph[stations_graph[to_node]] for to_node in stations}
+    return matrix_dict
+
 def shortest_path_graph_nodes(G: nx.DiGraph, start: any, stop: any, method = 'dijkstra')->List:
     """
     Create a path object from start to stop with meta information.
@@ -0,0 +1,111 @@
+"""
+ Copyright  2025 IAV GmbH Ingenieurgesellschaft Auto und Verkehr, All Rights Reserved.
+ 
+ Licensed under the Apache License, Version 2.0 (the "License");
+ you may not use this file except in compliance with the License.
+ You may obtain a copy of the License at
+ 
+ http://www.apache.org/licenses/LICENSE-2.0
+ 
+ Unless required by applicable law or agreed to in writing, software
+ distributed under the License is distributed on an "AS IS" BASIS,
+ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ See the License for the specific language governing permissions and
+ limitations under the License.
+ 
+ SPDX-License-Identifier: Apache-2.0
+"""
+import os
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager, nullcontext
+
+import logging
+logger = logging.getLogger('routing.timing')
+
+# upper bounds of the histogram buckets in ms, the last bucket is open
+BUCKETS_MS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000)
+
+
+class PhaseTimer:
+    """Measures the durations of the phases of a request and aggregates a histogram per phase.
+
+    Phases may be nested, e.g. the time matrix is part of the model build. If the timer is
+    disabled, phase() returns a shared no-op context, i.e. instrumented code has almost no overhead.
+    """
+
+    def __init__(self, enabled: bool = False):
+        self.enabled = enabled
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._histograms = {}
+        self._null_context = nullcontext({})
+
+    def phase(self, name: str):
+        """Context that measures one phase."""
+        if not self.enabled:
+            return self._null_context
+        return self._phase(name)
+
+    @contextmanager
+    def _phase(self, name: str):
+        time_start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, (time.perf_counter()-time_start)*1000.0)
+
+    def request(self):
+        """Context that collects the durations (ms) of all phases within the current thread, yields a dict phase -> duration."""
+        if not self.enabled:
+            return self._null_context
+        return self._request()
+
+    @contextmanager
+    def _request(self):
+        timings_outer = getattr(self._local, 'timings', None)
+        timings = {}
+        self._local.timings = timings
+        try:
+            yield timings
+        finally:
+            self._local.timings = timings_outer
+
+    def record(self, name: str, duration_ms: float):
+        timings = getattr(self._local, 'timings', None)
+        if timings is not None:
+            timings[name] = timings.get(name, 0.0) + duration_ms
+
+        with self._lock:
+            histogram = self._histograms.get(name)
+            if histogram is None:
+                histogram = {'count': 0, 'sum_ms': 0.0, 'max_ms': 0.0, 'buckets': [0]*(len(BUCKETS_MS)+1)}
+                self._histograms[name] = histogram
+            histogram['count'] += 1
+            histogram['sum_ms'] += duration_ms
+            histogram['max_ms'] = max(histogram['max_ms'], duration_ms)
+            histogram['buckets'][bisect_left(BUCKETS_MS, duration_ms)] += 1
+
+    def reset(self):
+        with self._lock:
+            self._histograms = {}
+
+    def metrics(self) -> dict:
+        """Histograms per phase, bucket i counts durations <= buckets_ms[i] (last bucket: larger)."""
+        with self._lock:
+            phases = {name: {'count': histogram['count'],
+                             'sum_ms': round(histogram['sum_ms'], 1),
+                             'max_ms': round(histogram['max_ms'], 1),
+                             'buckets': list(histogram['buckets'])}
+                      for name, histogram in self._histograms.items()}
+
+        return {'enabled': self.enabled, 'buckets_ms': list(BUCKETS_MS), 'phases': phases}
+
+    @staticmethod
+    def format(timings: dict) -> str:
+        return ', '.join(f'{name}={duration_ms:.1f}' for name, duration_ms in timings.items())
+
+
+# timer of the process, measurements are switched on by environment
+timer = PhaseTimer(enabled=os.environ.get('ROUTING_TIMING', 'no') == 'yes')
@@ -23,6 +23,7 @@ setup(name='routing',
       packages=['routing'],
       install_requires=[
           'networkx',
+          'numpy',
           'ortools',
           'shapely',
       ],
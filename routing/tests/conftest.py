@@ -0,0 +1,55 @@
+"""
+ Copyright  2025 IAV GmbH Ingenieurgesellschaft Auto und Verkehr, All Rights Reserved.
+ 
+ Licensed under the Apache License, Version 2.0 (the "License");
+ you may not use this file except in compliance with the License.
+ You may obtain a copy of the License at
+ 
+ http://www.apache.org/licenses/LICENSE-2.0
+ 
+ Unless required by applicable law or agreed to in writing, software
+ distributed under the License is distributed on an "AS IS" BASIS,
+ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ See the License for the specific language governing permissions and
+ limitations under the License.
+ 
+ SPDX-License-Identifier: Apache-2.0
+"""
+import networkx as nx
+import pytest
+
+from routing.routingClasses import Moby, MobyLoad, Station, Vehicle, VehicleCapacity
+
+
+@pytest.fixture
+def graph():
+    """ stations 1..5 on a line, 10 min between neighbours """
+    G = nx.DiGraph()
+    for i in range(1, 5):
+        G.add_edge(str(i), str(i+1), length=6000, maxspeed='36')
+        G.add_edge(str(i+1), str(i), length=6000, maxspeed='36')
+    return G
+
+
+@pytest.fixture
+def stations():
+    # time matrices are keyed by the station objects, all mobies of a test share them
+    return {i: Station(str(i)) for i in range(1, 6)}
+
+
+@pytest.fixture
+def options():
+    return {'slack': 10, 'time_offset_factor': 1.0, 'time_service_per_wheelchair': 0, 'time_limit_seconds': 1}
+
+
+def make_bus(work_time=(0, 1000), seats=4):
+    return Vehicle(VehicleCapacity(seats, 0), work_time)
+
+
+def make_promise(stations, start, stop, time_start, bus_id, route_id, load=1):
+    """ promise of a committed route, 10 min per station """
+    time_stop = time_start + 10*abs(stop-start)
+    moby = Moby(stations[start], stations[stop], (time_start, time_start+5), (time_stop, time_stop+5), MobyLoad(load, 0))
+    moby.bus_id = bus_id
+    moby.route_id = route_id
+    return moby
@@ -0,0 +1,141 @@
+"""
+ Copyright  2025 IAV GmbH Ingenieurgesellschaft Auto und Verkehr, All Rights Reserved.
+ 
+ Licensed under the Apache License, Version 2.0 (the "License");
+ you may not use this file except in compliance with the License.
+ You may obtain a copy of the License at
+ 
+ http://www.apache.org/licenses/LICENSE-2.0
+ 
+ Unless required by applicable law or agreed to in writing, software
+ distributed under the License is distributed on an "AS IS" BASIS,
+ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ See the License for the specific language governing permissions and
+ limitations under the License.
+ 
+ SPDX-License-Identifier: Apache-2.0
+"""
+import threading
+import time
+
+from routing.OSRM_directions import CircuitBreaker, OSRM
+
+
+def tripped_breaker(cooldown_seconds=0.05):
+    breaker = CircuitBreaker(failure_threshold=2, slow_call_seconds=1.0, cooldown_seconds=cooldown_seconds)
+    breaker.record_failure('timeout')
+    breaker.record_failure('timeout')
+    return breaker
+
+
+def test_breaker_opens_after_threshold():
+    breaker = CircuitBreaker(failure_threshold=2, cooldown_seconds=60)
+    breaker.record_failure('timeout')
+    assert breaker.state == CircuitBreaker.CLOSED
+    breaker.record_failure('timeout')
+    assert breaker.state == CircuitBreaker.OPEN
+    assert not breaker.allow_request()
+    assert breaker.metrics()['trips'] == 1
+    assert breaker.metrics()['rejected_calls'] == 1
+
+
+def test_slow_call_counts_as_failure():
+    breaker = CircuitBreaker(failure_threshold=1, slow_call_seconds=1.0, cooldown_seconds=60)
+    breaker.record_success(0.5)
+    assert breaker.state == CircuitBreaker.CLOSED
+    breaker.record_success(1.5)
+    assert breaker.state == CircuitBreaker.OPEN
+    assert breaker.metrics()['slow_calls'] == 1
+
+
+def test_half_open_admits_single_probe():
+    breaker = tripped_breaker()
+    time.sleep(0.1)
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+
+    barrier = threading.Barrier(8)
+    admitted = []
+    def call():
+        barrier.wait()
+        admitted.append(breaker.allow_request())
+    threads = [threading.Thread(target=call) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert admitted.count(True) == 1
+    # the other callers are rejected while the probe runs
+    assert not breaker.allow_request()
+
+
+def test_probe_success_closes_breaker():
+    breaker = tripped_breaker()
+    time.sleep(0.1)
+    assert breaker.allow_request()
+    breaker.record_success(0.1)
+    assert breaker.state == CircuitBreaker.CLOSED
+    assert breaker.allow_request()
+    assert breaker.allow_request()
+
+
+def test_probe_failure_reopens_breaker():
+    breaker = tripped_breaker()
+    time.sleep(0.1)
+    assert breaker.allow_request()
+    breaker.record_failure('timeout')
+    assert breaker.state == CircuitBreaker.OPEN
+    assert not breaker.allow_request()
+    assert breaker.metrics()['trips'] == 2
+
+
+def test_released_probe_admits_next_probe():
+    breaker = tripped_breaker()
+    time.sleep(0.1)
+    assert breaker.allow_request()
+    assert not breaker.allow_request()
+    breaker.release_probe()
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    assert breaker.allow_request()
+
+
+def test_release_probe_of_other_thread_is_ignored():
+    breaker = tripped_breaker()
+    time.sleep(0.1)
+    assert breaker.allow_request()
+    thread = threading.Thread(target=breaker.release_probe)
+    thread.start()
+    thread.join()
+    assert not breaker.allow_request()
+
+
+def test_recording_starts_from_client_state_and_replays():
+    worker = CircuitBreaker(failure_threshold=2, cooldown_seconds=60)
+    with worker.recording(CircuitBreaker.OPEN) as events:
+        assert not worker.allow_request()
+        worker.record_fallback('matrix')
+    assert events == [('fallback', 'matrix')]
+
+    with worker.recording(CircuitBreaker.CLOSED) as events:
+        assert worker.allow_request()
+        worker.record_failure('timeout')
+        worker.record_failure('timeout')
+    assert events == [('failure', 'timeout'), ('failure', 'timeout')]
+    # calls outside of a recording are not collected
+    worker.record_failure('timeout')
+    assert len(events) == 2
+
+    client = CircuitBreaker(failure_threshold=2, cooldown_seconds=60)
+    client.replay(events)
+    assert client.state == CircuitBreaker.OPEN
+    assert client.metrics()['failures'] == 2
+
+
+def test_latency_budget_remaining():
+    assert OSRM.budget_remaining() is None
+    with OSRM.latency_budget(10):
+        assert 9 < OSRM.budget_remaining() <= 10
+        with OSRM.latency_budget(60):
+            # nested budgets cannot extend the deadline
+            assert OSRM.budget_remaining() <= 10
+    assert OSRM.budget_remaining() is None
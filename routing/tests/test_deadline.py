@@ -0,0 +1,80 @@
+"""
+ Copyright  2025 IAV GmbH Ingenieurgesellschaft Auto und Verkehr, All Rights Reserved.
+ 
+ Licensed under the Apache License, Version 2.0 (the "License");
+ you may not use this file except in compliance with the License.
+ You may obtain a copy of the License at
+ 
+ http://www.apache.org/licenses/LICENSE-2.0
+ 
+ Unless required by applicable law or agreed to in writing, software
+ distributed under the License is distributed on an "AS IS" BASIS,
+ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ See the License for the specific language governing permissions and
+ limitations under the License.
+ 
+ SPDX-License-Identifier: Apache-2.0
+"""
+import time
+
+import pytest
+from ortools.constraint_solver import pywrapcp
+
+from routing.errors import NoRouteException
+from routing.routing import BusTour, new_routing
+from routing.routingClasses import Moby
+
+from conftest import make_bus, make_promise
+
+
+def make_tour(graph, vehicles):
+    return BusTour(graph, None, vehicles, time_offset_factor=1.0, time_per_demand_unit_wheelchair=0, slack=10)
+
+
+def test_check_deadline(graph):
+    tour = make_tour(graph, [make_bus()])
+    tour.check_deadline()
+    tour.deadline = time.time() + 60
+    tour.check_deadline()
+    tour.deadline = time.time() - 1
+    with pytest.raises(NoRouteException):
+        tour.check_deadline()
+
+
+def test_time_limit_cut_to_deadline(graph):
+    tour = make_tour(graph, [make_bus()])
+    tour.search_parameters = pywrapcp.DefaultRoutingSearchParameters()
+    tour.time_limit_seconds = 10
+    tour.set_time_limit()
+    assert tour.search_parameters.time_limit.ToMilliseconds() == 10000
+
+    tour.deadline = time.time() + 0.5
+    tour.set_time_limit()
+    assert 0 < tour.search_parameters.time_limit.ToMilliseconds() <= 500
+
+    tour.time_limit_seconds = None
+    tour.set_time_limit()
+    assert 0 < tour.search_parameters.time_limit.ToMilliseconds() <= 500
+
+    tour.deadline = time.time() - 1
+    with pytest.raises(NoRouteException):
+        tour.set_time_limit()
+
+
+def test_new_routing_within_deadline(graph, stations, options):
+    bus = make_bus()
+    request = Moby(stations[2], stations[3], (110, 115), None)
+    result = new_routing(graph, None, request, {1: make_promise(stations, 1, 4, 100, bus.id, 1)}, [], [bus], None, dict(options, deadline=time.time()+30))
+    assert result is not None
+    _, routes = result
+    assert [node.map_id for node in routes[0]] == ['Depot', '1', '2', '3', '4', 'Depot']
+
+
+def test_new_routing_deadline_expired(graph, stations, options):
+    bus = make_bus()
+    request = Moby(stations[2], stations[3], (110, 115), None)
+    result = new_routing(graph, None, request, {1: make_promise(stations, 1, 4, 100, bus.id, 1)}, [], [bus], None, dict(options, deadline=time.time()-1))
+    assert result is None
+    # the request is unchanged, i.e. it can be solved again
+    assert request.start_window == (110, 115)
+    assert request.stop_window is None
@@ -0,0 +1,45 @@
+"""
+ Copyright  2025 IAV GmbH Ingenieurgesellschaft Auto und Verkehr, All Rights Reserved.
+ 
+ Licensed under the Apache License, Version 2.0 (the "License");
+ you may not use this file except in compliance with the License.
+ You may obtain a copy of the License at
+ 
+ http://www.apache.org/licenses/LICENSE-2.0
+ 
+ Unless required by applicable law or agreed to in writing, software
+ distributed under the License is distributed on an "AS IS" BASIS,
+ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ See the License for the specific language governing permissions and
+ limitations under the License.
+ 
+ SPDX-License-Identifier: Apache-2.0
+"""
+from routing.polyline import SEPARATOR, decode_polyline, encode_polyline
+
+
+def test_encode_reference_example():
+    # example of the polyline algorithm with coordinates in 1e-5 degrees
+    points = [(3850000, -12020000), (4070000, -12095000), (4325200, -12645300)]
+    assert encode_polyline(points) == '_p~iF~ps|U_ulLnnqC_mqNvxq`@'
+    assert decode_polyline('_p~iF~ps|U_ulLnnqC_mqNvxq`@', 2) == points
+
+
+def test_round_trip_path_nodes():
+    # map id, epoch time and width of the time window as stored for the path nodes of routes
+    points = [(8229013941, 1760864400, 300), (26904871, 1760864460, 300), (8229013941, 1760864400, 0), (0, 1760864520, 600)]
+    encoded = encode_polyline(points)
+    assert decode_polyline(encoded, 3) == points
+    assert SEPARATOR not in encoded
+
+
+def test_round_trip_single_and_empty():
+    assert decode_polyline(encode_polyline([(-1, 0, 1)]), 3) == [(-1, 0, 1)]
+    assert encode_polyline([]) == ''
+    assert decode_polyline('', 3) == []
+
+
+def test_legs_joined_by_separator():
+    legs = [[(1, 100, 5), (2, 160, 5)], [(2, 160, 5), (3, 220, 0)]]
+    encoded = SEPARATOR.join(encode_polyline(leg) for leg in legs)
+    assert [decode_polyline(leg, 3) for leg in encoded.split(SEPARATOR)] == legs
@@ -0,0 +1,103 @@
+"""
+ Copyright  2025 IAV GmbH Ingenieurgesellschaft Auto und Verkehr, All Rights Reserved.
+ 
+ Licensed under the Apache License, Version 2.0 (the "License");
+ you may not use this file except in compliance with the License.
+ You may obtain a copy of the License at
+ 
+ http://www.apache.org/licenses/LICENSE-2.0
+ 
+ Unless required by applicable law or agreed to in writing, software
+ distributed under the License is distributed on an "AS IS" BASIS,
+ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ See the License for the specific language governing permissions and
+ limitations under the License.
+ 
+ SPDX-License-Identifier: Apache-2.0
+"""
+from types import SimpleNamespace
+
+from routing.promises import PromiseIndex
+
+
+def make_order(uid, route, hop_on, hop_off, load=1):
+    """ order with the attributes used by the index, times are (tMin, tMax) """
+    def node(mapId, times):
+        return SimpleNamespace(mapId=mapId, tMin=times[0], tMax=times[1], latitude=None, longitude=None, route=route)
+    return SimpleNamespace(uid=uid, hopOnNode=node(1, hop_on), hopOffNode=node(2, hop_off), load=load, loadWheelchair=0)
+
+
+def make_route(route_id, bus_uid, status='BOK'):
+    return SimpleNamespace(id=route_id, bus=SimpleNamespace(uid=bus_uid), status=status)
+
+
+ROUTE_A1 = make_route(1, 'a')
+ROUTE_A2 = make_route(2, 'a')
+ROUTE_B = make_route(3, 'b')
+
+
+def make_index():
+    return PromiseIndex(5, [
+        make_order('o1', ROUTE_A1, (100, 110), (130, 140)),
+        make_order('o2', ROUTE_A1, (120, 125), (150, 160)),
+        make_order('o3', ROUTE_A2, (300, 310), (330, 340)),
+        make_order('o4', ROUTE_B, (105, 115), (135, 145)),
+    ])
+
+
+def test_query_by_bus_and_interval():
+    index = make_index()
+    assert index.version == 5
+    assert set(index.query(['a'], 0, 200, 0)) == {'o1', 'o2'}
+    assert set(index.query(['a', 'b'], 0, 200, 0)) == {'o1', 'o2', 'o4'}
+    assert set(index.query(['a'], 0, 400, 0)) == {'o1', 'o2', 'o3'}
+    assert index.query(['a'], 200, 299, 0) == {}
+    assert index.query(['c'], 0, 400, 0) == {}
+
+
+def test_query_interval_bounds():
+    index = make_index()
+    # hop on windows must lie within the shift, a route is selected by any of its orders
+    assert set(index.query(['a'], 120, 200, 0)) == {'o1', 'o2'}
+    assert index.query(['a'], 120, 124, 0) == {}
+    assert set(index.query(['a'], 300, 310, 0)) == {'o3'}
+
+
+def test_query_drops_finished_orders():
+    index = make_index()
+    assert set(index.query(['a'], 0, 200, 145)) == {'o2'}
+    assert index.query(['a'], 0, 200, 160) == {}
+
+
+def test_query_returns_copies():
+    index = make_index()
+    promise = index.query(['b'], 0, 200, 0)['o4']
+    assert promise['route_id'] == 3 and promise['bus_uid'] == 'b'
+    assert promise['start'] == (1, (105, 115)) and promise['stop'] == (2, (135, 145))
+    promise['load'] = 99
+    assert index.query(['b'], 0, 200, 0)['o4']['load'] == 1
+
+
+def test_update_routes_replaces_orders_of_route():
+    index = make_index()
+    # o2 was cancelled, o5 added to route 1
+    index.update_routes([1], [make_order('o1', ROUTE_A1, (100, 110), (130, 140)), make_order('o5', ROUTE_A1, (180, 185), (190, 195))])
+    assert set(index.query(['a'], 0, 200, 0)) == {'o1', 'o5'}
+
+
+def test_update_routes_deleted_route():
+    index = make_index()
+    index.update_routes([2], [])
+    assert set(index.query(['a'], 0, 400, 0)) == {'o1', 'o2'}
+    index.update_routes([3], [])
+    assert index.query(['b'], 0, 400, 0) == {}
+
+
+def test_update_routes_order_moved_to_other_bus():
+    index = make_index()
+    route_b2 = make_route(4, 'b')
+    # o1 moved from route 1 to a new route of bus b, route 1 is not reported as changed
+    index.update_routes([4], [make_order('o1', route_b2, (100, 110), (130, 140))])
+    assert set(index.query(['a'], 0, 200, 0)) == {'o2'}
+    assert set(index.query(['b'], 0, 200, 0)) == {'o1', 'o4'}
+    assert index.query(['b'], 0, 200, 0)['o1']['route_id'] == 4
@@ -0,0 +1,126 @@
+"""
+ Copyright  2025 IAV GmbH Ingenieurgesellschaft Auto und Verkehr, All Rights Reserved.
+ 
+ Licensed under the Apache License, Version 2.0 (the "License");
+ you may not use this file except in compliance with the License.
+ You may obtain a copy of the License at
+ 
+ http://www.apache.org/licenses/LICENSE-2.0
+ 
+ Unless required by applicable law or agreed to in writing, software
+ distributed under the License is distributed on an "AS IS" BASIS,
+ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ See the License for the specific language governing permissions and
+ limitations under the License.
+ 
+ SPDX-License-Identifier: Apache-2.0
+"""
+from routing.routing import BusTour
+from routing.routingClasses import Moby
+
+from conftest import make_bus, make_promise
+
+
+def make_tour(graph, vehicles):
+    return BusTour(graph, None, vehicles, time_offset_factor=1.0, time_per_demand_unit_wheelchair=0, slack=10)
+
+
+def test_prune_routes_before_and_after_request(graph, stations):
+    bus = make_bus()
+    tour = make_tour(graph, [bus])
+    promises = {1: make_promise(stations, 1, 2, 0, bus.id, 1), 2: make_promise(stations, 4, 5, 500, bus.id, 2)}
+    request = Moby(stations[3], stations[4], (200, 210), None)
+
+    promises_kept, vehicle_indices = tour.prune_promises(request, promises)
+
+    assert promises_kept == {}
+    assert vehicle_indices == [0]
+    # the vehicle keeps the time between the removed routes (widened by 1), the vehicle of the caller is not changed
+    assert tour.capacities[0].work_time == (16, 499)
+    assert bus.work_time == (0, 1000)
+
+
+def test_prune_keeps_route_overlapping_request(graph, stations):
+    bus = make_bus()
+    tour = make_tour(graph, [bus])
+    promises = {1: make_promise(stations, 1, 2, 0, bus.id, 1), 2: make_promise(stations, 2, 5, 195, bus.id, 2)}
+    request = Moby(stations[3], stations[4], (200, 210), None)
+
+    promises_kept, vehicle_indices = tour.prune_promises(request, promises)
+
+    assert list(promises_kept) == [2]
+    assert vehicle_indices == [0]
+    assert tour.capacities[0].work_time == (16, 1000)
+
+
+def test_prune_travel_time_to_request(graph, stations):
+    bus = make_bus()
+    tour = make_tour(graph, [bus])
+    # the route ends at station 1 at 186 (widened by 1), 20 min before the request can start at station 3
+    promises = {1: make_promise(stations, 4, 1, 150, bus.id, 1)}
+    request = Moby(stations[3], stations[4], (206, 210), None)
+    assert list(tour.prune_promises(request, promises)[0]) == []
+
+    tour = make_tour(graph, [bus])
+    request = Moby(stations[3], stations[4], (200, 210), None)
+    assert list(tour.prune_promises(request, promises)[0]) == [1]
+
+
+def test_prune_removes_idle_vehicles(graph, stations):
+    bus_busy = make_bus()
+    bus_idle = make_bus(work_time=(600, 900))
+    bus_fixed = make_bus(work_time=(600, 900))
+    tour = make_tour(graph, [bus_idle, bus_busy, bus_fixed])
+    promises = {1: make_promise(stations, 2, 5, 195, bus_busy.id, 1)}
+    request = Moby(stations[3], stations[4], (200, 210), None)
+
+    promises_kept, vehicle_indices = tour.prune_promises(request, promises, [bus_fixed.id])
+
+    assert list(promises_kept) == [1]
+    assert vehicle_indices == [1, 2]
+    assert [vehicle.id for vehicle in tour.capacities] == [bus_busy.id, bus_fixed.id]
+
+
+def test_prune_needs_route_of_promises(graph, stations):
+    bus = make_bus()
+    tour = make_tour(graph, [bus])
+    promises = {1: make_promise(stations, 1, 2, 0, bus.id, 1), 2: make_promise(stations, 4, 5, 500, bus.id, None)}
+    request = Moby(stations[3], stations[4], (200, 210), None)
+
+    promises_kept, vehicle_indices = tour.prune_promises(request, promises)
+
+    assert promises_kept == promises
+    assert vehicle_indices == [0]
+
+
+def test_insertion_into_committed_route(graph, stations):
+    bus = make_bus()
+    tour = make_tour(graph, [bus])
+    tour._add_moby(make_promise(stations, 1, 4, 100, bus.id, 1), promised=True)
+    tour._add_moby(Moby(stations[2], stations[3], (110, 115), None))
+    assert tour.insertion_feasible()
+
+
+def test_no_insertion_into_full_route(graph, stations):
+    bus = make_bus(seats=4)
+    tour = make_tour(graph, [bus])
+    tour._add_moby(make_promise(stations, 1, 4, 100, bus.id, 1, load=4), promised=True)
+    tour._add_moby(Moby(stations[2], stations[3], (110, 115), None))
+    assert not tour.insertion_feasible()
+
+
+def test_no_insertion_out_of_time(graph, stations):
+    bus = make_bus()
+    tour = make_tour(graph, [bus])
+    tour._add_moby(make_promise(stations, 1, 4, 100, bus.id, 1), promised=True)
+    # the bus would have to go back from station 4 to 1
+    tour._add_moby(Moby(stations[1], stations[2], (115, 118), None))
+    assert not tour.insertion_feasible()
+
+
+def test_no_insertion_without_vehicle_of_promise(graph, stations):
+    bus = make_bus()
+    tour = make_tour(graph, [bus])
+    tour._add_moby(make_promise(stations, 1, 4, 100, 'other bus', 1), promised=True)
+    tour._add_moby(Moby(stations[2], stations[3], (110, 115), None))
+    assert not tour.insertion_feasible()